@@ -31,6 +31,7 @@ from modules.update_manager.update_manager import UpdateManager
 from slips_files.common.imports import *
 from slips_files.common.style import green
 from slips_files.core.evidencehandler import EvidenceHandler
+from slips_files.core.helpers.profiler_queue import ProfilerQueue
 from slips_files.core.input import Input
 from slips_files.core.output import Output
 from slips_files.core.profiler import Profiler
@@ -40,8 +41,8 @@ class ProcessManager:
     def __init__(self, main):
         self.main = main
         # this is the queue that will be used by the input proces
-        # to pass flows to the profiler
-        self.profiler_queue = Queue()
+        # to pass flows to the profiler, it's in shared memory
+        self.profiler_queue = ProfilerQueue()
         self.termination_event: Event = Event()
         self.stopped_modules = []
         # used to stop slips when these 2 are done
@@ -133,7 +134,43 @@ class ProcessManager:
                         f"PID {green(pbar.pid)}]")
         return pbar
 
+    def start_profiler_worker(
+        self, worker_id: int, worker_queue: Queue, worker_done: Event
+    ):
+        """
+        starts a profiler process that profiles the flows sent to its
+        queue by the main profiler process
+        """
+        worker = Profiler(
+            self.main.logger,
+            self.main.args.output,
+            self.main.redis_port,
+            self.termination_event,
+            profiler_queue=worker_queue,
+            is_profiler_done_event=worker_done,
+            worker_id=worker_id,
+        )
+        worker.start()
+        self.main.print(
+            f'Started {green(f"Profiler Worker {worker_id}")} '
+            f"[PID {green(worker.pid)}]",
+            1,
+            0,
+        )
+        self.main.db.store_pid(worker.name, int(worker.pid))
+        return worker
+
     def start_profiler_process(self):
+        workers: int = self.main.conf.profiler_workers()
+        workers_queues, workers_done = None, None
+        if workers > 1:
+            workers_queues = [Queue() for _ in range(workers)]
+            workers_done = [Event() for _ in range(workers)]
+            for worker_id in range(workers):
+                self.start_profiler_worker(
+                    worker_id, workers_queues[worker_id], workers_done[worker_id]
+                )
+
         profiler_process = Profiler(
             self.main.logger,
             self.main.args.output,
@@ -143,6 +180,8 @@ class ProcessManager:
             profiler_queue=self.profiler_queue,
             is_profiler_done_event=self.is_profiler_done_event,
             has_pbar=self.is_pbar_supported(),
+            workers_queues=workers_queues,
+            workers_done=workers_done,
         )
         profiler_process.start()
         self.main.print(
@@ -732,6 +771,7 @@ class ProcessManager:
 
             self.output_send_pipe.close()
             self.pbar_recv_pipe.close()
+            self.profiler_queue.unlink()
 
             # if store_a_copy_of_zeek_files is set to yes in slips.conf,
             # copy the whole zeek_files dir to the output dir
@@ -170,6 +170,10 @@ class RedisManager:
             decode_responses=True,
         )
         rcache.flushdb()
+        # the snapshot has the IoCs of the cache db, it's useless without it
+        if snapshot_path := self.main.conf.ioc_snapshot_path():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(snapshot_path)
         return True
 
     def close_all_ports(self):
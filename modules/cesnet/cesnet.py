@@ -262,6 +262,8 @@ class CESNET(IModule):
                 src_ips.update({srcip: json.dumps(event_info)})
 
         self.db.add_ips_to_IoC(src_ips)
+        # share the received IoCs with the other slips instances
+        self.db.write_IoC_snapshot()
 
     def pre_main(self):
         utils.drop_root_privs()
@@ -12,13 +12,14 @@ import math
 import time
 
 from slips_files.common.imports import *
-from .timer_thread import TimerThread
+from .timer_scheduler import TimerScheduler
 from .set_evidence import SetEvidnceHelper
 from slips_files.core.helpers.whitelist import Whitelist
 from slips_files.common.slips_utils import utils
 from typing import List, \
-    Tuple, \
-    Dict
+    Dict, \
+    Set, \
+    Tuple
 
 
 class FlowAlerts(IModule):
@@ -39,14 +40,19 @@ class FlowAlerts(IModule):
         self.p2p_daddrs = {}
         # get the default gateway
         self.gateway = self.db.get_gateway_ip()
-        # Cache list of connections that we already checked in the timer
+        # runs the checks that wait for other flows to arrive
+        # and check again later
+        self.timer_scheduler = TimerScheduler(
+            log_error=lambda text: self.print(text, 0, 1)
+        )
+        # Cache of connections that we already checked in the timer
         # thread (we waited for the connection of these dns resolutions)
-        self.connections_checked_in_dns_conn_timer_thread = []
-        # Cache list of connections that we already checked in the timer
+        self.connections_checked_in_dns_conn_timer_thread: Set[str] = set()
+        # Cache of connections that we already checked in the timer
         # thread (we waited for the dns resolution for these connections)
-        self.connections_checked_in_conn_dns_timer_thread = []
-        # Cache list of connections that we already checked in the timer thread for ssh check
-        self.connections_checked_in_ssh_timer_thread = []
+        self.connections_checked_in_conn_dns_timer_thread: Set[str] = set()
+        # Cache of connections that we already checked in the timer thread for ssh check
+        self.connections_checked_in_ssh_timer_thread: Set[str] = set()
         # Threshold how much time to wait when capturing in an interface, to start reporting connections without DNS
         # Usually the computer resolved DNS already, so we need to wait a little to report
         # In mins
@@ -387,53 +393,37 @@ class FlowAlerts(IModule):
             # maybe an empty file is downloaded
             return False
 
-    def get_sent_bytes(self, all_flows: Dict[str, dict]) \
-            -> Dict[str, Tuple[int, List[str], str]] :
+    def get_sent_bytes(self, profileid: str, twid: str) \
+            -> Dict[str, Tuple[int, List[str], float]]:
         """
-        Returns a dict of sent bytes to all ips in the all_flows dict
+        Returns a dict of sent bytes to all ips contacted by the given
+        profile in the given tw, summed by the db from the stored flows
          {
             contacted_ip: (
-                sum_of_mbs_sent,
+                sum_of_bytes_sent,
                 [uids],
                 last_ts_of_flow_containging_this_contacted_ip
             )
         }
          """
-        bytes_sent = {}
-        for uid, flow in all_flows.items():
-            daddr = flow['daddr']
-            sbytes: int = flow.get('sbytes', 0)
-            ts: str = flow.get('starttime', '')
-
-            if self.is_ignored_ip_data_upload(daddr) or not sbytes:
-                continue
-
-            if daddr in bytes_sent:
-                mbs_sent, uids, _= bytes_sent[daddr]
-                mbs_sent += sbytes
-                uids.append(uid)
-                bytes_sent[daddr] = (mbs_sent, uids, ts)
-            else:
-                bytes_sent[daddr] = (sbytes, [uid], ts)
+        return {
+            daddr: ip_info
+            for daddr, ip_info
+            in self.db.get_sent_bytes_per_daddr(profileid, twid).items()
+            if not self.is_ignored_ip_data_upload(daddr)
+        }
 
-        return bytes_sent
-    
     def detect_data_upload_in_twid(self, profileid, twid):
         """
         For each contacted ip in this twid,
         check if the total bytes sent to this ip is >= data_exfiltration_threshold
         """
-        all_flows: Dict[str, dict] = self.db.get_all_flows_in_profileid(
-            profileid
-        )
-        if not all_flows:
-            return
-
-        bytes_sent: Dict[str, Tuple[int, List[str], str]]
-        bytes_sent = self.get_sent_bytes(all_flows)
+        # the flows of the tw are stored before the tw is closed, so
+        # this counts all of them no matter when flowalerts got them
+        bytes_sent: Dict[str, Tuple[int, List[str], float]]
+        bytes_sent = self.get_sent_bytes(profileid, twid)
 
         for ip, ip_info in bytes_sent.items():
-            ip_info: Tuple[int, List[str], str]
             bytes_uploaded, uids, ts = ip_info
             
             mbs_uploaded = utils.convert_to_mb(bytes_uploaded)
@@ -615,6 +605,42 @@ class FlowAlerts(IModule):
             if self.whitelist.is_ip_in_org(ip, org):
                 return True
             
+    def recheck_later(
+            self,
+            checked_uids: Set[str],
+            uid: str,
+            interval: float,
+            function,
+            params: list,
+            groups=(),
+    ):
+        """
+        calls function(*params) again after interval seconds to give
+        time to the flows it needs to arrive.
+        the uid is added to the given checked uids, so the function
+        knows it's checking it for the 2nd time
+        :param groups: the check is cancelled when cancel_rechecks()
+        is called with any of them
+        """
+        checked_uids.add(uid)
+        if not self.timer_scheduler.schedule(
+            (function.__name__, uid),
+            interval,
+            function,
+            params,
+            groups=groups,
+        ):
+            # too many checks are waiting
+            checked_uids.discard(uid)
+
+    def cancel_rechecks(self, checked_uids: Set[str], group):
+        """
+        cancels the checks of the given group because the flow
+        they were waiting for arrived
+        """
+        for _, uid in self.timer_scheduler.cancel_group(group):
+            checked_uids.discard(uid)
+
     def should_ignore_conn_without_dns(self, flow_type, appproto, daddr) \
             -> bool:
         """
@@ -692,15 +718,19 @@ class FlowAlerts(IModule):
             # comes here if we haven't started the timer
             # thread for this connection before
             # mark this connection as checked
-            self.connections_checked_in_conn_dns_timer_thread.append(uid)
             params = [flow_type, appproto, daddr, twid, profileid, timestamp, uid]
             # self.print(f'Starting the timer to check on {daddr}, uid {uid}.
 
             # time {datetime.datetime.now()}')
-            timer = TimerThread(
-                15, self.check_connection_without_dns_resolution, params
+            # the check is cancelled if the dns resolution arrives
+            self.recheck_later(
+                self.connections_checked_in_conn_dns_timer_thread,
+                uid,
+                15,
+                self.check_connection_without_dns_resolution,
+                params,
+                groups=[('conn_waiting_for_dns', daddr)],
             )
-            timer.start()
         else:
             # It means we already checked this conn with the Timer process
             # (we waited 15 seconds for the dns to arrive after
@@ -722,10 +752,7 @@ class FlowAlerts(IModule):
             )
             # This UID will never appear again, so we can remove it and
             # free some memory
-            with contextlib.suppress(ValueError):
-                self.connections_checked_in_conn_dns_timer_thread.remove(
-                    uid
-                )
+            self.connections_checked_in_conn_dns_timer_thread.discard(uid)
 
     def is_CNAME_contacted(self, answers, contacted_ips) -> bool:
         """
@@ -851,14 +878,22 @@ class FlowAlerts(IModule):
         if uid not in self.connections_checked_in_dns_conn_timer_thread:
             # comes here if we haven't started the timer
             # thread for this dns before mark this dns as checked
-            self.connections_checked_in_dns_conn_timer_thread.append(uid)
             params = [domain, answers, rcode_name, timestamp, profileid, twid, uid]
             # self.print(f'Starting the timer to check on {domain}, uid {uid}.
             # time {datetime.datetime.now()}')
-            timer = TimerThread(
-                40, self.check_dns_without_connection, params
+            # the check is cancelled if a connection to any of the
+            # answers arrives
+            self.recheck_later(
+                self.connections_checked_in_dns_conn_timer_thread,
+                uid,
+                40,
+                self.check_dns_without_connection,
+                params,
+                groups=[
+                    ('dns_waiting_for_conn', profileid, twid, ip)
+                    for ip in self.extract_ips_from_dns_answers(answers)
+                ],
             )
-            timer.start()
         else:
             # It means we already checked this dns with the Timer process
             # but still no connection for it.
@@ -867,8 +902,7 @@ class FlowAlerts(IModule):
             )
             # This UID will never appear again, so we can remove it and
             # free some memory
-            with contextlib.suppress(ValueError):
-                self.connections_checked_in_dns_conn_timer_thread.remove(uid)
+            self.connections_checked_in_dns_conn_timer_thread.discard(uid)
 
     def detect_successful_ssh_by_zeek(self, uid, timestamp, profileid, twid):
         """
@@ -892,10 +926,7 @@ class FlowAlerts(IModule):
                 timestamp,
                 by='Zeek',
             )
-            with contextlib.suppress(ValueError):
-                self.connections_checked_in_ssh_timer_thread.remove(
-                    uid
-                )
+            self.connections_checked_in_ssh_timer_thread.discard(uid)
             return True
 
         elif uid not in self.connections_checked_in_ssh_timer_thread:
@@ -905,14 +936,14 @@ class FlowAlerts(IModule):
             # mark this connection as checked
             # self.print(f'Starting the timer to check on {flow_dict},
             # uid {uid}. time {datetime.datetime.now()}')
-            self.connections_checked_in_ssh_timer_thread.append(
-                uid
-            )
             params = [uid, timestamp, profileid, twid]
-            timer = TimerThread(
-                15, self.detect_successful_ssh_by_zeek, params
+            self.recheck_later(
+                self.connections_checked_in_ssh_timer_thread,
+                uid,
+                15,
+                self.detect_successful_ssh_by_zeek,
+                params,
             )
-            timer.start()
 
     def detect_successful_ssh_by_slips(self, uid, timestamp, profileid, twid, auth_success):
         """
@@ -942,10 +973,7 @@ class FlowAlerts(IModule):
                     timestamp,
                     by='Slips',
                 )
-                with contextlib.suppress(ValueError):
-                    self.connections_checked_in_ssh_timer_thread.remove(
-                        uid
-                    )
+                self.connections_checked_in_ssh_timer_thread.discard(uid)
                 return True
 
         elif uid not in self.connections_checked_in_ssh_timer_thread:
@@ -955,14 +983,14 @@ class FlowAlerts(IModule):
             # mark this connection as checked
             # self.print(f'Starting the timer to check on {flow_dict}, uid {uid}.
             # time {datetime.datetime.now()}')
-            self.connections_checked_in_ssh_timer_thread.append(
-                uid
-            )
             params = [uid, timestamp, profileid, twid, auth_success]
-            timer = TimerThread(
-                15, self.check_successful_ssh, params
+            self.recheck_later(
+                self.connections_checked_in_ssh_timer_thread,
+                uid,
+                15,
+                self.check_successful_ssh,
+                params,
             )
-            timer.start()
 
     def check_successful_ssh(
             self, uid, timestamp, profileid, twid, auth_success
@@ -1865,6 +1893,13 @@ class FlowAlerts(IModule):
             if not appproto or appproto == '-':
                 appproto = flow_dict.get('type', '')
 
+            # the dns resolutions of this daddr don't need to
+            # wait for a connection anymore
+            self.cancel_rechecks(
+                self.connections_checked_in_dns_conn_timer_thread,
+                ('dns_waiting_for_conn', profileid, twid, daddr),
+            )
+
             self.check_long_connection(
                 dur, daddr, saddr, profileid, twid, uid, timestamp
             )
@@ -2156,6 +2191,14 @@ class FlowAlerts(IModule):
                     domain, answers, rcode_name, stime, profileid, twid, uid
                 )
 
+            # the connections to the answers don't need to
+            # wait for this resolution anymore
+            for ip in self.extract_ips_from_dns_answers(answers or []):
+                self.cancel_rechecks(
+                    self.connections_checked_in_conn_dns_timer_thread,
+                    ('conn_waiting_for_dns', ip),
+                )
+
             self.check_suspicious_dns_answers(
                 domain, answers, daddr, profileid, twid, stime, uid
             )
@@ -0,0 +1,181 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+import traceback
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Set,
+    Tuple,
+    )
+
+
+class TimerScheduler:
+    """
+    Runs tasks after a delay using 1 thread for all of them, instead of
+    starting a TimerThread per task.
+
+    Tasks are identified by a key (e.g. the uid of the flow they check),
+    a key can only be scheduled once until its task runs or is cancelled.
+    Tasks can be added to groups (e.g. the ip they're waiting for) to
+    cancel all of them at once.
+
+    The thread runs all the tasks that are due at once, and exits when
+    there are no tasks left. it's started again when a task is scheduled,
+    so the process waits for the pending tasks before exiting, like it
+    did with the TimerThreads.
+    """
+
+    def __init__(
+            self,
+            log_error: Callable[[str], None] = None,
+            max_pending: int = 100000,
+    ):
+        # called with the errors of the tasks that fail, prints them to
+        # stderr if not given
+        self.log_error = log_error or (
+            lambda text: print(text, file=sys.stderr)
+        )
+        # tasks scheduled after this number is reached are discarded
+        self.max_pending = max_pending
+        # (time to run the task, task id, key) sorted by time.
+        # cancelled tasks are removed from self.pending only, and
+        # skipped when they're due
+        self.heap: List[Tuple[float, int, Hashable]] = []
+        self.task_ids = itertools.count()
+        # {key: (task id, function, parameters, groups)}
+        self.pending: Dict[
+            Hashable, Tuple[int, Callable, Iterable, tuple]
+        ] = {}
+        # {group: keys of the tasks in it}
+        self.groups: Dict[Hashable, Set[Hashable]] = {}
+        self.lock = threading.Lock()
+        # set when a task that runs before the others is scheduled
+        self.wake_up = threading.Event()
+        self.running = False
+
+    def is_pending(self, key: Hashable) -> bool:
+        return key in self.pending
+
+    def schedule(
+            self,
+            key: Hashable,
+            interval: float,
+            function: Callable,
+            parameters: Iterable,
+            groups: Iterable[Hashable] = (),
+    ) -> bool:
+        """
+        calls function(*parameters) after interval seconds
+        returns False if the key is already scheduled or there are
+        max_pending tasks waiting
+        """
+        with self.lock:
+            if key in self.pending or len(self.pending) >= self.max_pending:
+                return False
+
+            groups = tuple(groups)
+            task_id = next(self.task_ids)
+            self.pending[key] = (task_id, function, parameters, groups)
+            for group in groups:
+                self.groups.setdefault(group, set()).add(key)
+
+            run_at = time.time() + interval
+            if not self.heap or run_at < self.heap[0][0]:
+                self.wake_up.set()
+            heapq.heappush(self.heap, (run_at, task_id, key))
+
+            if not self.running:
+                self.running = True
+                threading.Thread(
+                    target=self.run, name='TimerScheduler'
+                ).start()
+        return True
+
+    def remove_from_groups(self, key: Hashable, groups: tuple):
+        for group in groups:
+            keys = self.groups.get(group)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.groups[group]
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        discards the task of the given key
+        returns False if it's not scheduled
+        """
+        with self.lock:
+            task = self.pending.pop(key, None)
+            if not task:
+                return False
+            self.remove_from_groups(key, task[3])
+            return True
+
+    def cancel_group(self, group: Hashable) -> List[Hashable]:
+        """
+        discards all the tasks in the given group
+        returns the keys of the discarded tasks
+        """
+        with self.lock:
+            keys = self.groups.pop(group, set())
+            for key in keys:
+                *_, groups = self.pending.pop(key)
+                self.remove_from_groups(key, groups)
+        return list(keys)
+
+    def get_due_tasks(self) -> List[Tuple[Callable, Iterable]]:
+        """
+        removes the tasks that should run now from the scheduled tasks
+        and returns them
+        """
+        now = time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, task_id, key = heapq.heappop(self.heap)
+            task = self.pending.get(key)
+            # the task of this entry was cancelled, and maybe scheduled
+            # again with a different id
+            if not task or task[0] != task_id:
+                continue
+            del self.pending[key]
+            _, function, parameters, groups = task
+            self.remove_from_groups(key, groups)
+            due.append((function, parameters))
+        return due
+
+    def run(self):
+        while True:
+            with self.lock:
+                due = self.get_due_tasks()
+                if not due:
+                    if not self.pending:
+                        # started again by the next schedule()
+                        self.heap = []
+                        self.running = False
+                        return
+                    self.wake_up.clear()
+                    wait = self.heap[0][0] - time.time()
+
+            if not due:
+                self.wake_up.wait(wait)
+                continue
+
+            for function, parameters in due:
+                try:
+                    function(*parameters)
+                except KeyboardInterrupt:
+                    return
+                except Exception:
+                    # 1 failing task shouldn't stop the rest
+                    self.log_error(
+                        f'Problem in the scheduled task '
+                        f'{getattr(function, "__name__", function)}'
+                    )
+                    self.log_error(traceback.format_exc())
@@ -4,7 +4,13 @@ import pickle
 import pandas as pd
 import json
 import datetime
+import time
 import traceback
+from typing import (
+    Optional,
+    List,
+    Tuple,
+)
 
 from slips_files.common.imports import *
 from slips_files.core.evidence_structure.evidence import \
@@ -57,16 +63,52 @@ class FlowMLDetection(IModule):
         # self.scores = []
         # The scaler trained during training and to use during testing
         self.scaler = StandardScaler()
+        # flows waiting to be detected in test mode.
+        # each one is a tuple (flow dict, twid, uid)
+        self.batch = []
+        self.batch_start_time = 0
 
     def read_configuration(self):
         conf = ConfigParser()
         self.mode = conf.get_ml_mode()
+        self.batch_size: int = conf.get_ml_batch_size()
+        self.batch_timeout: float = conf.get_ml_batch_timeout()
+        self.training_chunk_size: int = conf.get_ml_training_chunk_size()
+        self.training_checkpoint_chunks: int = (
+            conf.get_ml_training_checkpoint_chunks()
+        )
 
 
 
     def train(self):
         """
-        Train a model based on the flows we receive and the labels
+        Train a model based on the flows in the db and their labels.
+        the flows are read and trained on in chunks
+        """
+        # the scaler is fitted again on all the flows every time we train
+        self.scaler = StandardScaler()
+        trained_chunks = 0
+        for flows in self.get_training_flows():
+            self.flows = flows
+            self.train_chunk()
+            trained_chunks += 1
+            if (
+                self.training_checkpoint_chunks
+                and trained_chunks % self.training_checkpoint_chunks == 0
+            ):
+                self.store_model()
+
+        if trained_chunks and not (
+            self.training_checkpoint_chunks
+            and trained_chunks % self.training_checkpoint_chunks == 0
+        ):
+            # Store the models on disk, unless the last chunk was just
+            # checkpointed
+            self.store_model()
+
+    def train_chunk(self):
+        """
+        Train the model with the chunk of flows in self.flows
         """
         try:
             # Process the labels to have only Normal and Malware
@@ -85,8 +127,10 @@ class FlowMLDetection(IModule):
             X_flow = self.flows.drop('label', axis=1)
             X_flow = X_flow.drop('module_labels', axis=1)
 
-            # Normalize this batch of data so far. This can get progressivle slow
-            X_flow = self.scaler.fit_transform(X_flow)
+            # Normalize this chunk with the scaler fitted on all the chunks
+            # so far
+            self.scaler.partial_fit(X_flow)
+            X_flow = self.scaler.transform(X_flow)
 
             # Train
             try:
@@ -110,11 +154,8 @@ class FlowMLDetection(IModule):
             # plt.plot(self.scores)
             # plt.savefig('train-scores.png')
 
-            # Store the models on disk
-            self.store_model()
-
         except Exception:
-            self.print('Error in train()', 0 , 1)
+            self.print('Error in train_chunk()', 0 , 1)
             self.print(traceback.format_exc(), 0, 1)
 
 
@@ -218,72 +259,85 @@ class FlowMLDetection(IModule):
             self.print('Error in process_features()')
             self.print(traceback.format_exc(),0,1)
 
-    def process_flows(self):
+    def get_fake_flows(self) -> list:
         """
-        Process all the flwos in the DB
+        Returns 2 flows that are fake but representative of a normal and
+        malware flow. they are only for the training process
+        """
+        return [
+            {
+                'ts': 1594417039.029793,
+                'dur': '1.9424750804901123',
+                'saddr': '10.7.10.101',
+                'sport': '49733',
+                'daddr': '40.70.224.145',
+                'dport': '443',
+                'proto': 'tcp',
+                'origstate': 'SRPA_SPA',
+                'state': 'Established',
+                'pkts': 84,
+                'allbytes': 42764,
+                'spkts': 37,
+                'sbytes': 25517,
+                'appproto': 'ssl',
+                'label': 'Malware',
+                'module_labels': {
+                    'flowalerts-long-connection': 'Malware'
+                },
+            },
+            {
+                'ts': 1382355032.706468,
+                'dur': '10.896695',
+                'saddr': '147.32.83.52',
+                'sport': '47956',
+                'daddr': '80.242.138.72',
+                'dport': '80',
+                'proto': 'tcp',
+                'origstate': 'SRPA_SPA',
+                'state': 'Established',
+                'pkts': 67,
+                'allbytes': 67696,
+                'spkts': 1,
+                'sbytes': 100,
+                'appproto': 'http',
+                'label': 'Normal',
+                'module_labels': {
+                    'flowalerts-long-connection': 'Normal'
+                },
+            },
+        ]
+
+    def get_training_flows(self):
+        """
+        Yields the flows in the DB in chunks of training_chunk_size flows,
+        each chunk is a pandas df processed and ready for training
+        """
+        # Check how many different labels are in the DB
+        # We need both normal and malware
+        labels = self.db.get_labels()
+        # If only 1 label has flows, there are not enough different labels,
+        # so insert two flows that are fake but representative of a normal
+        # and malware flow to the first chunk
+        # At least 1 flow of each label is required
+        add_fake_flows = len(labels) == 1
+
+        for flows in self.db.iterate_flows_in_chunks(
+                self.training_chunk_size
+        ):
+            if add_fake_flows:
+                flows.extend(self.get_fake_flows())
+                add_fake_flows = False
+
+            self.process_flows(flows)
+            if self.flows is not None and not self.flows.empty:
+                yield self.flows
+
+    def process_flows(self, flows: list):
+        """
+        Process the given chunk of flows from the DB
         Store the pandas df in self.flows
         """
         try:
-            # We get all the flows so far
-            # because this retraining happens in batches
-            flows = self.db.get_all_flows()
-
-            # Check how many different labels are in the DB
-            # We need both normal and malware
-            labels = self.db.get_labels()
-            if len(labels) == 1:
-                # Only 1 label has flows
-                # There are not enough different labels, so insert two flows
-                # that are fake but representative of a normal and malware flow
-                # they are only for the training process
-                # At least 1 flow of each label is required
-                # self.print(f'Amount of labeled flows: {labels}', 0, 1)
-                flows.append(
-                    {
-                        'ts': 1594417039.029793,
-                        'dur': '1.9424750804901123',
-                        'saddr': '10.7.10.101',
-                        'sport': '49733',
-                        'daddr': '40.70.224.145',
-                        'dport': '443',
-                        'proto': 'tcp',
-                        'origstate': 'SRPA_SPA',
-                        'state': 'Established',
-                        'pkts': 84,
-                        'allbytes': 42764,
-                        'spkts': 37,
-                        'sbytes': 25517,
-                        'appproto': 'ssl',
-                        'label': 'Malware',
-                        'module_labels': {
-                            'flowalerts-long-connection': 'Malware'
-                        },
-                    }
-                )
-                flows.append(
-                    {
-                        'ts': 1382355032.706468,
-                        'dur': '10.896695',
-                        'saddr': '147.32.83.52',
-                        'sport': '47956',
-                        'daddr': '80.242.138.72',
-                        'dport': '80',
-                        'proto': 'tcp',
-                        'origstate': 'SRPA_SPA',
-                        'state': 'Established',
-                        'pkts': 67,
-                        'allbytes': 67696,
-                        'spkts': 1,
-                        'sbytes': 100,
-                        'appproto': 'http',
-                        'label': 'Normal',
-                        'module_labels': {
-                            'flowalerts-long-connection': 'Normal'
-                        },
-                    }
-                )
-                # If there are enough flows, we dont insert them anymore
-
             # Convert to pandas df
             df_flows = pd.DataFrame(flows)
 
@@ -296,15 +350,23 @@ class FlowMLDetection(IModule):
             # Stop the timer
             self.print('Error in process_flows()')
             self.print(traceback.format_exc(),0,1)
+            self.flows = None
 
-    def process_flow(self):
+    def process_flow(self, flows: list):
         """
-        Process one flow. Only used during detection in testing
-        Store the pandas df in self.flow
+        Process the given flows of the current batch. Only used during
+        detection in testing
+        Store the pandas df in self.flow, the index of each row is the
+        index of its flow in the given list
+        :param flows: (flow_dict, twid, uid) of each flow
         """
+        # don't keep the df of the previous batch if this one fails
+        self.flow = None
         try:
-            # Convert the flow to a pandas dataframe
-            raw_flow = pd.DataFrame(self.flow_dict, index=[0])
+            # Convert the flows to a pandas dataframe
+            raw_flow = pd.DataFrame(
+                [flow_dict for flow_dict, _, _ in flows]
+            )
             # Process features
             dflow = self.process_features(raw_flow)
             # Update the flow to the processed version
@@ -313,10 +375,12 @@ class FlowMLDetection(IModule):
             # Stop the timer
             self.print('Error in process_flow()')
             self.print(traceback.format_exc(),0,1)
+            self.flow = None
 
     def detect(self):
         """
-        Detect this flow with the current model stored
+        Detect the flows in self.flow with the current model stored
+        returns the predicted label of each row
         """
         try:
             # Store the real label if there is one
@@ -413,10 +477,112 @@ class FlowMLDetection(IModule):
         self.db.set_evidence(evidence)
 
 
+    def add_flow_to_batch(self, flow_dict: dict, twid: str, uid: str):
+        if not self.batch:
+            self.batch_start_time = time.time()
+        self.batch.append((flow_dict, twid, uid))
+
+    def should_detect_batch(self) -> bool:
+        """
+        the batch is detected when it's full or when
+        its oldest flow waited for batch_timeout
+        """
+        if not self.batch:
+            return False
+
+        return (
+            len(self.batch) >= self.batch_size
+            or time.time() - self.batch_start_time >= self.batch_timeout
+        )
+
+    def detect_flows(self, flows: list) -> Optional[List[Tuple[int, str]]]:
+        """
+        Detects the given flows using 1 prediction
+        returns the (index of the flow in the given list, prediction) of
+        each flow that wasn't discarded, or None if the flows can't be
+        detected
+        :param flows: (flow_dict, twid, uid) of each flow
+        """
+        self.process_flow(flows)
+        if self.flow is None:
+            return None
+
+        # After processing the flows, it may happen that we delete icmp/arp/etc
+        # so the dataframe can be empty
+        if self.flow.empty:
+            return []
+
+        flows_indices = list(self.flow.index)
+        preds = self.detect()
+        if preds is None:
+            return None
+        return list(zip(flows_indices, preds))
+
+    def detect_batch(self):
+        """
+        Detects all the flows of the current batch using 1 prediction
+        and sets evidence for the malicious ones
+        """
+        batch = self.batch
+        self.batch = []
+
+        predictions = self.detect_flows(batch)
+        if predictions is None and len(batch) > 1:
+            # 1 malformed flow makes the whole batch fail, detect the
+            # flows one by one so only the malformed ones are skipped
+            predictions = []
+            for flow_index, flow in enumerate(batch):
+                if flow_prediction := self.detect_flows([flow]):
+                    _, pred = flow_prediction[0]
+                    predictions.append((flow_index, pred))
+
+        for flow_index, pred in predictions or []:
+            flow_dict, twid, uid = batch[flow_index]
+            self.report_prediction(flow_dict, twid, uid, pred)
+
+    def report_prediction(
+            self, flow_dict: dict, twid: str, uid: str, pred: str
+            ):
+        label = flow_dict['label']
+        if (
+            label
+            and label != 'unknown'
+            and label != pred
+        ):
+            # If the user specified a label in test mode, and the label
+            # is diff from the prediction, print in debug mode
+            self.print(
+                f'Report Prediction {pred} for label {label} flow {flow_dict["saddr"]}:'
+                f'{flow_dict["sport"]} -> {flow_dict["daddr"]}:'
+                f'{flow_dict["dport"]}/{flow_dict["proto"]}',
+                0,
+                3,
+            )
+        if pred == 'Malware':
+            # Generate an alert
+            self.set_evidence_malicious_flow(
+                flow_dict['saddr'],
+                flow_dict['sport'],
+                flow_dict['daddr'],
+                flow_dict['dport'],
+                twid,
+                uid,
+            )
+            self.print(
+                f'Prediction {pred} for label {label} flow {flow_dict["saddr"]}:'
+                f'{flow_dict["sport"]} -> {flow_dict["daddr"]}:'
+                f'{flow_dict["dport"]}/{flow_dict["proto"]}',
+                0,
+                2,
+            )
+
     def shutdown_gracefully(self):
         # Confirm that the module is done processing
         if self.mode == 'train':
             self.store_model()
+        elif self.batch:
+            # don't lose the flows waiting in the batch
+            self.detect_batch()
 
     def pre_main(self):
         utils.drop_root_privs()
@@ -458,50 +624,11 @@ class FlowMLDetection(IModule):
                     self.print(
                         f'Training the model with the last group of flows and labels. Total flows: {sum_labeled_flows}.'
                     )
-                    # Process all flows in the DB and make them ready for pandas
-                    self.process_flows()
-                    # Train an algorithm
+                    # Train an algorithm with all the flows in the DB
                     self.train()
             elif self.mode == 'test':
                 # We are testing, which means using the model to detect
-                self.process_flow()
-
-                # After processing the flow, it may happen that we delete icmp/arp/etc
-                # so the dataframe can be empty
-                if self.flow is not None and not self.flow.empty:
-                    # Predict
-                    pred = self.detect()
-                    label = self.flow_dict['label']
-
-                    # Report
-                    if (
-                        label
-                        and label != 'unknown'
-                        and label != pred[0]
-                    ):
-                        # If the user specified a label in test mode, and the label
-                        # is diff from the prediction, print in debug mode
-                        self.print(
-                            f'Report Prediction {pred[0]} for label {label} flow {self.flow_dict["saddr"]}:'
-                            f'{self.flow_dict["sport"]} -> {self.flow_dict["daddr"]}:'
-                            f'{self.flow_dict["dport"]}/{self.flow_dict["proto"]}',
-                            0,
-                            3,
-                        )
-                    if pred[0] == 'Malware':
-                        # Generate an alert
-                        self.set_evidence_malicious_flow(
-                            self.flow_dict['saddr'],
-                            self.flow_dict['sport'],
-                            self.flow_dict['daddr'],
-                            self.flow_dict['dport'],
-                            twid,
-                            uid,
-                        )
-                        self.print(
-                            f'Prediction {pred[0]} for label {label} flow {self.flow_dict["saddr"]}:'
-                            f'{self.flow_dict["sport"]} -> {self.flow_dict["daddr"]}:'
-                            f'{self.flow_dict["dport"]}/{self.flow_dict["proto"]}',
-                            0,
-                            2,
-                        )
+                self.add_flow_to_batch(self.flow_dict, twid, uid)
+
+        if self.mode == 'test' and self.should_detect_batch():
+            self.detect_batch()
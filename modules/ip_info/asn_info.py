@@ -5,10 +5,16 @@ import ipwhois
 import json
 import requests
 import maxminddb
+from typing import Optional
+
+from slips_files.common.ip_range_index import IPRangeIndex
 
 class ASN:
     def __init__(self, db=None):
         self.db = db
+        # the ranges cached in the db and their asn info, loaded the first
+        # time we look for a cached asn
+        self.cached_asn_ranges: Optional[IPRangeIndex] = None
         # Open the maxminddb ASN offline db
         try:
             self.asn_db = maxminddb.open_database(
@@ -18,37 +24,38 @@ class ASN:
             # errors are printed in IP_info
             pass
 
+    def load_cached_asn_ranges(self):
+        """
+        reads the asn of all the ranges cached in the db into
+        self.cached_asn_ranges
+        """
+        self.cached_asn_ranges = IPRangeIndex()
+        for range, range_info in self.db.get_asn_cache().items():
+            self.cached_asn_ranges.add(range, json.loads(range_info))
+
     def get_cached_asn(self, ip) :
         """
         If this ip belongs to a cached ip range, return the cached asn info of it
         :param ip: str
         if teh range of this ip was found, this function returns a dict with {'number' , 'org'}
         """
-        first_octet: str = utils.get_first_octet(ip)
-        if not first_octet:
-            # invalid ip or no cached asns
-            return
+        if self.cached_asn_ranges is None:
+            self.load_cached_asn_ranges()
 
-        cached_asn: str = self.db.get_asn_cache(first_octet=first_octet)
-        if not cached_asn:
+        range_info = self.cached_asn_ranges.lookup(ip)
+        if not range_info:
+            # invalid ip or no cached asn for its range
             return
 
-        cached_asn: dict = json.loads(cached_asn)
+        asn_info = {
+            'asn': {
+                'org': range_info['org'],
 
-        for range, range_info in cached_asn.items():
-            # convert to objects
-            ip_range = ipaddress.ip_network(range)
-            ip = ipaddress.ip_address(ip)
-            if ip in ip_range:
-                asn_info = {
-                    'asn': {
-                        'org': range_info['org'],
-
-                    }
-                }
-                if 'number' in range_info:
-                    asn_info['asn'].update({"number": range_info['number']})
-                return asn_info
+            }
+        }
+        if 'number' in range_info:
+            asn_info['asn'].update({"number": range_info['number']})
+        return asn_info
 
     def update_asn(self, cached_data, update_period) -> bool:
         """
@@ -91,30 +98,32 @@ class ASN:
 
         return ip_info
 
-    def cache_ip_range(self, ip: str):
+    @staticmethod
+    def get_range_key(ip: str) -> str:
         """
-        Get the range of the given ip and
-        cache the asn of the whole ip range
+        returns the /24 (or /48 for ipv6) of the given ip. ips with the
+        same key most likely have the same asn range, so their range
+        is looked up only once
+        """
+        prefixlen = 48 if ':' in ip else 24
+        try:
+            return str(ipaddress.ip_network(f'{ip}/{prefixlen}', strict=False))
+        except ValueError:
+            return ip
+
+    def get_ip_range_online(self, ip: str, timeout: int = 5):
+        """
+        Get the asn range of the given ip and its asn using RDAP
+        returns a dict with {'org', 'cidr', 'number'}
+        or False if it wasn't found
         """
         if not ip:
             return False
 
         try:
-            # Cache the range of this ip
-            whois_info: dict = ipwhois.IPWhois(address=ip).lookup_rdap()
-            asnorg = whois_info.get('asn_description', False)
-            asn_cidr = whois_info.get('asn_cidr', False)
-            asn_number = whois_info.get('asn', False)
-
-            if asnorg and asn_cidr not in ('', 'NA'):
-                self.db.set_asn_cache(asnorg, asn_cidr, asn_number)
-                asn_info = {
-                    'asn': {
-                        'number': f'AS{asn_number}',
-                        'org': asnorg
-                    }
-                }
-                return asn_info
+            whois_info: dict = ipwhois.IPWhois(
+                address=ip, timeout=timeout
+            ).lookup_rdap()
         except (
             ipwhois.exceptions.IPDefinedError,
             ipwhois.exceptions.HTTPLookupError,
@@ -125,6 +134,48 @@ class ASN:
             # or ASN lookup failed with no more methods to try
             return False
 
+        asnorg = whois_info.get('asn_description', False)
+        asn_cidr = whois_info.get('asn_cidr', False)
+        if not asnorg or asn_cidr in ('', 'NA'):
+            return False
+
+        return {
+            'org': asnorg,
+            'cidr': asn_cidr,
+            'number': whois_info.get('asn', False),
+        }
+
+    def cache_range_info(self, range_info: dict) -> dict:
+        """
+        caches the asn of the whole ip range returned by
+        get_ip_range_online()
+        returns the asn info of the range
+        """
+        asnorg = range_info['org']
+        asn_cidr = range_info['cidr']
+        asn_number = range_info['number']
+        self.db.set_asn_cache(asnorg, asn_cidr, asn_number)
+        if self.cached_asn_ranges is not None:
+            cached_range_info = {'org': asnorg}
+            if asn_number:
+                cached_range_info['number'] = f'AS{asn_number}'
+            self.cached_asn_ranges.add(asn_cidr, cached_range_info)
+        return {
+            'asn': {
+                'number': f'AS{asn_number}',
+                'org': asnorg
+            }
+        }
+
+    def cache_ip_range(self, ip: str):
+        """
+        Get the range of the given ip and
+        cache the asn of the whole ip range
+        """
+        if range_info := self.get_ip_range_online(ip):
+            return self.cache_range_info(range_info)
+        return False
+
 
     def get_asn_online(self, ip):
         """
@@ -181,33 +232,3 @@ class ASN:
         cached_ip_info.update(asn)
         # store the ASN we found in 'IPsInfo'
         self.db.setInfoForIPs(ip, cached_ip_info)
-
-    def get_asn(self, ip, cached_ip_info):
-        """
-        Gets ASN info about IP, either cached, from our offline mmdb or from ip-api.com
-        """
-        # do we have asn cached for this range?
-        if cached_asn := self.get_cached_asn(ip):
-            self.update_ip_info(ip, cached_ip_info, cached_asn)
-            return
-
-        else:
-            # now we have 2 options, either search for the ASN in our offline db, or online
-            # either way we need to cache the asn of this ip's range so we don't search for ips in the same range
-            # cache this range in our redis db
-            if asn := self.cache_ip_range(ip):
-                # range is cached and we managed to get the number and org of the given ip using whois
-                # no need to search online or offline
-                self.update_ip_info(ip, cached_ip_info, asn)
-                return
-
-            # we don't have it cached in our db, get it from geolite
-            if asn := self.get_asn_info_from_geolite(ip):
-                self.update_ip_info(ip, cached_ip_info, asn)
-                return
-
-            # can't find asn in mmdb or using whois library, try using ip-info
-            if asn := self.get_asn_online(ip):
-                # found it online
-                self.update_ip_info(ip, cached_ip_info, asn)
-                return
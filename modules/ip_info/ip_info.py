@@ -14,9 +14,11 @@ import subprocess
 import re
 import time
 import asyncio
+from functools import partial
 
 from slips_files.common.imports import *
 from .asn_info import ASN
+from .online_lookups import OnlineLookups
 from slips_files.common.slips_utils import utils
 from slips_files.core.evidence_structure.evidence import \
     (
@@ -237,28 +239,42 @@ class IPInfo(IModule):
         """
         return socket.AF_INET6 if ':' in ip else socket.AF_INET
 
-    def get_rdns(self, ip):
+    def lookup_rdns(self, ip):
         """
-        get reverse DNS of an ip
+        get reverse DNS of an ip without storing it
         returns RDNS of the given ip or False if not found
         :param ip: str
         """
-        data = {}
         try:
             # works with both ipv4 and ipv6
             reverse_dns = socket.gethostbyaddr(ip)[0]
-            # if there's no reverse dns record for this ip, reverse_dns will be an ip.
-            try:
-                # reverse_dns is an ip. there's no reverse dns. don't store
-                socket.inet_pton(self.get_ip_family(reverse_dns), reverse_dns)
-                return False
-            except socket.error:
-                # all good, store it
-                data['reverse_dns'] = reverse_dns
-                self.db.setInfoForIPs(ip, data)
         except (socket.gaierror, socket.herror, OSError):
             # not an ip or multicast, can't get the reverse dns record of it
             return False
+
+        # if there's no reverse dns record for this ip, reverse_dns will be an ip.
+        try:
+            # reverse_dns is an ip. there's no reverse dns. don't store
+            socket.inet_pton(self.get_ip_family(reverse_dns), reverse_dns)
+            return False
+        except socket.error:
+            return reverse_dns
+
+    def get_rdns(self, ip):
+        """
+        get reverse DNS of an ip and store it
+        returns RDNS of the given ip or False if not found
+        :param ip: str
+        """
+        if reverse_dns := self.lookup_rdns(ip):
+            return self.store_rdns(ip, reverse_dns)
+        return False
+
+    def store_rdns(self, ip, reverse_dns):
+        if not reverse_dns:
+            return False
+        data = {'reverse_dns': reverse_dns}
+        self.db.setInfoForIPs(ip, data)
         return data
 
     # MAC functions
@@ -388,7 +404,84 @@ class IPInfo(IModule):
         self.db.set_info_for_domains(domain, { 'Age': age})
         return age
 
+    # ASN functions
+    def init_online_lookups(self):
+        """
+        the online lookups are slow, they run in the background so they
+        don't block the module. each service has its own threads so a
+        slow service doesn't delay the others
+        """
+        self.rdns_lookups = OnlineLookups(
+            'rDNS', self.lookup_rdns, max_workers=8, timeout=10
+        )
+        # ips in the same /24 share the same rdap lookup
+        self.rdap_lookups = OnlineLookups(
+            'RDAP', self.asn.get_ip_range_online, max_workers=4, timeout=15
+        )
+        self.ip_api_lookups = OnlineLookups(
+            'ip-api', self.asn.get_asn_online, max_workers=2, timeout=10
+        )
+        self.online_lookups = (
+            self.rdns_lookups,
+            self.rdap_lookups,
+            self.ip_api_lookups,
+        )
+
+    def get_asn(self, ip, cached_ip_info):
+        """
+        Gets ASN info about IP, either cached, from our offline mmdb or from
+        the RDAP servers or ip-api.com in the background
+        """
+        # do we have asn cached for this range?
+        if cached_asn := self.asn.get_cached_asn(ip):
+            self.asn.update_ip_info(ip, cached_ip_info, cached_asn)
+            return
+
+        # the offline db doesn't have to wait for the online lookups
+        found_offline = False
+        if asn := self.asn.get_asn_info_from_geolite(ip):
+            self.asn.update_ip_info(ip, cached_ip_info, asn)
+            found_offline = True
+
+        # either way we need to cache the asn of this ip's range so we don't
+        # search for ips in the same range
+        key = self.asn.get_range_key(ip)
+        callback = partial(self.handle_ip_range, ip, found_offline)
+        if not self.rdap_lookups.submit(key, callback, ip):
+            # the rdap lookup of this range failed recently
+            callback(None)
+
+    def handle_ip_range(self, ip, found_offline: bool, range_info):
+        """
+        called when the RDAP lookup of the range of the given ip is done
+        :param range_info: the range returned by get_ip_range_online() or
+        None if the lookup failed
+        """
+        if range_info:
+            self.asn.cache_range_info(range_info)
+            # the range may not contain all the ips that shared this lookup
+            if asn := self.asn.get_cached_asn(ip):
+                self.asn.update_ip_info(ip, {}, asn)
+                return
+
+        if found_offline:
+            return
+
+        # can't find asn in mmdb or using whois library, try using ip-api
+        self.ip_api_lookups.submit(ip, partial(self.store_asn, ip), ip)
+
+    def store_asn(self, ip, asn):
+        if asn:
+            self.asn.update_ip_info(ip, {}, asn)
+
+    def handle_online_lookups_results(self):
+        for lookups in self.online_lookups:
+            lookups.handle_results()
+
     def shutdown_gracefully(self):
+        if hasattr(self, 'online_lookups'):
+            for lookups in self.online_lookups:
+                lookups.shutdown()
         if hasattr(self, 'asn_db'):
             self.asn_db.close()
         if hasattr(self, 'country_db'):
@@ -572,6 +665,7 @@ class IPInfo(IModule):
     def pre_main(self):
         utils.drop_root_privs()
         self.wait_for_dbs()
+        self.init_online_lookups()
         # the following method only works when running on an interface
         if ip := self.get_gateway_ip():
             self.db.set_default_gateway('IP', ip)
@@ -607,10 +701,14 @@ class IPInfo(IModule):
                     cached_ip_info,
                     self.update_period
             ):
-                self.asn.get_asn(ip, cached_ip_info)
-            self.get_rdns(ip)
+                self.get_asn(ip, cached_ip_info)
+
+            # ------ RDNS -------
+            self.rdns_lookups.submit(ip, partial(self.store_rdns, ip), ip)
 
     def main(self):
+        self.handle_online_lookups_results()
+
         if msg:= self.get_msg('new_MAC'):
             data = json.loads(msg['data'])
             mac_addr: str = data['MAC']
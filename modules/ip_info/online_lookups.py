@@ -0,0 +1,144 @@
+import queue
+import time
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    )
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    )
+
+
+class OnlineLookups:
+    """
+    Runs the lookups of 1 slow online service (rDNS, RDAP, ip-api, etc.)
+    in a bounded pool of threads, so they don't block the main loop of
+    the module and don't delay the offline lookups.
+
+    - at most max_workers lookups of this service run at the same time
+      and at most max_pending lookups wait for a thread
+    - a key that's being looked up isn't looked up again, the callbacks
+      of all the requests for it get the result of the same lookup
+    - a key whose lookup failed or timed out isn't looked up again
+      for negative_ttl seconds
+    - a lookup that doesn't finish within timeout seconds of being
+      requested is given up on
+
+    The callbacks are called from handle_results() in the thread that
+    calls it, never from the threads of the pool.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            lookup: Callable,
+            max_workers: int = 4,
+            timeout: float = 10,
+            negative_ttl: float = 3600,
+            max_pending: int = 10000,
+    ):
+        """
+        :param lookup: the function that does the lookup, it should
+        return a falsy value if nothing was found
+        """
+        self.name = name
+        self.lookup = lookup
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        # {key: [future, deadline, callbacks]}
+        self.pending: Dict[Any, list] = {}
+        # keys whose lookup is done, filled by the threads of the pool
+        self.done = queue.SimpleQueue()
+        # {key: time when we can look it up again}
+        self.failed: Dict[Any, float] = {}
+        self.last_deadline_check = time.time()
+
+    def submit(self, key, callback: Callable, *args) -> bool:
+        """
+        looks up the given key in the background by calling
+        lookup(*args). callback(result) is called by handle_results()
+        once it's done, result is None if the lookup failed or timed out
+        returns False if the key isn't looked up because it failed
+        recently or there are too many pending lookups
+        """
+        if key in self.pending:
+            self.pending[key][2].append(callback)
+            return True
+
+        now = time.time()
+        if key in self.failed:
+            if self.failed[key] > now:
+                return False
+            del self.failed[key]
+
+        if len(self.pending) >= self.max_pending:
+            return False
+
+        future: Future = self.executor.submit(self.lookup, *args)
+        self.pending[key] = [future, now + self.timeout, [callback]]
+        future.add_done_callback(lambda _: self.done.put(key))
+        return True
+
+    def handle_results(self):
+        """
+        calls the callbacks of all the lookups that are done or timed out
+        should be called regularly from the main loop of the module
+        """
+        while True:
+            try:
+                key = self.done.get_nowait()
+            except queue.Empty:
+                break
+            if key not in self.pending:
+                # timed out before it was done
+                continue
+            future, _, _ = self.pending[key]
+            try:
+                result = future.result()
+            except Exception:
+                result = None
+            self.finish(key, result)
+
+        now = time.time()
+        if now - self.last_deadline_check < 1:
+            return
+        self.last_deadline_check = now
+        for key, (future, deadline, _) in list(self.pending.items()):
+            if now > deadline:
+                # lookups that didn't start yet are cancelled, the result
+                # of the running ones is ignored
+                future.cancel()
+                self.finish(key, None)
+
+    def finish(self, key, result):
+        callbacks: List[Callable] = self.pending.pop(key)[2]
+        if not result:
+            self.mark_as_failed(key)
+            result = None
+        for callback in callbacks:
+            callback(result)
+
+    def mark_as_failed(self, key):
+        now = time.time()
+        if len(self.failed) >= self.max_pending:
+            # forget the keys we can look up again
+            self.failed = {
+                failed_key: retry_time
+                for failed_key, retry_time in self.failed.items()
+                if retry_time > now
+            }
+        self.failed[key] = now + self.negative_ttl
+
+    def shutdown(self):
+        # the lookups that didn't start yet are cancelled. shutdown()'s
+        # cancel_futures needs python 3.9
+        for future, _, _ in self.pending.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
@@ -99,51 +99,76 @@ class Redis{
       });})
     }
 
+    /*Tuples are stored in a hash {tupleid: '[letters, timestamps]'}, rebuild the JSON string of all the tuples.*/
+    tuplesToJSON(reply){
+      if(!reply){return null;}
+      let tuples = {};
+      Object.keys(reply).forEach((tupleid)=>{tuples[tupleid] = JSON.parse(reply[tupleid]);});
+      return JSON.stringify(tuples);
+    }
+
+    /*Port and IP stats are stored in a flat hash {'80|totalflows': '1'}, rebuild the JSON string of the nested stats.*/
+    statsToJSON(reply){
+      if(!reply){return null;}
+      let stats = {};
+      Object.keys(reply).forEach((path)=>{
+        let keys = path.split('|');
+        let leaf = keys.pop();
+        let node = stats;
+        keys.forEach((key)=>{
+          if(!(key in node)){node[key] = {};}
+          node = node[key];
+        });
+        node[leaf] = leaf == 'stime' ? reply[path] : parseInt(reply[path]);
+      });
+      return JSON.stringify(stats);
+    }
+
     /*Get outtuples for specific profile and timewindow.*/
     getOutTuples(ip,timewindow){
-      return new Promise ((resolve, reject)=>{this.db.hget("profile_"+ip+"_"+timewindow,'OutTuples',(err,reply)=>{
+      return new Promise ((resolve, reject)=>{this.db.hgetall("profile_"+ip+"_"+timewindow+"_OutTuples",(err,reply)=>{
         if(err){console.log("Error in getOutTuples in kalipso_redis.js. Error: ",err); reject(err);}
-        else{resolve(reply);}
+        else{resolve(this.tuplesToJSON(reply));}
       });})
     }
 
     /*Get intuples for specific profile and timewindow*/
     getInTuples(ip,timewindow){
-      return new Promise ((resolve, reject)=>{this.db.hget("profile_"+ip+"_"+timewindow,'InTuples',(err,reply)=>{
+      return new Promise ((resolve, reject)=>{this.db.hgetall("profile_"+ip+"_"+timewindow+"_InTuples",(err,reply)=>{
         if(err){console.log("Error in getInTuples in kalipso_redis.js. Error: ",err); reject(err);}
-        else{resolve(reply);}
+        else{resolve(this.tuplesToJSON(reply));}
       });})
     }
 
     /*Get data for UDP established connections (dst/src ports/ips client/server) for specific profile and timewindow*/
     getUDPest(ip, timewindow,udp_key){
-      return new Promise ((resolve, reject)=>{this.db.hget("profile_"+ip+"_"+timewindow, udp_key,(err,reply)=>{
+      return new Promise ((resolve, reject)=>{this.db.hgetall("profile_"+ip+"_"+timewindow+"_"+udp_key,(err,reply)=>{
         if(err){console.log("Error in getUDPest in kalipso_redis.js. Error: ",err); reject(err);}
-        else{resolve(reply);}
+        else{resolve(this.statsToJSON(reply));}
       });})
     }
 
     /*Get data for TCP established (dst/src ports/IPs client/server) for specific profile and timewindow.*/
     getTCPest(ip, timewindow,tcp_key){
-      return new Promise ((resolve, reject)=>{this.db.hget("profile_"+ip+"_"+timewindow,tcp_key,(err,reply)=>{
+      return new Promise ((resolve, reject)=>{this.db.hgetall("profile_"+ip+"_"+timewindow+"_"+tcp_key,(err,reply)=>{
         if(err){console.log("Error in getTCPest in kalipso_redis.js. Error: ",err); reject(err);}
-        else{resolve(reply);}
+        else{resolve(this.statsToJSON(reply));}
       });})
     }
 
     /*Get data for UDP notestablished (dst/src ports/IPs client/server) for specific profile and timewindow*/
     getUDPnotest(ip, timewindow,udp_key){
-      return new Promise ((resolve, reject)=>{this.db.hget("profile_"+ip+"_"+timewindow, udp_key,(err,reply)=>{
+      return new Promise ((resolve, reject)=>{this.db.hgetall("profile_"+ip+"_"+timewindow+"_"+udp_key,(err,reply)=>{
         if(err){console.log("Error in getUDPnotest in kalipso_redis.js. Error: ",err); reject(err);}
-        else{resolve(reply);}
+        else{resolve(this.statsToJSON(reply));}
       });})
     }
 
     /*Get data for TCP notestablished (dst/src port/ips client/server) for specific profile and timewindow*/
     getTCPnotest(ip, timewindow,tcp_key){
-      return new Promise ((resolve, reject)=>{this.db.hget("profile_"+ip+"_"+timewindow,tcp_key,(err,reply)=>{
+      return new Promise ((resolve, reject)=>{this.db.hgetall("profile_"+ip+"_"+timewindow+"_"+tcp_key,(err,reply)=>{
         if(err){console.log("Error in getTCPnotest in kalipso_redis.js. Error: ",err); reject(err);}
-        else{resolve(reply);}
+        else{resolve(this.statsToJSON(reply));}
       });})
     }
 
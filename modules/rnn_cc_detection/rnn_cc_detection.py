@@ -1,8 +1,12 @@
 # Must imports
 import warnings
 import json
+import time
 import numpy as np
-from typing import Optional
+from collections import OrderedDict
+from typing import Optional, \
+    Dict, \
+    Tuple
 from tensorflow.python.keras.models import load_model
 
 from slips_files.common.imports import *
@@ -33,12 +37,29 @@ class CCDetection(IModule):
     description = 'Detect C&C channels based on behavioral letters'
     authors = ['Sebastian Garcia', 'Kamila Babayeva', 'Ondrej Lukas']
 
+    # Length of behavioral model with which we trained our module
+    max_length = 500
+    # max number of tuples we remember the last scored letters of
+    max_scored_tuples = 100000
+
     def init(self):
         self.c1 = self.db.subscribe('new_letters')
         self.channels = {
             'new_letters': self.c1,
         }
+        self.read_configuration()
+        # tuples waiting to be scored,
+        # {(profileid, twid, tupleid): the last new_letters msg of the tuple}
+        self.batch: Dict[Tuple[str, str, str], dict] = {}
+        self.batch_start_time = 0
+        # the letters each tuple had the last time it was scored,
+        # used to avoid scoring the same letters again
+        self.scored_letters: Dict[Tuple[str, str, str], str] = OrderedDict()
 
+    def read_configuration(self):
+        conf = ConfigParser()
+        self.batch_size: int = conf.rnn_cc_batch_size()
+        self.batch_timeout: float = conf.rnn_cc_batch_timeout()
 
     def set_evidence_cc_channel(
         self,
@@ -118,9 +139,7 @@ class CCDetection(IModule):
         The pre_behavioral_model is a 1D array of letters in an array
         """
         # TODO: set the max_length in the function call
-
-        # Length of behavioral model with which we trained our module
-        max_length = 500
+        max_length = self.max_length
 
         # Convert each of the stratosphere letters to an integer. There are 50
         vocabulary = list('abcdefghiABCDEFGHIrstuvwxyzRSTUVWXYZ1234567890,.+*')
@@ -153,6 +172,129 @@ class CCDetection(IModule):
         # self.print(f'Post Padded Seq sent: {pre_behavioral_model}. Shape: {pre_behavioral_model.shape}')
         return pre_behavioral_model
 
+    def add_tuple_to_batch(self, msg: dict):
+        """
+        adds the letters of the given tuple to the batch of tuples waiting
+        to be scored, unless they're the same letters we last scored
+        """
+        key = (msg['profileid'], msg['twid'], msg['tupleid'])
+        # the model only sees the first max_length letters
+        letters = msg['new_symbol'][:self.max_length]
+        if self.scored_letters.get(key) == letters:
+            # the score of these letters is known already
+            return
+
+        if not self.batch:
+            self.batch_start_time = time.time()
+        # if the tuple is already in the batch, its new letters replace
+        # the old ones
+        self.batch[key] = msg
+
+    def should_score_batch(self) -> bool:
+        """
+        the batch is scored when it's full or when
+        its oldest tuple waited for batch_timeout
+        """
+        if not self.batch:
+            return False
+
+        return (
+            len(self.batch) >= self.batch_size
+            or time.time() - self.batch_start_time >= self.batch_timeout
+        )
+
+    def remember_scored_letters(self, key: Tuple[str, str, str], letters):
+        self.scored_letters[key] = letters
+        self.scored_letters.move_to_end(key)
+        if len(self.scored_letters) > self.max_scored_tuples:
+            # forget the tuple that wasn't scored for the longest time
+            self.scored_letters.popitem(last=False)
+
+    def score_batch(self):
+        """
+        predicts the scores of all the tuples in the batch using 1
+        predict() call and sets evidence for the c&c channels
+        """
+        batch = self.batch
+        self.batch = {}
+        if not batch:
+            return
+
+        msgs = list(batch.values())
+        # function to convert each letter of behavioral model to ascii
+        behavioral_models = np.concatenate(
+            [
+                self.convert_input_for_module(msg['new_symbol'])
+                for msg in msgs
+            ]
+        )
+        # predict the score of behavioral model being c&c channel
+        self.print(
+            f'predicting {len(msgs)} sequences', 3, 0,
+        )
+        scores = self.tcpmodel.predict(behavioral_models)
+
+        for key, msg, score in zip(batch.keys(), msgs, scores):
+            pre_behavioral_model = msg['new_symbol']
+            self.remember_scored_letters(
+                key, pre_behavioral_model[:self.max_length]
+            )
+            self.print(
+                f' >> sequence: {pre_behavioral_model}. final prediction score: {score[0]:.20f}', 3, 0,
+            )
+            # get a float instead of numpy array
+            self.handle_score(msg, score[0])
+
+    def handle_score(self, msg: dict, score: float):
+        """
+        sets evidence for the given tuple if its score is high enough
+        :param msg: the new_letters msg of the tuple
+        """
+        pre_behavioral_model = msg['new_symbol']
+        profileid = msg['profileid']
+        twid = msg['twid']
+        tupleid = msg['tupleid']
+        flow = msg['flow']
+        # to reduce false positives
+        threshold = 0.99
+        if score > threshold:
+            threshold_confidence = 100
+            if (
+                len(pre_behavioral_model)
+                >= threshold_confidence
+            ):
+                confidence = 1
+            else:
+                confidence = (
+                    len(pre_behavioral_model)
+                    / threshold_confidence
+                )
+            uid = msg['uid']
+            stime = flow['starttime']
+            self.set_evidence_cc_channel(
+                score,
+                confidence,
+                uid,
+                stime,
+                tupleid,
+                profileid,
+                twid,
+            )
+            to_send = {
+                'attacker_type': utils.detect_data_type(flow['daddr']),
+                'profileid' : profileid,
+                'twid' : twid,
+                'flow': flow,
+            }
+            # we only check malicious jarm hashes when there's a CC
+            # detection
+            self.db.publish('check_jarm_hash', json.dumps(to_send))
+
+    def shutdown_gracefully(self):
+        # don't lose the tuples waiting in the batch
+        if hasattr(self, 'tcpmodel'):
+            self.score_batch()
+
     def pre_main(self):
         utils.drop_root_privs()
         # TODO: set the decision threshold in the function call
@@ -169,61 +311,10 @@ class CCDetection(IModule):
         if msg:= self.get_msg('new_letters'):
             msg = msg['data']
             msg = json.loads(msg)
-            pre_behavioral_model = msg['new_symbol']
-            profileid = msg['profileid']
-            twid = msg['twid']
             tupleid = msg['tupleid']
-            flow = msg['flow']
 
             if 'tcp' in tupleid.lower():
-                # to reduce false positives
-                threshold = 0.99
-                # function to convert each letter of behavioral model to ascii
-                behavioral_model = self.convert_input_for_module(
-                    pre_behavioral_model
-                )
-                # predict the score of behavioral model being c&c channel
-                self.print(
-                    f'predicting the sequence: {pre_behavioral_model}', 3, 0,
-                )
-                score = self.tcpmodel.predict(behavioral_model)
-                self.print(
-                    f' >> sequence: {pre_behavioral_model}. final prediction score: {score[0][0]:.20f}', 3, 0,
-                )
-                # get a float instead of numpy array
-                score = score[0][0]
-                if score > threshold:
-                    threshold_confidence = 100
-                    if (
-                        len(pre_behavioral_model)
-                        >= threshold_confidence
-                    ):
-                        confidence = 1
-                    else:
-                        confidence = (
-                            len(pre_behavioral_model)
-                            / threshold_confidence
-                        )
-                    uid = msg['uid']
-                    stime = flow['starttime']
-                    self.set_evidence_cc_channel(
-                        score,
-                        confidence,
-                        uid,
-                        stime,
-                        tupleid,
-                        profileid,
-                        twid,
-                    )
-                    to_send = {
-                        'attacker_type': utils.detect_data_type(flow['daddr']),
-                        'profileid' : profileid,
-                        'twid' : twid,
-                        'flow': flow,
-                    }
-                    # we only check malicious jarm hashes when there's a CC
-                    # detection
-                    self.db.publish('check_jarm_hash', json.dumps(to_send))
+                self.add_tuple_to_batch(msg)
 
             """
             elif 'udp' in tupleid.lower():
@@ -240,3 +331,6 @@ class CCDetection(IModule):
                 if score > threshold:
                     self.set_evidence(score, tupleid, profileid, twid)
             """
+
+        if self.should_score_batch():
+            self.score_batch()
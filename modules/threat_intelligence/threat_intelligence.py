@@ -11,6 +11,7 @@ from typing import Dict, \
 
 from slips_files.common.slips_utils import utils
 from slips_files.common.imports import *
+from slips_files.common.ip_range_index import IPRangeIndex
 from modules.threat_intelligence.urlhaus import URLhaus
 from slips_files.core.evidence_structure.evidence import \
     (
@@ -83,24 +84,11 @@ class ThreatIntel(IModule, URLhaus):
         Cache the IoC IP ranges instead of retrieving them from the db
         """
         ip_ranges = self.db.get_malicious_ip_ranges()
-        self.cached_ipv6_ranges = {}
-        self.cached_ipv4_ranges = {}
+        # {range: range} for finding the blacklisted range of an ip
+        # without checking every range
+        self.cached_ip_ranges = IPRangeIndex()
         for range in ip_ranges.keys():
-            if '.' in range:
-                first_octet = range.split('.')[0]
-                try:
-                    self.cached_ipv4_ranges[first_octet].append(range)
-                except KeyError:
-                    # first time seeing this octet
-                    self.cached_ipv4_ranges[first_octet] = [range]
-            else:
-                # ipv6 range
-                first_octet = range.split(':')[0]
-                try:
-                    self.cached_ipv6_ranges[first_octet].append(range)
-                except KeyError:
-                    # first time seeing this octet
-                    self.cached_ipv6_ranges[first_octet] = [range]
+            self.cached_ip_ranges.add(range, range)
 
     def __read_configuration(self):
         conf = ConfigParser()
@@ -544,49 +532,21 @@ class ThreatIntel(IModule, URLhaus):
                     )
 
         # Add all loaded malicious ips to the database
-        self.db.add_ips_to_IoC(malicious_ips)
+        self.db.add_ips_to_IoC(malicious_ips, source=data_file_name)
         # Add all loaded malicious domains to the database
-        self.db.add_domains_to_IoC(malicious_domains)
-        self.db.add_ip_range_to_IoC(malicious_ip_ranges)
+        self.db.add_domains_to_IoC(malicious_domains, source=data_file_name)
+        self.db.add_ip_range_to_IoC(
+            malicious_ip_ranges, source=data_file_name
+        )
         self.db.add_asn_to_IoC(malicious_asns)
         return True
 
-    def __delete_old_source_IPs(self, file):
-        """
-        When file is updated, delete the old IPs in the cache
-        """
-        all_data = self.db.get_IPs_in_IoC()
-        old_data = []
-        for ip_data in all_data.items():
-            ip = ip_data[0]
-            data = json.loads(ip_data[1])
-            if data['source'] == file:
-                old_data.append(ip)
-        if old_data:
-            self.db.delete_ips_from_IoC_ips(old_data)
-
-    def __delete_old_source_Domains(self, file):
-        """
-        When file is updated, delete the old Domains in the cache
-        """
-        all_data = self.db.get_Domains_in_IoC()
-        old_data = []
-        for domain_data in all_data.items():
-            domain = domain_data[0]
-            data = json.loads(domain_data[1])
-            if data['source'] == file:
-                old_data.append(domain)
-        if old_data:
-            self.db.delete_domains_from_IoC_domains(old_data)
-
     def __delete_old_source_data_from_database(self, data_file):
         """
-        Delete old IPs of the source from the database.
-        :param data_file: the name of source to delete old IPs from.
+        Delete old IPs, domains and ranges of the source from the database.
+        :param data_file: the name of source to delete old IoCs from.
         """
-        # Only read the files with .txt or .csv
-        self.__delete_old_source_IPs(data_file)
-        self.__delete_old_source_Domains(data_file)
+        self.db.delete_IoCs_of_source(data_file)
 
     def parse_ja3_file(self, path):
         """
@@ -1016,34 +976,28 @@ class ThreatIntel(IModule, URLhaus):
             self, ip, uid, daddr, timestamp, profileid, twid, ip_state
     ):
         """ check if this ip belongs to any of our blacklisted ranges"""
-        ip_obj = ipaddress.ip_address(ip)
-        # Malicious IP ranges are stored in slips sorted by the first octet
-        # so get the ranges that match the fist octet of the given IP
-        if validators.ipv4(ip):
-            first_octet = ip.split('.')[0]
-            ranges_starting_with_octet = self.cached_ipv4_ranges.get(first_octet, [])
-        elif validators.ipv6(ip):
-            first_octet = ip.split(':')[0]
-            ranges_starting_with_octet = self.cached_ipv6_ranges.get(first_octet, [])
-        else:
+        range = self.cached_ip_ranges.lookup(ip)
+        if not range:
             return False
-        
-        for range in ranges_starting_with_octet:
-            if ip_obj in ipaddress.ip_network(range):
-                # ip was found in one of the blacklisted ranges
-                ip_info = self.db.get_malicious_ip_ranges()[range]
-                ip_info = json.loads(ip_info)
-                self.set_evidence_malicious_ip(
-                    ip,
-                    uid,
-                    daddr,
-                    timestamp,
-                    ip_info,
-                    profileid,
-                    twid,
-                    ip_state,
-                )
-                return True
+
+        # ip was found in one of the blacklisted ranges
+        ip_info = self.db.get_malicious_ip_range_info(range)
+        if not ip_info:
+            # the range was deleted from the db after we cached it
+            return False
+
+        ip_info = json.loads(ip_info)
+        self.set_evidence_malicious_ip(
+            ip,
+            uid,
+            daddr,
+            timestamp,
+            ip_info,
+            profileid,
+            twid,
+            ip_state,
+        )
+        return True
 
     def search_offline_for_domain(self, domain):
         # Search for this domain in our database of IoC
@@ -1090,9 +1044,11 @@ class ThreatIntel(IModule, URLhaus):
             # not malicious
             return False
         
-        self.db.add_ips_to_IoC({
-                ip: json.dumps(ip_info)
-        })
+        # the IoC snapshot shared with the other slips instances is still
+        # valid, this IP is either in it or found online again
+        self.db.add_ips_to_IoC(
+            {ip: json.dumps(ip_info)}, update_generation=False
+        )
         if is_dns_response:
             self.set_evidence_malicious_ip_in_dns_response(
                 ip,
@@ -1340,8 +1296,13 @@ class ThreatIntel(IModule, URLhaus):
             'own_malicious_JA3.csv',
             'own_malicious_JARM.csv',
         )
-        for local_file in local_files:
-            self.update_local_file(local_file)
+        updated_files = [
+            self.update_local_file(local_file) for local_file in local_files
+        ]
+        if any(updated_files):
+            # share the IoCs of the local files with the other
+            # slips instances
+            self.db.write_IoC_snapshot()
 
         self.circllu_calls_thread.start()
         
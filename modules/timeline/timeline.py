@@ -6,6 +6,12 @@ import sys
 # Your imports
 import time
 import json
+from collections import OrderedDict
+from typing import (
+    Dict,
+    List,
+    Tuple,
+    )
 
 
 class Timeline(IModule):
@@ -13,6 +19,14 @@ class Timeline(IModule):
     name = 'Timeline'
     description = 'Creates kalipso timeline of what happened in the network based on flows and available data'
     authors = ['Sebastian Garcia']
+    # how long (in seconds) a flow waits for zeek to give us its altflow
+    # (dns, http, ssl, etc.) before it's added to the timeline without it
+    altflow_timeout = 1
+    # how often (in seconds) the altflows of the pending flows are checked
+    check_interval = 0.1
+    # max flows waiting for their altflow, when there are more, the oldest
+    # ones are added to the timeline without waiting
+    max_pending_flows = 10000
 
     def init(self):
         self.separator = self.db.get_field_separator()
@@ -25,6 +39,11 @@ class Timeline(IModule):
         conf = ConfigParser()
         self.is_human_timestamp = conf.timeline_human_timestamp()
         self.analysis_direction = conf.analysis_direction()
+        # flows waiting for their altflow. the same flow is in the
+        # timeline of its src and dst profiles when analysis_direction is all
+        # {(profileid, twid, uid): (deadline, activity, timestamp)}
+        self.pending_flows: Dict[Tuple[str, str, str], tuple] = OrderedDict()
+        self.last_check = 0
 
 
     def process_timestamp(self, timestamp: float) -> str:
@@ -36,6 +55,8 @@ class Timeline(IModule):
         """
         Process the received flow  for this profileid and twid
          so its printed by the logprocess later
+        the flow is added to the timeline once its altflow is found or
+        altflow_timeout passes, see check_pending_flows()
         """
         timestamp_human = self.process_timestamp(timestamp)
 
@@ -251,108 +272,14 @@ class Timeline(IModule):
                     'duration': dur,
                 }
             #################################
-            # Now process the alternative flows
-            # Sometimes we need to wait a little to give time to Zeek to find the related flow since they are read very fast together.
-            # This should be improved algorithmically probably
-            time.sleep(0.05)
-            alt_flow: dict = self.db.get_altflow_from_uid(
-                profileid, twid, uid
+            # Zeek may give us the related altflow of this flow after it,
+            # wait for it without blocking the rest of the flows
+            self.pending_flows[(profileid, twid, uid)] = (
+                time.time() + self.altflow_timeout,
+                activity,
+                timestamp,
             )
 
-            alt_activity = {}
-            http_data = {}
-            if alt_flow:
-                flow_type = alt_flow['type_']
-                self.print(
-                    f"Received an altflow of type {flow_type}: {alt_flow}",
-                    3, 0
-                )
-                if 'dns' in flow_type:
-                    answer = alt_flow['answers']
-                    if 'NXDOMAIN' in alt_flow['rcode_name']:
-                        answer = 'NXDOMAIN'
-                    dns_activity = {
-                        'query': alt_flow['query'],
-                        'answers': answer
-                    }
-                    alt_activity = {
-                        'info': dns_activity,
-                        'critical warning':'',
-                    }
-                elif flow_type == 'http':
-                    http_data_all = {
-                        'Request': alt_flow['method']
-                        + ' http://'
-                        + alt_flow['host']
-                        + alt_flow['uri'],
-                        'Status Code': str(alt_flow['status_code'])
-                        + '/'
-                        + alt_flow['status_msg'],
-                        'MIME': str(alt_flow['resp_mime_types']),
-                        'UA': alt_flow['user_agent'],
-                    }
-                    # if any of fields are empty, do not include them
-                    http_data = {
-                        k: v
-                        for k, v in http_data_all.items()
-                        if v != '' and v != '/'
-                    }
-                    alt_activity = {'info': http_data}
-                elif flow_type == 'ssl':
-                    if alt_flow['validation_status'] == 'ok':
-                        validation = 'Yes'
-                        resumed = 'False'
-                    elif (
-                        not alt_flow['validation_status']
-                        and alt_flow['resumed'] is True
-                    ):
-                        # If there is no validation and it is a resumed ssl.
-                        # It means that there was a previous connection with
-                        # the validation data. We can not say Say it
-                        validation = '??'
-                        resumed = 'True'
-                    else:
-                        # If the validation is not ok and not empty
-                        validation = 'No'
-                        resumed = 'False'
-                    # if there is no CN
-                    subject = alt_flow['subject'].split(',')[0] if alt_flow[
-                        'subject'] else '????'
-                    # We put server_name instead of dns resolution
-                    ssl_activity = {
-                        'server_name': subject,
-                        'trusted': validation,
-                        'resumed': resumed,
-                        'version': alt_flow['version'],
-                        'dns_resolution': alt_flow['server_name']
-                    }
-                    alt_activity = {'info': ssl_activity}
-                elif flow_type == 'ssh':
-                    success = 'Successful' if alt_flow[
-                        'auth_success'] else 'Not Successful'
-                    ssh_activity = {
-                        'login': success,
-                        'auth_attempts': alt_flow['auth_attempts'],
-                        'client': alt_flow['client'],
-                        'server': alt_flow['client'],
-                    }
-                    alt_activity = {'info': ssh_activity}
-
-            elif activity:
-                alt_activity = {'info': ''}
-
-            # Combine the activity of normal flows and activity of alternative flows and store in the DB for this profileid and twid
-            activity.update(alt_activity)
-            if activity:
-                self.db.add_timeline_line(
-                    profileid, twid, activity, timestamp
-                )
-            self.print(
-                f'Activity of Profileid: {profileid}, TWid {twid}: '
-                f'{activity}', 3, 0
-            )
-
-
         except Exception:
             exception_line = sys.exc_info()[2].tb_lineno
             self.print(
@@ -361,9 +288,182 @@ class Timeline(IModule):
             self.print(traceback.format_exc(),0,1)
             return True
 
+    def get_alt_activity(self, alt_flow, activity: dict) -> dict:
+        """
+        returns the activity of the given altflow (dns, http, ssl, ssh)
+        to add to the activity of its flow
+        :param alt_flow: the altflow of the flow or False if it has none
+        """
+        alt_activity = {}
+        http_data = {}
+        if alt_flow:
+            flow_type = alt_flow['type_']
+            self.print(
+                f"Received an altflow of type {flow_type}: {alt_flow}",
+                3, 0
+            )
+            if 'dns' in flow_type:
+                answer = alt_flow['answers']
+                if 'NXDOMAIN' in alt_flow['rcode_name']:
+                    answer = 'NXDOMAIN'
+                dns_activity = {
+                    'query': alt_flow['query'],
+                    'answers': answer
+                }
+                alt_activity = {
+                    'info': dns_activity,
+                    'critical warning':'',
+                }
+            elif flow_type == 'http':
+                http_data_all = {
+                    'Request': alt_flow['method']
+                    + ' http://'
+                    + alt_flow['host']
+                    + alt_flow['uri'],
+                    'Status Code': str(alt_flow['status_code'])
+                    + '/'
+                    + alt_flow['status_msg'],
+                    'MIME': str(alt_flow['resp_mime_types']),
+                    'UA': alt_flow['user_agent'],
+                }
+                # if any of fields are empty, do not include them
+                http_data = {
+                    k: v
+                    for k, v in http_data_all.items()
+                    if v != '' and v != '/'
+                }
+                alt_activity = {'info': http_data}
+            elif flow_type == 'ssl':
+                if alt_flow['validation_status'] == 'ok':
+                    validation = 'Yes'
+                    resumed = 'False'
+                elif (
+                    not alt_flow['validation_status']
+                    and alt_flow['resumed'] is True
+                ):
+                    # If there is no validation and it is a resumed ssl.
+                    # It means that there was a previous connection with
+                    # the validation data. We can not say Say it
+                    validation = '??'
+                    resumed = 'True'
+                else:
+                    # If the validation is not ok and not empty
+                    validation = 'No'
+                    resumed = 'False'
+                # if there is no CN
+                subject = alt_flow['subject'].split(',')[0] if alt_flow[
+                    'subject'] else '????'
+                # We put server_name instead of dns resolution
+                ssl_activity = {
+                    'server_name': subject,
+                    'trusted': validation,
+                    'resumed': resumed,
+                    'version': alt_flow['version'],
+                    'dns_resolution': alt_flow['server_name']
+                }
+                alt_activity = {'info': ssl_activity}
+            elif flow_type == 'ssh':
+                success = 'Successful' if alt_flow[
+                    'auth_success'] else 'Not Successful'
+                ssh_activity = {
+                    'login': success,
+                    'auth_attempts': alt_flow['auth_attempts'],
+                    'client': alt_flow['client'],
+                    'server': alt_flow['client'],
+                }
+                alt_activity = {'info': ssh_activity}
+
+        elif activity:
+            alt_activity = {'info': ''}
+        return alt_activity
+
+    def add_to_timeline(
+            self, profileid, twid, activity: dict, alt_flow, timestamp
+    ) -> bool:
+        """
+        Combines the activity of normal flows and activity of alternative
+        flows and stores it in the DB for this profileid and twid
+        returns True if the line was stored
+        """
+        activity.update(self.get_alt_activity(alt_flow, activity))
+        self.print(
+            f'Activity of Profileid: {profileid}, TWid {twid}: '
+            f'{activity}', 3, 0
+        )
+        if not activity:
+            return False
+        self.db.add_timeline_line(profileid, twid, activity, timestamp)
+        return True
+
+    def get_finished_flows(
+            self, flush: bool
+    ) -> List[Tuple[Tuple[str, str, str], tuple, dict]]:
+        """
+        returns the pending flows whose altflow was found, that waited
+        for it for too long, or all of them if flush is True
+        [((profileid, twid, uid), pending flow, altflow or False)]
+        """
+        uids = list({uid for _, _, uid in self.pending_flows})
+        altflows: Dict[str, dict] = self.db.get_altflows_from_uids(uids)
+        now = time.time()
+        too_many = len(self.pending_flows) - self.max_pending_flows
+        finished = []
+        # pending flows are sorted by deadline
+        for key, pending_flow in self.pending_flows.items():
+            uid = key[2]
+            deadline = pending_flow[0]
+            if (
+                    uid in altflows
+                    or flush
+                    or deadline <= now
+                    or len(finished) < too_many
+            ):
+                finished.append((key, pending_flow, altflows.get(uid, False)))
+        return finished
+
+    def check_pending_flows(self, flush=False):
+        """
+        adds the flows that are done waiting for their altflow to
+        the timeline, all in 1 batch
+        :param flush: add all of them without waiting
+        """
+        now = time.time()
+        if not self.pending_flows or (
+                not flush and now - self.last_check < self.check_interval
+        ):
+            return
+        self.last_check = now
+
+        finished = self.get_finished_flows(flush)
+        if not finished:
+            return
+
+        self.db.start_batch()
+        try:
+            for key, pending_flow, alt_flow in finished:
+                del self.pending_flows[key]
+                profileid, twid, _ = key
+                _, activity, timestamp = pending_flow
+                try:
+                    self.add_to_timeline(
+                        profileid, twid, activity, alt_flow, timestamp
+                    )
+                except Exception:
+                    exception_line = sys.exc_info()[2].tb_lineno
+                    self.print(
+                        f'Problem on add_to_timeline() line {exception_line}',
+                        0, 1
+                    )
+                    self.print(traceback.format_exc(), 0, 1)
+        finally:
+            self.db.commit_batch()
+
     def pre_main(self):
         utils.drop_root_privs()
 
+    def shutdown_gracefully(self):
+        self.check_pending_flows(flush=True)
+
     def main(self):
         # Main loop function
         if msg:= self.get_msg('new_flow'):
@@ -378,3 +478,5 @@ class Timeline(IModule):
             self.process_flow(
                 profileid, twid, flow, timestamp
             )
+
+        self.check_pending_flows()
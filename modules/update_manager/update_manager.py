@@ -692,42 +692,12 @@ class UpdateManager(IModule):
             self.print(f"Error: {e}", 0, 1)
             return False
 
-    def delete_old_source_IPs(self, file):
-        """
-        When file is updated, delete the old IPs in the cache
-        """
-        all_data = self.db.get_IPs_in_IoC()
-        old_data = []
-        for ip_data in all_data.items():
-            ip = ip_data[0]
-            data = json.loads(ip_data[1])
-            if data["source"] == file:
-                old_data.append(ip)
-        if old_data:
-            self.db.delete_ips_from_IoC_ips(old_data)
-
-    def delete_old_source_Domains(self, file):
-        """
-        When file is updated, delete the old Domains in the cache
-        """
-        all_data = self.db.get_Domains_in_IoC()
-        old_data = []
-        for domain_data in all_data.items():
-            domain = domain_data[0]
-            data = json.loads(domain_data[1])
-            if data["source"] == file:
-                old_data.append(domain)
-        if old_data:
-            self.db.delete_domains_from_IoC_domains(old_data)
-
     def delete_old_source_data_from_database(self, data_file):
         """
-        Delete old IPs of the source from the database.
-        :param data_file: the name of source to delete old IPs from.
+        Delete old IPs, domains and ranges of the source from the database.
+        :param data_file: the name of source to delete old IoCs from.
         """
-        # Only read the files with .txt or .csv
-        self.delete_old_source_IPs(data_file)
-        self.delete_old_source_Domains(data_file)
+        self.db.delete_IoCs_of_source(data_file)
 
     def parse_ja3_feed(self, url, ja3_feed_path: str) -> bool:
         """
@@ -901,7 +871,7 @@ class UpdateManager(IModule):
                         }
                     )
 
-            self.db.add_ips_to_IoC(malicious_ips_dict)
+            self.db.add_ips_to_IoC(malicious_ips_dict, source=filename)
             return True
 
         if "hole.cert.pl" in link_to_download:
@@ -933,7 +903,7 @@ class UpdateManager(IModule):
                             "tags": tags,
                         }
                     )
-            self.db.add_domains_to_IoC(malicious_domains_dict)
+            self.db.add_domains_to_IoC(malicious_domains_dict, source=filename)
             return True
 
     def get_description_column(self, header):
@@ -1085,6 +1055,9 @@ class UpdateManager(IModule):
             malicious_ips_dict = {}
             malicious_domains_dict = {}
             malicious_ip_ranges = {}
+            # the profiles of the new IPs, their threat level is set to the
+            # threat level of this feed once the feed is parsed
+            profiles_of_new_ips = []
             if "json" in ti_file_path:
                 return self.parse_json_ti_feed(link_to_download, ti_file_path)
 
@@ -1274,10 +1247,7 @@ class UpdateManager(IModule):
                             )
                             # set the score and confidence of this ip in ipsinfo
                             # and the profile of this ip to the same as the ones given in slips.conf
-                            # todo for now the confidence is 1
-                            self.db.update_threat_level(
-                                f"profile_{data}", threat_level, 1
-                            )
+                            profiles_of_new_ips.append(f"profile_{data}")
                     elif data_type == "ip_range":
                         # make sure we're not blacklisting a private or multicast ip range
                         # get network address from range
@@ -1335,9 +1305,20 @@ class UpdateManager(IModule):
                                 }
                             )
 
-            self.db.add_ips_to_IoC(malicious_ips_dict)
-            self.db.add_domains_to_IoC(malicious_domains_dict)
-            self.db.add_ip_range_to_IoC(malicious_ip_ranges)
+            data_file_name = ti_file_path.split("/")[-1]
+            self.db.add_ips_to_IoC(malicious_ips_dict, source=data_file_name)
+            self.db.add_domains_to_IoC(
+                malicious_domains_dict, source=data_file_name
+            )
+            self.db.add_ip_range_to_IoC(
+                malicious_ip_ranges, source=data_file_name
+            )
+            # todo for now the confidence is 1
+            self.db.update_threat_levels(
+                profiles_of_new_ips,
+                self.url_feeds[link_to_download]["threat_level"],
+                1,
+            )
             return True
 
         except Exception:
@@ -1529,6 +1510,8 @@ class UpdateManager(IModule):
 
             self.db.set_loaded_ti_files(self.loaded_ti_files)
             self.print_duplicate_ip_summary()
+            # share the updated IoCs with the other slips instances
+            self.db.write_IoC_snapshot()
             self.loaded_ti_files = 0
         except KeyboardInterrupt:
             return False
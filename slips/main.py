@@ -613,6 +613,11 @@ class Main(IObservable):
             # should be here after we're sure that the server was started
             redis_pid = self.redis_man.get_pid_of_redis_server(self.redis_port)
             self.redis_man.log_redis_server_pid(self.redis_port, redis_pid)
+            # and the ones the profiles are stored in, so they're closed
+            # with the main one
+            for port in self.db.get_redis_shard_ports():
+                redis_pid = self.redis_man.get_pid_of_redis_server(port)
+                self.redis_man.log_redis_server_pid(port, redis_pid)
 
             self.db.set_slips_mode(self.mode)
 
@@ -718,6 +723,8 @@ class Main(IObservable):
                 self.update_stats()
 
                 self.db.check_tw_to_close()
+                self.db.archive_closed_tws()
+                self.db.trim_streams()
 
                 modified_profiles: Set[str] = (
                     self.metadata_man.update_slips_stats_in_the_db()[1]
@@ -25,10 +25,15 @@ class IModule(IObservable, ABC, Process):
         self.redis_port = redis_port
         self.output_dir = output_dir
         self.msg_received = False
+        # True if any of the channels had a msg in the current
+        # loop of main()
+        self.msgs_received_in_loop = False
         # used to tell all slips.py children to stop
         self.termination_event: Event = termination_event
         self.logger = logger
-        self.db = DBManager(self.logger, self.output_dir, self.redis_port)
+        self.db = DBManager(
+            self.logger, self.output_dir, self.redis_port, subscriber=self.name
+        )
         IObservable.__init__(self)
         self.add_observer(self.logger)
         self.init(**kwargs)
@@ -113,6 +118,7 @@ class IModule(IObservable, ABC, Process):
         message = self.db.get_message(self.channels[channel_name])
         if utils.is_msg_intended_for(message, channel_name):
             self.msg_received = True
+            self.msgs_received_in_loop = True
             return message
         else:
             self.msg_received = False
@@ -138,12 +144,21 @@ class IModule(IObservable, ABC, Process):
             return True
 
         try:
+            # the evidence set while handling a msg are stored at once
+            # after main() returns
+            self.db.start_evidence_batch()
             while not self.should_stop():
                 # keep running main() in a loop as long as the module is
                 # online
                 # if a module's main() returns 1, it means there's an
                 # error and it needs to stop immediately
+                self.msgs_received_in_loop = False
                 error: bool = self.main()
+                self.db.commit_evidence_batch()
+                if not self.msgs_received_in_loop:
+                    # none of the channels had msgs, wait for the streams
+                    # instead of polling redis in a loop
+                    self.db.wait_for_stream_msgs()
                 if error:
                     self.shutdown_gracefully()
 
@@ -152,4 +167,7 @@ class IModule(IObservable, ABC, Process):
         except Exception:
             self.print(f'Problem in {self.name}',0, 1)
             self.print(traceback.format_exc(),  0, 1)
+        finally:
+            # the threads of the module may still set evidence
+            self.db.end_evidence_batch()
         return True
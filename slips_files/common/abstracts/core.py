@@ -35,8 +35,11 @@ class ICore(IModule, Process):
         # used to tell all slips.py children to stop
         self.termination_event: Event = termination_event
         self.redis_port = redis_port
-        self.db = DBManager(self.logger, output_dir, redis_port)
+        self.db = DBManager(
+            self.logger, output_dir, redis_port, subscriber=self.name
+        )
         self.msg_received = False
+        self.msgs_received_in_loop = False
         IObservable.__init__(self)
         self.add_observer(self.logger)
         self.init(**kwargs)
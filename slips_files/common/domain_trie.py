@@ -0,0 +1,111 @@
+from typing import (
+    Any,
+    Optional,
+    Tuple,
+    )
+
+
+class DomainTrie:
+    """
+    Suffix trie of domains. Each domain is stored label by label starting
+    from the TLD, so finding whether a domain or any of its parent domains
+    was added takes 1 dict lookup per label of the domain instead of
+    checking every added domain
+    e.g. after adding 'example.com', 'www.example.com' is found but
+    'example.com.test' and 'badexample.com' aren't
+    """
+
+    # key of the value of a domain in its node, can't be a label
+    VALUE = ""
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, domain: str) -> bool:
+        return self.lookup(domain) is not None
+
+    @staticmethod
+    def get_labels(domain: str) -> list:
+        """returns the labels of the given domain starting from the TLD"""
+        labels = [label for label in domain.lower().split(".") if label]
+        labels.reverse()
+        return labels
+
+    def add(self, domain: str, value: Any = True):
+        """
+        adds the given domain to the trie, the value is what lookup()
+        returns for this domain and its subdomains
+        """
+        labels = self.get_labels(domain)
+        if not labels:
+            return
+
+        node = self.root
+        for label in labels:
+            node = node.setdefault(label, {})
+        if self.VALUE not in node:
+            self.size += 1
+        node[self.VALUE] = value
+
+    def remove(self, domain: str) -> bool:
+        """
+        removes the given domain from the trie, its subdomains that were
+        added separately are kept
+        returns False if the domain isn't there
+        """
+        # (parent node, label) of each node in the path of this domain
+        path = []
+        node = self.root
+        for label in self.get_labels(domain):
+            if label not in node:
+                return False
+            path.append((node, label))
+            node = node[label]
+
+        if self.VALUE not in node:
+            return False
+
+        del node[self.VALUE]
+        self.size -= 1
+        # remove the nodes that aren't used by any other domain
+        for parent, label in reversed(path):
+            if parent[label]:
+                break
+            del parent[label]
+        return True
+
+    def lookup(self, domain: str) -> Optional[Any]:
+        """
+        returns the value of the given domain if it was added,
+        or the value of its closest parent domain that was added.
+        returns None if neither the domain nor its parents were added
+        """
+        if match := self.lookup_match(domain):
+            return match[1]
+        return None
+
+    def lookup_match(self, domain: str) -> Optional[Tuple[str, Any]]:
+        """
+        same as lookup() but returns a tuple with the matching domain and
+        its value
+        """
+        labels = self.get_labels(domain)
+        node = self.root
+        match = None
+        for depth, label in enumerate(labels):
+            node = node.get(label)
+            if node is None:
+                break
+            if self.VALUE in node:
+                match = (depth, node[self.VALUE])
+
+        if match is None:
+            return None
+
+        depth, value = match
+        matching_domain = ".".join(reversed(labels[: depth + 1]))
+        return matching_domain, value
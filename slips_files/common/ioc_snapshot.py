@@ -0,0 +1,237 @@
+import array
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    )
+
+
+class IoCSnapshot:
+    """
+    Read-only file with the IoCs of all the TI feeds, shared by all the
+    slips instances on the same host using mmap.
+
+    The file has 1 table per IoC type (IoC_ips, IoC_domains, etc.).
+    Each table is a sorted array of the 64-bit hashes of its IoCs, an
+    array with the offset of the record of each IoC, and the records
+    themselves (the IoC and its description). Looking up an IoC is a
+    binary search in the mapped file, nothing is copied or parsed
+    until it's found.
+
+    The snapshot is written to a temp file that replaces the old one
+    atomically, readers notice the new file and map it instead of the
+    old one.
+
+    Each snapshot has the generation of the IoCs in the db it was
+    written from, so readers can tell if the IoCs changed after that.
+    """
+
+    magic = b'SLIPSIOC'
+    version = 1
+    # magic, version, length of the json header
+    header_format = '=8sII'
+    # length of the ioc and length of its description
+    record_format = '=II'
+    # how often (in seconds) readers check whether the file was replaced
+    check_interval = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mm: Optional[mmap.mmap] = None
+        # {table: (memoryview of hashes, memoryview of record offsets)}
+        self.tables: Dict[str, tuple] = {}
+        # (inode, mtime) of the mapped file
+        self.file_id = None
+        # offset of the tables in the file
+        self.data_start = 0
+        # generation of the IoCs in the mapped file
+        self.generation: Optional[str] = None
+        self.last_check = 0
+        self.reload()
+
+    @staticmethod
+    def hash(ioc: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(ioc.encode(), digest_size=8).digest(),
+            'little'
+        )
+
+    @staticmethod
+    def align(offset: int) -> int:
+        """returns the first offset >= the given one that's 8-byte aligned"""
+        return (offset + 7) & ~7
+
+    @classmethod
+    def write(
+            cls,
+            path: str,
+            tables: Dict[str, Dict[str, str]],
+            generation: Optional[str] = None,
+    ):
+        """
+        writes the given tables to a new snapshot that atomically
+        replaces the one at the given path
+        :param tables: {table: {ioc: description}}
+        :param generation: generation of the IoCs in the given tables
+        """
+        header = {'tables': {}, 'generation': generation}
+        # all offsets are relative to the start of the data, right after
+        # the header
+        layouts = []
+        offset = 0
+        for table, iocs in tables.items():
+            entries = sorted(
+                (cls.hash(ioc), ioc, description)
+                for ioc, description in iocs.items()
+            )
+            hashes_offset = offset
+            offsets_offset = hashes_offset + 8 * len(entries)
+            records_offset = offsets_offset + 8 * len(entries)
+            records = []
+            record_offsets = array.array('Q')
+            records_len = 0
+            for _, ioc, description in entries:
+                ioc = ioc.encode()
+                description = description.encode()
+                record_offsets.append(records_offset + records_len)
+                record = struct.pack(
+                    cls.record_format, len(ioc), len(description)
+                ) + ioc + description
+                records.append(record)
+                records_len += len(record)
+
+            hashes = array.array('Q', [entry[0] for entry in entries])
+            layouts.append((hashes_offset, hashes, record_offsets, records))
+            header['tables'][table] = {
+                'count': len(entries),
+                'hashes': hashes_offset,
+                'offsets': offsets_offset,
+            }
+            offset = cls.align(records_offset + records_len)
+
+        header_json = json.dumps(header).encode()
+        data_start = cls.get_data_start(len(header_json))
+        tmp_path = f'{path}.tmp.{os.getpid()}'
+        with open(tmp_path, 'wb') as snapshot:
+            snapshot.write(
+                struct.pack(
+                    cls.header_format, cls.magic, cls.version, len(header_json)
+                )
+            )
+            snapshot.write(header_json)
+            for hashes_offset, hashes, record_offsets, records in layouts:
+                snapshot.seek(data_start + hashes_offset)
+                snapshot.write(hashes.tobytes())
+                snapshot.write(record_offsets.tobytes())
+                snapshot.write(b''.join(records))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def get_data_start(cls, header_len: int) -> int:
+        return cls.align(struct.calcsize(cls.header_format) + header_len)
+
+    def get_file_id(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def reload(self):
+        """maps the current snapshot file, if it changed"""
+        self.last_check = time.time()
+        file_id = self.get_file_id()
+        if file_id == self.file_id:
+            return
+
+        self.close()
+        self.file_id = file_id
+        if not file_id:
+            return
+
+        try:
+            with open(self.path, 'rb') as snapshot:
+                mm = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # empty or unreadable file
+            return
+
+        header_size = struct.calcsize(self.header_format)
+        magic, version, header_len = struct.unpack_from(
+            self.header_format, mm
+        )
+        if magic != self.magic or version != self.version:
+            mm.close()
+            return
+
+        header = json.loads(mm[header_size: header_size + header_len])
+        self.data_start = self.get_data_start(header_len)
+        self.generation = header.get('generation')
+        view = memoryview(mm)[self.data_start:]
+        for table, info in header['tables'].items():
+            count = info['count']
+            hashes = view[info['hashes']: info['hashes'] + 8 * count]
+            offsets = view[info['offsets']: info['offsets'] + 8 * count]
+            self.tables[table] = (hashes.cast('Q'), offsets.cast('Q'))
+        view.release()
+        self.mm = mm
+
+    def close(self):
+        for hashes, offsets in self.tables.values():
+            hashes.release()
+            offsets.release()
+        self.tables = {}
+        self.generation = None
+        if self.mm:
+            try:
+                self.mm.close()
+            except BufferError:
+                # a lookup still uses it, it's closed when it's not used
+                pass
+            self.mm = None
+
+    def is_loaded(self) -> bool:
+        if time.time() - self.last_check >= self.check_interval:
+            self.reload()
+        return self.mm is not None
+
+    def get(self, table: str, ioc: str) -> Optional[str]:
+        """
+        returns the description of the given ioc in the given table,
+        or None if it's not there
+        """
+        if not self.is_loaded() or table not in self.tables:
+            return None
+
+        hashes, offsets = self.tables[table]
+        ioc_hash = self.hash(ioc)
+        ioc = ioc.encode()
+        record_size = struct.calcsize(self.record_format)
+        i = bisect.bisect_left(hashes, ioc_hash)
+        # different iocs may have the same hash
+        while i < len(hashes) and hashes[i] == ioc_hash:
+            offset = self.data_start + offsets[i]
+            ioc_len, description_len = struct.unpack_from(
+                self.record_format, self.mm, offset
+            )
+            start = offset + record_size
+            if self.mm[start: start + ioc_len] == ioc:
+                start += ioc_len
+                return self.mm[start: start + description_len].decode()
+            i += 1
+        return None
+
+    def get_many(
+            self, table: str, iocs: Iterable[str]
+    ) -> List[Optional[str]]:
+        return [self.get(table, ioc) for ioc in iocs]
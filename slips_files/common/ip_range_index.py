@@ -0,0 +1,104 @@
+import ipaddress
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Union,
+    )
+
+
+class IPRangeIndex:
+    """
+    Longest prefix match of IPv4 and IPv6 addresses in a set of networks.
+    The networks are stored in 1 dict per prefix length, keyed by the
+    network bits as an int, so a lookup is 1 dict lookup per prefix length
+    used instead of checking every network
+    """
+
+    def __init__(self):
+        # {ip version: {prefix length: {network bits: value}}}
+        self.networks: Dict[int, Dict[int, Dict[int, Any]]] = {4: {}, 6: {}}
+        # prefix lengths used by each ip version, longest first
+        self.prefixlens: Dict[int, List[int]] = {4: [], 6: []}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, ip: str) -> bool:
+        return self.lookup(ip) is not None
+
+    @staticmethod
+    def get_network_bits(
+        ip: Union[ipaddress.IPv4Address, ipaddress.IPv6Address],
+        prefixlen: int,
+    ) -> int:
+        return int(ip) >> (ip.max_prefixlen - prefixlen)
+
+    def add(self, network: str, value: Any = True) -> bool:
+        """
+        adds the given network to the index, the value is what lookup()
+        returns for the ips in this network
+        :param network: a CIDR like 1.2.3.0/24 or a single ip
+        returns False if the given network is invalid
+        """
+        try:
+            network = ipaddress.ip_network(network, strict=False)
+        except ValueError:
+            return False
+
+        prefixlen = network.prefixlen
+        networks: dict = self.networks[network.version]
+        if prefixlen not in networks:
+            networks[prefixlen] = {}
+            self.prefixlens[network.version] = sorted(networks, reverse=True)
+
+        key = self.get_network_bits(network.network_address, prefixlen)
+        if key not in networks[prefixlen]:
+            self.size += 1
+        networks[prefixlen][key] = value
+        return True
+
+    def remove(self, network: str) -> bool:
+        """
+        removes the given network from the index
+        returns False if the network isn't there
+        """
+        try:
+            network = ipaddress.ip_network(network, strict=False)
+        except ValueError:
+            return False
+
+        networks: dict = self.networks[network.version]
+        prefixlen = network.prefixlen
+        key = self.get_network_bits(network.network_address, prefixlen)
+        try:
+            del networks[prefixlen][key]
+        except KeyError:
+            return False
+
+        self.size -= 1
+        if not networks[prefixlen]:
+            del networks[prefixlen]
+            self.prefixlens[network.version] = sorted(networks, reverse=True)
+        return True
+
+    def lookup(self, ip: str) -> Optional[Any]:
+        """
+        returns the value of the most specific network the given ip
+        belongs to, or None if it doesn't belong to any
+        """
+        try:
+            ip = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        networks: dict = self.networks[ip.version]
+        for prefixlen in self.prefixlens[ip.version]:
+            key = self.get_network_bits(ip, prefixlen)
+            try:
+                return networks[prefixlen][key]
+            except KeyError:
+                continue
+        return None
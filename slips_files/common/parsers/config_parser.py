@@ -490,6 +490,92 @@ class ConfigParser(object):
             'flowmldetection', 'mode', 'test'
         )
 
+    def get_ml_batch_size(self) -> int:
+        """
+        returns the number of flows the flowmldetection module
+        detects at once in test mode
+        """
+        batch_size = self.read_configuration(
+            'flowmldetection', 'batch_size', 1
+        )
+        try:
+            batch_size = int(batch_size)
+        except ValueError:
+            batch_size = 1
+        return max(batch_size, 1)
+
+    def get_ml_batch_timeout(self) -> float:
+        """
+        returns the max time (in seconds) a flow waits in the
+        flowmldetection batch before being detected
+        """
+        # 500 is in ms
+        timeout = self.read_configuration(
+            'flowmldetection', 'batch_timeout', 500
+        )
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            timeout = 500
+        return timeout / 1000
+
+    def get_ml_training_chunk_size(self) -> int:
+        """
+        returns the number of flows the flowmldetection module
+        trains on at once in train mode
+        """
+        chunk_size = self.read_configuration(
+            'flowmldetection', 'training_chunk_size', 10000
+        )
+        try:
+            chunk_size = int(chunk_size)
+        except ValueError:
+            chunk_size = 10000
+        return max(chunk_size, 1)
+
+    def get_ml_training_checkpoint_chunks(self) -> int:
+        """
+        returns the number of chunks trained on before storing the model
+        on disk. 0 means the model is stored after training on all chunks
+        """
+        checkpoint_chunks = self.read_configuration(
+            'flowmldetection', 'training_checkpoint_chunks', 10
+        )
+        try:
+            checkpoint_chunks = int(checkpoint_chunks)
+        except ValueError:
+            checkpoint_chunks = 10
+        return max(checkpoint_chunks, 0)
+
+    def rnn_cc_batch_size(self) -> int:
+        """
+        returns the number of tuples the rnnccdetection module
+        scores at once
+        """
+        batch_size = self.read_configuration(
+            'rnnccdetection', 'batch_size', 100
+        )
+        try:
+            batch_size = int(batch_size)
+        except ValueError:
+            batch_size = 100
+        return max(batch_size, 1)
+
+    def rnn_cc_batch_timeout(self) -> float:
+        """
+        returns the max time (in seconds) a tuple waits in the
+        rnnccdetection batch before being scored
+        """
+        # 100 is in ms
+        timeout = self.read_configuration(
+            'rnnccdetection', 'batch_timeout', 100
+        )
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            timeout = 100
+        return timeout / 1000
+
     def RiskIQ_credentials_path(self):
         return self.read_configuration(
             'threatintelligence', 'RiskIQ_credentials_path', ''
@@ -502,6 +588,13 @@ class ConfigParser(object):
             'modules/threat_intelligence/local_data_files/'
         )
 
+    def ioc_snapshot_path(self) -> str:
+        return self.read_configuration(
+            'threatintelligence',
+            'ioc_snapshot_path',
+            'databases/ioc_snapshot.bin'
+        ).strip()
+
     def wait_for_TI_to_finish(self) -> bool:
         wait = self.read_configuration(
             'threatintelligence',
@@ -603,6 +696,59 @@ class ConfigParser(object):
         )
         return delete != 'False'
 
+    def redis_shard_ports(self) -> List[int]:
+        """
+        returns the ports of the redis servers the profiles are stored in,
+        [] if they're stored in the main redis server
+        """
+        ports: str = self.read_configuration(
+             'parameters', 'redis_shard_ports', '[]'
+        )
+        ports: str = utils.sanitize(ports)
+        shard_ports = []
+        for port in ports.replace('[', '').replace(']', '').split(','):
+            port = port.strip().strip("'")
+            try:
+                shard_ports.append(int(port))
+            except ValueError:
+                continue
+        return shard_ports
+
+    def redis_streams_channels(self) -> List[str]:
+        """
+        returns the channels whose msgs are sent using redis streams
+        """
+        channels: str = self.read_configuration(
+             'parameters', 'redis_streams_channels', '[]'
+        )
+        channels: str = utils.sanitize(channels)
+        channels: List[str] = [
+            channel.strip().strip("'").strip('"')
+            for channel in channels.replace('[', '').replace(']', '').split(',')
+        ]
+        return [channel for channel in channels if channel]
+
+    def redis_streams_batch_size(self) -> int:
+        batch_size = self.read_configuration(
+             'parameters', 'redis_streams_batch_size', 100
+        )
+        try:
+            batch_size = int(batch_size)
+        except ValueError:
+            batch_size = 100
+        return max(batch_size, 1)
+
+    def redis_streams_block_time(self) -> float:
+        block_time = self.read_configuration(
+             'parameters', 'redis_streams_block_time', 0.1
+        )
+        try:
+            block_time = float(block_time)
+        except ValueError:
+            block_time = 0.1
+        # redis blocks forever if it's 0
+        return max(block_time, 0.001)
+
     def rotation_period(self):
         rotation_period = self.read_configuration(
              'parameters', 'rotation_period', '1 day'
@@ -675,6 +821,102 @@ class ConfigParser(object):
              'parameters', 'label', 'unknown'
         )
 
+    def dns_resolutions_ttl(self) -> float:
+        """
+        returns how long (in seconds) a dns resolution that isn't seen
+        again is kept in the db. 0 means forever
+        """
+        ttl = self.read_configuration(
+            'parameters', 'dns_resolutions_ttl', 172800
+        )
+        try:
+            ttl = float(ttl)
+        except ValueError:
+            ttl = 172800
+        return max(ttl, 0)
+
+    def max_dns_resolutions(self) -> int:
+        """
+        returns the max number of resolved ips and domains kept in the db
+        """
+        max_resolutions = self.read_configuration(
+            'parameters', 'max_dns_resolutions', 1000000
+        )
+        try:
+            max_resolutions = int(max_resolutions)
+        except ValueError:
+            max_resolutions = 1000000
+        return max(max_resolutions, 1)
+
+    def archive_closed_tws_after(self) -> float:
+        """
+        returns how long (in seconds) the data of a closed tw is kept in
+        redis before it's archived. -1 means it's never archived
+        """
+        archive_after = self.read_configuration(
+            'parameters', 'archive_closed_tws_after', -1
+        )
+        try:
+            archive_after = float(archive_after)
+        except ValueError:
+            archive_after = -1
+        return archive_after if archive_after >= 0 else -1
+
+    def profiler_batch_size(self) -> int:
+        """
+        returns the number of flows the profiler stores in the db at once
+        """
+        batch_size = self.read_configuration(
+             'parameters', 'profiler_batch_size', 1
+        )
+        try:
+            batch_size = int(batch_size)
+        except ValueError:
+            batch_size = 1
+        return max(batch_size, 1)
+
+    def profiler_batch_timeout(self) -> float:
+        """
+        returns the max time (in seconds) a flow waits in the profiler's
+        batch before being stored in the db
+        """
+        # 500 is in ms
+        timeout = self.read_configuration(
+             'parameters', 'profiler_batch_timeout', 500
+        )
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            timeout = 500
+        return timeout / 1000
+
+    def evidence_batch_size(self) -> int:
+        """
+        returns the number of evidence a module stores in the db at once,
+        and the number of evidence the evidence handler reads at once
+        """
+        batch_size = self.read_configuration(
+             'parameters', 'evidence_batch_size', 1
+        )
+        try:
+            batch_size = int(batch_size)
+        except ValueError:
+            batch_size = 1
+        return max(batch_size, 1)
+
+    def profiler_workers(self) -> int:
+        """
+        returns the number of processes used for profiling the flows
+        """
+        workers = self.read_configuration(
+             'parameters', 'profiler_workers', 1
+        )
+        try:
+            workers = int(workers)
+        except ValueError:
+            workers = 1
+        return max(workers, 1)
+
     def get_UID(self):
         return int(self.read_configuration(
              'Docker', 'UID', 0
@@ -0,0 +1,197 @@
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+from typing import (
+    List,
+    Optional,
+    )
+
+
+class SharedRingBuffer:
+    """
+    Ring buffer of variable length records in shared memory, used to pass
+    data from 1 producer process to 1 consumer process without pickling
+    it or copying it through a pipe.
+
+    Each record is stored as its length followed by its bytes. A record
+    that doesn't fit at the end of the buffer is written at its start, and
+    the rest of the buffer is skipped by the consumer.
+
+    The position of the producer (tail) and of the consumer (head) are
+    stored in the shared memory and only grow, each one is written by 1
+    process only. The producer blocks when the buffer is full until the
+    consumer reads enough records, the timeout is reached or it's told to
+    stop, and the consumer blocks when the buffer is empty until the
+    producer writes a record or the timeout is reached.
+    """
+
+    position_format = '<Q'
+    length_format = '<I'
+    # written instead of a length when the rest of the buffer is skipped
+    wrap_marker = 0xFFFFFFFF
+    # the positions are in different cache lines
+    head_offset = 0
+    tail_offset = 64
+    header_size = 128
+    # how often the producer checks the buffer again while it's full, in
+    # case the consumer freed space without it noticing
+    check_interval = 0.1
+
+    def __init__(self, size: int = 32 * 1024 * 1024):
+        self.size = size
+        self.length_size = struct.calcsize(self.length_format)
+        # records bigger than this would make the producer wait for an
+        # almost empty buffer
+        self.max_record_size = size // 4
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.header_size + size
+        )
+        self.buf = self.shm.buf
+        self.set_position(self.head_offset, 0)
+        self.set_position(self.tail_offset, 0)
+        # set by the producer when it writes to an empty buffer
+        self.not_empty = multiprocessing.Event()
+        # set by the consumer when it frees space
+        self.not_full = multiprocessing.Event()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['shm'], state['buf']
+        state['shm_name'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('shm_name')
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.buf = self.shm.buf
+
+    def get_position(self, offset: int) -> int:
+        return struct.unpack_from(self.position_format, self.buf, offset)[0]
+
+    def set_position(self, offset: int, position: int):
+        struct.pack_into(self.position_format, self.buf, offset, position)
+
+    def put_record(
+            self,
+            record: bytes,
+            timeout: Optional[float] = None,
+            stop: Optional[multiprocessing.Event] = None,
+    ) -> bool:
+        """
+        writes the given record to the buffer, waits for the consumer
+        if the buffer is full
+        :param timeout: how long to wait for the consumer, waits
+        forever if it's None
+        :param stop: event that makes the producer stop waiting when it's
+        set, e.g. the consumer stopped and will never free space
+        returns False if the record wasn't written
+        """
+        needed = self.length_size + len(record)
+        if needed > self.max_record_size:
+            raise ValueError(
+                f'Record of {len(record)} bytes is too big for the buffer'
+            )
+
+        old_tail = tail = self.get_position(self.tail_offset)
+        offset = tail % self.size
+        room_at_end = self.size - offset
+        # the record is written at the start if it doesn't fit at the end
+        total = needed if needed <= room_at_end else room_at_end + needed
+        deadline = None if timeout is None else time.time() + timeout
+        while self.size - (tail - self.get_position(self.head_offset)) < total:
+            self.not_full.clear()
+            # the consumer may have freed space before we cleared it
+            if (
+                self.size - (tail - self.get_position(self.head_offset))
+                >= total
+            ):
+                break
+            if stop is not None and stop.is_set():
+                return False
+
+            wait = self.check_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return False
+            self.not_full.wait(wait)
+
+        if needed > room_at_end:
+            if room_at_end >= self.length_size:
+                struct.pack_into(
+                    self.length_format, self.buf,
+                    self.header_size + offset, self.wrap_marker
+                )
+            tail += room_at_end
+            offset = 0
+
+        start = self.header_size + offset
+        struct.pack_into(self.length_format, self.buf, start, len(record))
+        start += self.length_size
+        self.buf[start: start + len(record)] = record
+        self.set_position(self.tail_offset, tail + needed)
+
+        # the head is read after the tail is written, if the consumer read
+        # everything before this record, it may be waiting for it
+        if self.get_position(self.head_offset) == old_tail:
+            self.not_empty.set()
+        return True
+
+    def get_records(
+            self, max_records: int = 1000, timeout: float = 1
+    ) -> List[bytes]:
+        """
+        returns up to max_records records from the buffer, waits up to
+        timeout seconds if it's empty
+        returns [] if there are no records
+        """
+        head = self.get_position(self.head_offset)
+        tail = self.get_position(self.tail_offset)
+        if head == tail:
+            self.not_empty.clear()
+            # the producer may have written before we cleared it
+            tail = self.get_position(self.tail_offset)
+            if head == tail:
+                self.not_empty.wait(timeout)
+                tail = self.get_position(self.tail_offset)
+                if head == tail:
+                    return []
+
+        records = []
+        while head < tail and len(records) < max_records:
+            offset = head % self.size
+            room_at_end = self.size - offset
+            if room_at_end < self.length_size:
+                head += room_at_end
+                continue
+
+            start = self.header_size + offset
+            length = struct.unpack_from(self.length_format, self.buf, start)[0]
+            if length == self.wrap_marker:
+                head += room_at_end
+                continue
+
+            start += self.length_size
+            records.append(bytes(self.buf[start: start + length]))
+            head += self.length_size + length
+
+        self.set_position(self.head_offset, head)
+        self.not_full.set()
+        return records
+
+    def close(self):
+        """closes the buffer in the current process"""
+        self.buf.release()
+        self.shm.close()
+
+    def unlink(self):
+        """
+        frees the shared memory, should be called once by the process
+        that created the buffer after all the processes closed it
+        """
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -20,9 +20,13 @@ class DBManager(IObservable):
             redis_port,
             start_sqlite=True,
             start_redis_server=True,
+            subscriber='slips',
             **kwargs
     ):
         self.output_dir = output_dir
+        # name of the module using this db, used to read the msgs
+        # sent using redis streams
+        self.subscriber = subscriber
         self.redis_port = redis_port
         self.logger = logger
         IObservable.__init__(self)
@@ -54,6 +58,9 @@ class DBManager(IObservable):
     def iterate_flows(self, *args, **kwargs):
         return self.sqlite.iterate_flows(*args, **kwargs)
 
+    def iterate_flows_in_chunks(self, *args, **kwargs):
+        return self.sqlite.iterate_flows_in_chunks(*args, **kwargs)
+
 
     def get_columns(self, *args, **kwargs):
         return self.sqlite.get_columns(*args, **kwargs)
@@ -62,14 +69,39 @@ class DBManager(IObservable):
         return self.rdb.publish(*args, **kwargs)
 
     def subscribe(self, *args, **kwargs):
+        kwargs.setdefault('subscriber', self.subscriber)
         return self.rdb.subscribe(*args, **kwargs)
 
+    def trim_streams(self, *args, **kwargs):
+        return self.rdb.trim_streams(*args, **kwargs)
+
+    def get_streams_backlog(self, *args, **kwargs):
+        return self.rdb.get_streams_backlog(*args, **kwargs)
+
+    def start_batch(self, *args, **kwargs):
+        if self.sqlite:
+            self.sqlite.start_batch()
+        return self.rdb.start_batch(*args, **kwargs)
+
+    def commit_batch(self, *args, **kwargs):
+        # the flows are written to sqlite before the msgs about them
+        # are sent by redis
+        if self.sqlite:
+            self.sqlite.commit_batch()
+        return self.rdb.commit_batch(*args, **kwargs)
+
+    def is_batching(self, *args, **kwargs):
+        return self.rdb.is_batching(*args, **kwargs)
+
     def publish_stop(self, *args, **kwargs):
         return self.rdb.publish_stop(*args, **kwargs)
 
     def get_message(self, *args, **kwargs):
         return self.rdb.get_message(*args, **kwargs)
 
+    def wait_for_stream_msgs(self):
+        return self.rdb.wait_for_stream_msgs(self.subscriber)
+
     def print(self, *args, **kwargs):
         return self.rdb.print(*args, **kwargs)
 
@@ -386,6 +418,15 @@ class DBManager(IObservable):
     def set_evidence(self, *args, **kwargs):
         return self.rdb.set_evidence(*args, **kwargs)
 
+    def start_evidence_batch(self, *args, **kwargs):
+        return self.rdb.start_evidence_batch(*args, **kwargs)
+
+    def commit_evidence_batch(self, *args, **kwargs):
+        return self.rdb.commit_evidence_batch(*args, **kwargs)
+
+    def end_evidence_batch(self, *args, **kwargs):
+        return self.rdb.end_evidence_batch(*args, **kwargs)
+
     def get_user_agents_count(self, *args, **kwargs):
         return self.rdb.get_user_agents_count(*args, **kwargs)
 
@@ -415,14 +456,20 @@ class DBManager(IObservable):
         return self.rdb.remove_whitelisted_evidence(*args, **kwargs)
 
     def get_profileid_twid_alerts(self, *args, **kwargs):
-        return self.rdb.get_profileid_twid_alerts(*args, **kwargs)
+        return self.read_tw(self.rdb.get_profileid_twid_alerts, *args, **kwargs)
 
     def get_twid_evidence(self, *args, **kwargs):
-        return self.rdb.get_twid_evidence(*args, **kwargs)
+        return self.read_tw(self.rdb.get_twid_evidence, *args, **kwargs)
 
     def update_threat_level(self, *args, **kwargs):
         return self.rdb.update_threat_level(*args, **kwargs)
 
+    def update_threat_levels(self, *args, **kwargs):
+        return self.rdb.update_threat_levels(*args, **kwargs)
+
+    def update_profiles_threat_levels(self, *args, **kwargs):
+        return self.rdb.update_profiles_threat_levels(*args, **kwargs)
+
     def set_loaded_ti_files(self, *args, **kwargs):
         return self.rdb.set_loaded_ti_files(*args, **kwargs)
 
@@ -474,9 +521,15 @@ class DBManager(IObservable):
     def add_ssl_sha1_to_IoC(self, *args, **kwargs):
         return self.rdb.add_ssl_sha1_to_IoC(*args, **kwargs)
 
+    def write_IoC_snapshot(self, *args, **kwargs):
+        return self.rdb.write_IoC_snapshot(*args, **kwargs)
+
     def get_malicious_ip_ranges(self, *args, **kwargs):
         return self.rdb.get_malicious_ip_ranges(*args, **kwargs)
 
+    def get_malicious_ip_range_info(self, *args, **kwargs):
+        return self.rdb.get_malicious_ip_range_info(*args, **kwargs)
+
     def get_IPs_in_IoC(self, *args, **kwargs):
         return self.rdb.get_IPs_in_IoC(*args, **kwargs)
 
@@ -513,6 +566,9 @@ class DBManager(IObservable):
     def delete_feed(self, *args, **kwargs):
         return self.rdb.delete_feed(*args, **kwargs)
 
+    def delete_IoCs_of_source(self, *args, **kwargs):
+        return self.rdb.delete_IoCs_of_source(*args, **kwargs)
+
     def is_profile_malicious(self, *args, **kwargs):
         return self.rdb.is_profile_malicious(*args, **kwargs)
 
@@ -547,13 +603,13 @@ class DBManager(IObservable):
         return self.rdb.set_info_for_urls(*args, **kwargs)
 
     def get_data_from_profile_tw(self, *args, **kwargs):
-        return self.rdb.get_data_from_profile_tw(*args, **kwargs)
+        return self.read_tw(self.rdb.get_data_from_profile_tw, *args, **kwargs)
 
     def get_outtuples_from_profile_tw(self, *args, **kwargs):
-        return self.rdb.get_outtuples_from_profile_tw(*args, **kwargs)
+        return self.read_tw(self.rdb.get_outtuples_from_profile_tw, *args, **kwargs)
 
     def get_intuples_from_profile_tw(self, *args, **kwargs):
-        return self.rdb.get_intuples_from_profile_tw(*args, **kwargs)
+        return self.read_tw(self.rdb.get_intuples_from_profile_tw, *args, **kwargs)
 
     def get_dhcp_flows(self, *args, **kwargs):
         return self.rdb.get_dhcp_flows(*args, **kwargs)
@@ -582,6 +638,9 @@ class DBManager(IObservable):
     def get_altflow_from_uid(self, *args, **kwargs):
         return self.sqlite.get_altflow_from_uid(*args, **kwargs)
 
+    def get_altflows_from_uids(self, *args, **kwargs):
+        return self.sqlite.get_altflows_from_uids(*args, **kwargs)
+
     def get_all_flows_in_profileid_twid(self, *args, **kwargs):
         return self.sqlite.get_all_flows_in_profileid_twid(*args, **kwargs)
 
@@ -591,6 +650,9 @@ class DBManager(IObservable):
     def get_all_flows(self, *args, **kwargs):
         return self.sqlite.get_all_flows(*args, **kwargs)
 
+    def get_sent_bytes_per_daddr(self, *args, **kwargs):
+        return self.sqlite.get_sent_bytes_per_daddr(*args, **kwargs)
+
     def get_all_contacted_ips_in_profileid_twid(self, *args, **kwargs):
         """
         Get all the contacted IPs in a given profile and TW
@@ -630,6 +692,9 @@ class DBManager(IObservable):
     def get_profileid_from_ip(self, *args, **kwargs):
         return self.rdb.get_profileid_from_ip(*args, **kwargs)
 
+    def set_first_flow_time(self, *args, **kwargs):
+        return self.rdb.set_first_flow_time(*args, **kwargs)
+
     def get_first_flow_time(self, *args, **kwargs):
         return self.rdb.get_first_flow_time(*args, **kwargs)
 
@@ -643,10 +708,10 @@ class DBManager(IObservable):
         return self.rdb.get_number_of_tws_in_profile(*args, **kwargs)
 
     def get_srcips_from_profile_tw(self, *args, **kwargs):
-        return self.rdb.get_srcips_from_profile_tw(*args, **kwargs)
+        return self.read_tw(self.rdb.get_srcips_from_profile_tw, *args, **kwargs)
 
     def get_dstips_from_profile_tw(self, *args, **kwargs):
-        return self.rdb.get_dstips_from_profile_tw(*args, **kwargs)
+        return self.read_tw(self.rdb.get_dstips_from_profile_tw, *args, **kwargs)
 
     def get_t2_for_profile_tw(self, *args, **kwargs):
         return self.rdb.get_t2_for_profile_tw(*args, **kwargs)
@@ -717,6 +782,53 @@ class DBManager(IObservable):
     def check_tw_to_close(self, *args, **kwargs):
         return self.rdb.check_tw_to_close(*args, **kwargs)
 
+    def archive_closed_tws(self):
+        """
+        moves the data of the tws that were closed more than
+        archive_closed_tws_after seconds ago from redis to sqlite
+        """
+        if not self.sqlite:
+            return
+        tws: List[str] = self.rdb.get_tws_to_archive()
+        if not tws:
+            return
+
+        def store(profileid_twid: str, data: dict) -> bool:
+            if self.rdb.is_tw_archived(profileid_twid):
+                # got new flows after it was archived
+                data = self.rdb.merge_exported(
+                    self.sqlite.get_archived_tw(profileid_twid), data
+                )
+            return self.sqlite.archive_tw(profileid_twid, data)
+
+        keys: dict = self.rdb.get_keys_of_tws(tws)
+        for profileid_twid in tws:
+            self.rdb.archive_tw(profileid_twid, keys[profileid_twid], store)
+
+    def restore_archived_tw(self, profileid: str, twid: str) -> bool:
+        """
+        moves the data of the given tw back from sqlite to redis if it
+        was archived
+        returns False if it wasn't archived or couldn't be restored
+        """
+        profileid_twid = f'{profileid}{self.rdb.separator}{twid}'
+        if not self.sqlite or not self.rdb.is_tw_archived(profileid_twid):
+            return False
+        return self.rdb.restore_tw(
+            profileid_twid, self.sqlite.get_archived_tw(profileid_twid)
+        )
+
+    def read_tw(self, read, profileid, twid, *args, **kwargs):
+        """
+        calls read(profileid, twid, ...) to read the data of the given tw,
+        restoring it from the archive first if it was archived.
+        a tw that got new data after being archived has only part of its
+        data in redis, so it's restored whether redis has data or not
+        """
+        if self.rdb.is_tw_archiving_enabled():
+            self.restore_archived_tw(profileid, twid)
+        return read(profileid, twid, *args, **kwargs)
+
     def check_health(self):
         self.rdb.pubsub.check_health()
 
@@ -879,6 +991,9 @@ class DBManager(IObservable):
     def get_redis_pid(self, *args, **kwargs):
         return self.rdb.get_redis_pid(*args, **kwargs)
 
+    def get_redis_shard_ports(self, *args, **kwargs):
+        return self.rdb.get_redis_shard_ports(*args, **kwargs)
+
     def increment_attack_counter(self, *args, **kwargs):
         return self.rdb.increment_attack_counter(*args, **kwargs)
 
@@ -1,5 +1,6 @@
 import time
 import json
+import threading
 from typing import List, Tuple, Optional, Dict
 
 from slips_files.common.slips_utils import utils
@@ -18,6 +19,9 @@ class AlertHandler:
     Contains all the logic related to setting and retrieving evidence and alerts in the db
     """
     name = 'DB'
+    # when batching evidence, the evidence set are buffered in memory
+    # and stored at once in commit_evidence_batch()
+    batching_evidence = False
 
     def increment_attack_counter(
             self,
@@ -121,6 +125,46 @@ class AlertHandler:
         # the victim is the whole network
         return ''
 
+    def start_evidence_batch(self):
+        """
+        Starts buffering the evidence set by this process in memory
+        instead of storing each one of them when it's set.
+        the buffered evidence are stored at once when commit_evidence_batch()
+        is called or when evidence_batch_size evidence are buffered.
+        used by the modules, they commit the batch after each main() call
+        """
+        self.pending_evidence: List[Evidence] = []
+        # the evidence can be set by the threads of a module too
+        self.evidence_lock = threading.Lock()
+        self.batching_evidence = True
+
+    def commit_evidence_batch(self):
+        """stores all the buffered evidence"""
+        if not self.batching_evidence or not self.pending_evidence:
+            return
+
+        with self.evidence_lock:
+            evidence_batch = self.pending_evidence
+            self.pending_evidence = []
+            self.store_evidence(evidence_batch)
+
+    def end_evidence_batch(self):
+        """
+        stores the buffered evidence, the evidence set after this are
+        stored right away. e.g. by the threads of a module that stopped
+        """
+        if not self.batching_evidence:
+            return
+
+        # clearing the flag and draining the batch under the lock makes
+        # sure no evidence is appended to a batch that won't be stored
+        with self.evidence_lock:
+            self.batching_evidence = False
+            evidence_batch = self.pending_evidence
+            self.pending_evidence = []
+            if evidence_batch:
+                self.store_evidence(evidence_batch)
+
     def set_evidence(self, evidence: Evidence):
         """
         Set the evidence for this Profile and Timewindow.
@@ -128,52 +172,108 @@ class AlertHandler:
         slips_files/core/evidence_structure/evidence.py) with all the
         evidence details,
         """
+        if not self.batching_evidence:
+            self.store_evidence([evidence])
+        else:
+            with self.evidence_lock:
+                # the batch may have ended while waiting for the lock
+                if not self.batching_evidence:
+                    self.store_evidence([evidence])
+                else:
+                    self.pending_evidence.append(evidence)
+                    if (
+                        len(self.pending_evidence)
+                        >= self.evidence_batch_size
+                    ):
+                        evidence_batch = self.pending_evidence
+                        self.pending_evidence = []
+                        self.store_evidence(evidence_batch)
+
+        # disabled evidence are ignored when storing them
+        return not self.is_detection_disabled(evidence.evidence_type)
+
+    def add_profiles_of_evidence(self, evidence_batch: List[Evidence]):
+        """
+        creates the profiles of the given evidence that don't exist
+        """
+        # {profileid: timestamp of its first evidence}
+        profiles: Dict[str, str] = {}
+        for evidence in evidence_batch:
+            profiles.setdefault(str(evidence.profile), evidence.timestamp)
+
+        pipe = self.r.pipeline(transaction=False)
+        for profileid in profiles:
+            pipe.sismember('profiles', profileid)
+        exist: List[bool] = pipe.execute()
+
+        for (profileid, timestamp), profile_exists in zip(
+                profiles.items(), exist
+        ):
+            if not profile_exists:
+                self.add_profile(profileid, timestamp, self.width)
 
-        # create the profile if it doesn't exist
-        self.add_profile(
-            str(evidence.profile),
-            evidence.timestamp,
-            self.width
-            )
+    def store_evidence(self, evidence_batch: List[Evidence]):
+        """
+        Stores the given evidence, notifies the evidence handler about the
+        new ones, and updates the threat levels of their attackers.
+        All the evidence are written using 2 redis pipelines
+        """
+        # create the profiles if they don't exist
+        self.add_profiles_of_evidence(evidence_batch)
 
         # Ignore evidence if it's disabled in the configuration file
-        if self.is_detection_disabled(evidence.evidence_type):
-            return False
-
-        self.set_flow_causing_evidence(evidence.uid, evidence.id)
-
-        evidence_to_send: dict = evidence_to_dict(evidence)
-        evidence_to_send: str = json.dumps(evidence_to_send)
-
-        # Check if we have the current evidence stored in the DB for
-        # this profileid in this twid
-
-        # This is done to ignore repetition of the same evidence sent.
-        evidence_exists: Optional[dict] = self.r.hget(
-            f'{evidence.profile}_{evidence.timewindow}_evidence',
-            evidence.id
+        evidence_batch = [
+            evidence for evidence in evidence_batch
+            if not self.is_detection_disabled(evidence.evidence_type)
+        ]
+        if not evidence_batch:
+            return
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset(
+            'flows_causing_evidence',
+            mapping={
+                evidence.id: json.dumps(evidence.uid)
+                for evidence in evidence_batch
+            }
         )
-
-        # note that publishing HAS TO be done after adding the evidence
-        # to the db
-        if not evidence_exists:
-            self.r.hset(
+        serialized_evidence: List[str] = []
+        for evidence in evidence_batch:
+            evidence_to_send: dict = evidence_to_dict(evidence)
+            evidence_to_send: str = json.dumps(evidence_to_send)
+            serialized_evidence.append(evidence_to_send)
+            # the evidence is only set if it's not in the db already.
+            # This is done to ignore repetition of the same evidence sent.
+            pipe.hsetnx(
                 f'{evidence.profile}_{evidence.timewindow}_evidence',
                 evidence.id,
                 evidence_to_send
             )
-            self.r.incr('number_of_evidence', 1)
-            self.publish('evidence_added', evidence_to_send)
+        # the first result is the one of the hset
+        added: List[bool] = pipe.execute()[1:]
+
+        # note that publishing HAS TO be done after adding the evidence
+        # to the db
+        new_evidence: List[str] = [
+            evidence_to_send
+            for evidence_to_send, is_new in zip(serialized_evidence, added)
+            if is_new
+        ]
+        if new_evidence:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.incr('number_of_evidence', len(new_evidence))
+            for evidence_to_send in new_evidence:
+                self.send_msg(pipe, 'evidence_added', evidence_to_send)
+            pipe.execute()
 
         # an evidence is generated for this profile
         # update the threat level of this profile
-        self.update_threat_level(
-            str(evidence.attacker.profile),
-            str(evidence.threat_level),
-            evidence.confidence
+        updates: Dict[str, List[Tuple[str, float]]] = {}
+        for evidence in evidence_batch:
+            updates.setdefault(str(evidence.attacker.profile), []).append(
+                (str(evidence.threat_level), evidence.confidence)
             )
-
-        return True
+        self.update_profiles_threat_levels(updates)
 
 
     def init_evidence_number(self):
@@ -183,11 +283,11 @@ class AlertHandler:
     def get_evidence_number(self):
         return self.r.get('number_of_evidence')
 
-    def mark_evidence_as_processed(self, evidence_id: str):
+    def mark_evidence_as_processed(self, *evidence_ids: str):
         """
         If an evidence was processed by the evidenceprocess, mark it in the db
         """
-        self.r.sadd('processed_evidence', evidence_id)
+        self.r.sadd('processed_evidence', *evidence_ids)
 
     def is_evidence_processed(self, evidence_ID: str) -> bool:
         return self.r.sismember('processed_evidence', evidence_ID)
@@ -287,8 +387,9 @@ class AlertHandler:
         twid by the given update_val
         :param update_val: can be +ve to increase the threat level or -ve
         to decrease
+        :returns: the updated accumulated threat level
         """
-        self.r.zincrby(
+        return self.r.zincrby(
             'accumulated_threat_levels',
             update_val,
             f'{profileid}_{twid}',
@@ -341,15 +442,27 @@ class AlertHandler:
         if the past threat level and confidence
         are the same as the ones we wanna store, we replace the timestamp only
         """
+        past_threat_levels: str = self.r.hget(
+            profileid,
+            'past_threat_levels'
+        )
+        past_threat_levels: str = self.get_updated_past_threat_levels(
+            past_threat_levels, threat_level, confidence
+        )
+        self.r.hset(profileid, 'past_threat_levels', past_threat_levels)
+
+    def get_updated_past_threat_levels(
+            self, past_threat_levels: Optional[str], threat_level, confidence
+        ) -> str:
+        """
+        returns the given serialized past threat levels of a profile
+        after adding the given threat level and confidence to them
+        """
         now = utils.convert_format(time.time(), utils.alerts_format)
         confidence = f'confidence: {confidence}'
         # this is what we'll be storing in the db, tl, ts, and confidence
         threat_level_data = (threat_level, now, confidence)
 
-        past_threat_levels: str = self.r.hget(
-            profileid,
-            'past_threat_levels'
-        )
         if past_threat_levels:
             # get the list of ts and past threat levels
             past_threat_levels: List[Tuple] = json.loads(past_threat_levels)
@@ -374,8 +487,7 @@ class AlertHandler:
             # first time setting a threat level for this profile
             past_threat_levels = [threat_level_data]
 
-        past_threat_levels = json.dumps(past_threat_levels)
-        self.r.hset(profileid, 'past_threat_levels', past_threat_levels)
+        return json.dumps(past_threat_levels)
         
         
     def update_ips_info(self, profileid, max_threat_lvl, confidence):
@@ -419,3 +531,95 @@ class AlertHandler:
 
         self.update_ips_info(profileid, max_threat_lvl, confidence)
 
+    def update_threat_levels(
+            self,
+            profileids: List[str],
+            threat_level: str,
+            confidence: float,
+            chunk_size: int = 10000,
+            ):
+        """
+        Does the same as update_threat_level() for all the given profiles
+        at once
+        """
+        self.update_profiles_threat_levels(
+            {profileid: [(threat_level, confidence)]
+             for profileid in profileids},
+            chunk_size=chunk_size,
+        )
+
+    def update_profiles_threat_levels(
+            self,
+            updates: Dict[str, List[Tuple[str, float]]],
+            chunk_size: int = 10000,
+            ):
+        """
+        Does the same as calling update_threat_level() with each one of the
+        given threat levels and confidences of each profile, in order.
+        the profiles are updated in chunks, each chunk is read
+        using 1 pipeline and written using another one
+        :param updates: {profileid: [(threat level, confidence)]}
+        """
+        profileids: List[str] = list(updates)
+        for i in range(0, len(profileids), chunk_size):
+            chunk: List[str] = profileids[i: i + chunk_size]
+            ips: List[str] = [profileid.split('_')[-1] for profileid in chunk]
+
+            pipe = self.r.pipeline(transaction=False)
+            for profileid in chunk:
+                pipe.hmget(profileid, 'past_threat_levels', 'max_threat_level')
+            profiles_info: list = pipe.execute()
+            cached_ips_info: list = self.rcache.hmget('IPsInfo', ips)
+
+            pipe = self.r.pipeline(transaction=False)
+            ips_info = {}
+            for profileid, ip, profile_info, cached_ip_info in zip(
+                    chunk, ips, profiles_info, cached_ips_info
+            ):
+                past_threat_levels, old_max_threat_level = profile_info
+                max_threat_lvl: float = (
+                    utils.threat_levels[old_max_threat_level]
+                    if old_max_threat_level else -1
+                )
+                fields = {}
+                last_update = None
+                for update in updates[profileid]:
+                    # setting the same threat level and confidence again
+                    # only changes the timestamp of the last one
+                    if update == last_update:
+                        continue
+                    last_update = update
+                    threat_level, confidence = update
+                    past_threat_levels: str = (
+                        self.get_updated_past_threat_levels(
+                            past_threat_levels, threat_level, confidence
+                        )
+                    )
+                    threat_level_float: float = (
+                        utils.threat_levels[threat_level]
+                    )
+                    if threat_level_float > max_threat_lvl:
+                        max_threat_lvl = threat_level_float
+                        fields['max_threat_level'] = threat_level
+
+                fields.update({
+                    'threat_level': threat_level,
+                    'past_threat_levels': past_threat_levels,
+                })
+                pipe.hset(profileid, mapping=fields)
+
+                score_confidence = {
+                    'score': max_threat_lvl,
+                    'confidence': confidence
+                }
+                if cached_ip_info:
+                    # append the score and confidence to the already
+                    # existing data
+                    cached_ip_info: dict = json.loads(cached_ip_info)
+                    cached_ip_info.update(score_confidence)
+                    score_confidence = cached_ip_info
+                ips_info[ip] = json.dumps(score_confidence)
+
+            pipe.execute()
+            if ips_info:
+                self.rcache.hset('IPsInfo', mapping=ips_info)
@@ -3,7 +3,13 @@ from slips_files.common.parsers.config_parser import ConfigParser
 from slips_files.core.database.redis_db.ioc_handler import IoCHandler
 from slips_files.core.database.redis_db.alert_handler import AlertHandler
 from slips_files.core.database.redis_db.profile_handler import ProfileHandler
+from slips_files.core.database.redis_db.tw_archive_handler import (
+    TWArchiveHandler
+    )
+from slips_files.core.database.redis_db.sharded_redis import ShardedRedis
+from slips_files.core.database.redis_db.stream_consumer import StreamConsumer
 from slips_files.common.abstracts.observer import IObservable
+from slips_files.common.ioc_snapshot import IoCSnapshot
 
 import os
 import signal
@@ -16,12 +22,19 @@ import ipaddress
 import sys
 import validators
 from typing import List, \
-    Dict
+    Dict, \
+    Set
 
 RUNNING_IN_DOCKER = os.environ.get('IS_IN_A_DOCKER_CONTAINER', False)
 
 
-class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
+class RedisDB(
+        IoCHandler,
+        AlertHandler,
+        ProfileHandler,
+        TWArchiveHandler,
+        IObservable
+):
     """Main redis db class."""
     # this db should be a singelton per port. meaning no 2 instances should be created for the same port at the same
     # time
@@ -87,8 +100,6 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
     _gateway_MAC_found = False
     _conf_file = 'config/redis.conf'
     our_ips = utils.get_own_IPs()
-    # flag to know which flow is the start of the pcap/file
-    first_flow = True
     # to make sure we only detect and store the user's localnet once
     is_localnet_set = False
     # in case of redis ConnectionErrors, this is how long we'll wait in
@@ -100,6 +111,17 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
     max_retries = 150
     # to keep track of connection retries. once it reaches max_retries, slips will terminate
     connection_retry = 0
+    # max domains, resolvers and tws kept in the dns resolution of each ip,
+    # the oldest ones are forgotten first
+    max_dns_resolution_list_len = 100
+    # old dns resolutions are evicted once every this many resolutions
+    dns_eviction_interval = 1000
+    dns_resolutions_since_eviction = 0
+    # max number of msgs kept in a stream when redis is too old to remove
+    # only the ones that were read by all the subscribers
+    max_stream_len = 1000000
+    # {subscriber: StreamConsumer} of the subscribers in this process
+    stream_consumers: Dict[str, StreamConsumer] = {}
 
     def __new__(
             cls,
@@ -179,6 +201,19 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
         cls.disabled_detections: List[str] = conf.disabled_detections()
         cls.width = conf.get_tw_width_as_float()
         cls.client_ips: List[str] = conf.client_ips()
+        cls.redis_shard_ports: List[int] = conf.redis_shard_ports()
+        cls.stream_channels: Set[str] = set(conf.redis_streams_channels())
+        cls.stream_batch_size: int = conf.redis_streams_batch_size()
+        cls.stream_block_time: float = conf.redis_streams_block_time()
+        cls.evidence_batch_size: int = conf.evidence_batch_size()
+        cls.dns_resolutions_ttl: float = conf.dns_resolutions_ttl()
+        cls.max_dns_resolutions: int = conf.max_dns_resolutions()
+        cls.archive_closed_tws_after: float = conf.archive_closed_tws_after()
+        cls.ioc_snapshot_path: str = conf.ioc_snapshot_path()
+        cls.ioc_snapshot = (
+            IoCSnapshot(cls.ioc_snapshot_path)
+            if cls.ioc_snapshot_path else None
+        )
 
     @classmethod
     def set_slips_internal_time(cls, timestamp):
@@ -261,14 +296,23 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
         """
         Connects to the given port and Sets r and rcache
         """
+        shard_ports = cls.get_redis_shard_ports()
         if cls.start_server:
             #  starts the redis server using cli. we don't need that when using -k
-            os.system(
-                f'redis-server {cls._conf_file} --port {cls.redis_port}  > /dev/null 2>&1'
-            )
+            for port in (cls.redis_port, *shard_ports):
+                os.system(
+                    f'redis-server {cls._conf_file} --port {port}  > /dev/null 2>&1'
+                )
         try:
             # db 0 changes everytime we run slips
             cls.r = cls.start_redis_instance(cls.redis_port, 0)
+            if shard_ports:
+                # the profiles are stored in the shards, everything else
+                # in the main server
+                cls.r = ShardedRedis(
+                    cls.r,
+                    [cls.start_redis_instance(port, 0) for port in shard_ports]
+                )
 
             # port 6379 db 0 is cache, delete it using -cc flag
             cls.rcache = cls.start_redis_instance(6379, 1)
@@ -280,10 +324,22 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
             # when you try to execute a command on the server.
             # so make sure it's established first
             cls.r.client_list()
+            if shard_ports:
+                for shard in cls.r.shards:
+                    shard.client_list()
             return True
         except redis.exceptions.ConnectionError:
             return False
 
+    @classmethod
+    def get_redis_shard_ports(cls) -> List[int]:
+        """
+        returns the ports of the redis servers the profiles are stored in
+        """
+        return [
+            port for port in cls.redis_shard_ports if port != cls.redis_port
+        ]
+
     @classmethod
     def close_redis_server(cls, redis_port):
         if server_pid := cls.get_redis_server_PID(redis_port):
@@ -316,14 +372,55 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
 
     def publish(self, channel, data):
         """Publish something"""
-        self.r.publish(channel, data)
+        if self.is_batching():
+            # will be published when the batch is committed,
+            # after the data it's about is stored in the db
+            self.buffer_msg(channel, data)
+            return
+        self.send_msg(self.r, channel, data)
+
+    def get_stream_key(self, channel: str) -> str:
+        return f'stream{self.separator}{channel}'
 
-    def subscribe(self, channel: str, ignore_subscribe_messages=True):
-        """Subscribe to channel"""
+    def send_msg(self, client, channel: str, data):
+        """
+        sends the given msg using the given redis client or pipeline.
+        the msgs of the redis_streams_channels are added to the stream
+        of the channel, the rest are published
+        """
+        if channel in self.stream_channels:
+            client.xadd(self.get_stream_key(channel), {'data': data})
+        else:
+            client.publish(channel, data)
+
+    def subscribe(
+            self,
+            channel: str,
+            ignore_subscribe_messages=True,
+            subscriber: str = 'slips'
+    ):
+        """
+        Subscribe to channel
+        :param subscriber: name of the module subscribing. each subscriber
+        reads all the msgs sent using streams, the rest are received by
+        all the subscribers anyway
+        """
         # For when a TW is modified
         if channel not in self.supported_channels:
             return False
 
+        if channel in self.stream_channels:
+            if subscriber not in self.stream_consumers:
+                self.stream_consumers[subscriber] = StreamConsumer(
+                    self.r,
+                    subscriber,
+                    batch_size=self.stream_batch_size,
+                    block_time=self.stream_block_time,
+                )
+            return self.stream_consumers[subscriber].subscribe(
+                self.get_stream_key(channel), channel
+            )
+
         self.pubsub = self.r.pubsub()
         self.pubsub.subscribe(
             channel,
@@ -337,7 +434,87 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
         to shutdown slips gracefully, this function should only be used by slips.py
         """
         self.print('Sending the stop signal to all listeners', 0, 3)
-        self.r.publish('control_channel', 'stop_slips')
+        self.send_msg(self.r, 'control_channel', 'stop_slips')
+
+    @staticmethod
+    def parse_stream_id(stream_id: str) -> tuple:
+        """returns a sortable tuple from the given stream msg id"""
+        ms, seq = stream_id.split('-')
+        return int(ms), int(seq)
+
+    def trim_streams(self):
+        """
+        removes the msgs of each stream that were read and acknowledged
+        by all its subscribers, and stores how many msgs each subscriber
+        didn't read (lag) or didn't acknowledge (pending) yet
+        """
+        backlog = {}
+        for channel in self.stream_channels:
+            stream = self.get_stream_key(channel)
+            try:
+                groups: List[dict] = self.r.xinfo_groups(stream)
+            except redis.exceptions.ResponseError:
+                # nothing was sent in this channel and no one subscribed
+                continue
+
+            # the oldest msg each subscriber still needs
+            oldest_needed = []
+            for group in groups:
+                if group['pending']:
+                    pending: dict = self.r.xpending(stream, group['name'])
+                    oldest_needed.append(pending['min'])
+                else:
+                    oldest_needed.append(group['last-delivered-id'])
+                backlog.setdefault(group['name'], {})[channel] = {
+                    'pending': group['pending'],
+                    # only given by redis >= 7
+                    'lag': group.get('lag'),
+                }
+
+            if not oldest_needed:
+                # no subscribers
+                self.r.xtrim(stream, 0, approximate=False)
+                continue
+
+            min_id = min(oldest_needed, key=self.parse_stream_id)
+            try:
+                self.r.execute_command('XTRIM', stream, 'MINID', '~', min_id)
+            except redis.exceptions.ResponseError:
+                # MINID needs redis >= 6.2
+                self.r.xtrim(stream, self.max_stream_len)
+
+        if backlog:
+            self.r.hset(
+                'StreamsBacklog',
+                mapping={
+                    subscriber: json.dumps(channels)
+                    for subscriber, channels in backlog.items()
+                }
+            )
+
+    def get_streams_backlog(self) -> Dict[str, dict]:
+        """
+        returns how many msgs each subscriber has left to read from each
+        stream
+        {subscriber: {channel: {'pending': int, 'lag': int}}}
+        """
+        return {
+            subscriber: json.loads(channels)
+            for subscriber, channels in self.r.hgetall('StreamsBacklog').items()
+        }
+
+    def wait_for_stream_msgs(self, subscriber: str):
+        """
+        blocks for up to stream_block_time until any of the streams the
+        given subscriber is subscribed to has msgs
+        """
+        if not (consumer := self.stream_consumers.get(subscriber)):
+            return
+        try:
+            consumer.wait()
+        except redis.exceptions.ConnectionError:
+            # handled by the next get_message()
+            pass
 
     def get_message(self, channel, timeout=0.0000001):
         """
@@ -584,7 +761,7 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
 
         self.rcache.hset('IPsInfo', ip, json.dumps(cached_ip_info))
         if is_new_info:
-            self.r.publish('ip_info_change', ip)
+            self.send_msg(self.r, 'ip_info_change', ip)
 
     def get_redis_pid(self):
         """returns the pid of the current redis server"""
@@ -685,6 +862,7 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
 
     def delete_dns_resolution(self , ip):
         self.r.hdel("DNSresolution" , ip)
+        self.r.zrem("DNSresolution_last_seen", ip)
 
     def should_store_resolution(self, query: str, answers: list, qtype_name: str):
         # don't store queries ending with arpa as dns resolutions, they're reverse dns
@@ -739,76 +917,126 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
                 # it's a CNAME
                 CNAMEs.append(answer)
                 continue
+            ips_to_add.append(answer)
 
+        if not ips_to_add:
+            return
 
-            # get stored DNS resolution from our db
-            ip_info_from_db = self.get_dns_resolution(answer)
-            if ip_info_from_db == {}:
-                # if the domain(query) we have isn't already in
-                # DNSresolution in the db
-                resolved_by = [srcip]
-                domains = []
-                timewindows = [profileid_twid]
-            else:
-                # we have info about this domain in DNSresolution in the db
-                # keep track of all srcips that resolved this domain
-                resolved_by = ip_info_from_db.get('resolved-by', [])
-                if srcip not in resolved_by:
-                    resolved_by.append(srcip)
-
-                # timewindows in which this odmain was resolved
-                timewindows = ip_info_from_db.get('timewindows', [])
-                if profileid_twid not in timewindows:
-                    timewindows.append(profileid_twid)
-
-                # we'll be appending the current answer
-                # to these cached domains
-                domains = ip_info_from_db.get('domains', [])
-
-            # if the domain(query) we have isn't already in
-            # DNSresolution in the db, add it
-            if query not in domains:
-                domains.append(query)
-
-            # domains should be a list, not a string!,
-            # so don't use json.dumps here
+        # get the stored DNS resolutions of all the answers at once
+        resolutions = {}
+        stored_resolutions = self.r.hmget('DNSresolution', ips_to_add)
+        for answer, ip_info_from_db in zip(ips_to_add, stored_resolutions):
+            ip_info_from_db = (
+                json.loads(ip_info_from_db) if ip_info_from_db else {}
+            )
+            # keep track of the domains resolved to this ip, all srcips
+            # that resolved them and the tws they were resolved in
             ip_info = {
                 'ts': ts,
                 'uid': uid,
-                'domains': domains,
-                'resolved-by': resolved_by,
-                'timewindows': timewindows,
+                'domains': self.add_to_bounded_list(
+                    ip_info_from_db.get('domains', []), query
+                ),
+                'resolved-by': self.add_to_bounded_list(
+                    ip_info_from_db.get('resolved-by', []), srcip
+                ),
+                'timewindows': self.add_to_bounded_list(
+                    ip_info_from_db.get('timewindows', []), profileid_twid
+                ),
             }
-            ip_info = json.dumps(ip_info)
-            # we store ALL dns resolutions seen since starting slips
-            # store with the IP as the key
-            self.r.hset('DNSresolution', answer, ip_info)
-            # store with the domain as the key:
-            self.r.hset('ResolvedDomains', domains[0], answer)
-            # these ips will be associated with the query in our db
-            ips_to_add.append(answer)
+            resolutions[answer] = json.dumps(ip_info, separators=(',', ':'))
+
+        # store with the IP as the key
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset('DNSresolution', mapping=resolutions)
+        last_seen = self.get_dns_resolution_time(ts)
+        pipe.zadd(
+            'DNSresolution_last_seen',
+            {answer: last_seen for answer in ips_to_add}
+        )
+        pipe.execute()
 
-            #  For each CNAME in the answer
-            # store it in DomainsInfo in the cache db (used for kalipso)
-            # and in CNAMEsInfo in the maion db  (used for detecting dns without resolution)
-        if ips_to_add:
-            domaindata = {'IPs': ips_to_add}
-            # if an ip came in the DNS answer along with the last seen CNAME
-            try:
-                # store this CNAME in the db
-                domaindata['CNAME'] = CNAMEs
-            except NameError:
-                # no CNAME came with this query
-                pass
+        #  For each CNAME in the answer
+        # store it in DomainsInfo in the cache db (used for kalipso)
+        # and in CNAMEsInfo in the maion db  (used for detecting dns without resolution)
+        domaindata = {'IPs': ips_to_add, 'CNAME': CNAMEs}
+        self.set_info_for_domains(query, domaindata, mode='add')
+        self.set_domain_resolution(query, ips_to_add, ts=ts)
+        self.evict_old_dns_resolutions()
+
+    def add_to_bounded_list(self, items: list, item) -> list:
+        """
+        appends the given item to the given list if it's not there,
+        forgetting the oldest items if the list gets too long
+        """
+        if item in items:
+            return items
+        items.append(item)
+        return items[-self.max_dns_resolution_list_len:]
 
-            self.set_info_for_domains(query, domaindata, mode='add')
-            self.set_domain_resolution(query, ips_to_add)
+    @staticmethod
+    def get_dns_resolution_time(ts) -> float:
+        """
+        returns the time of a resolution used to evict old ones.
+        this is the time of the dns flow, so old pcaps aren't evicted
+        as soon as they're read
+        """
+        try:
+            return float(ts)
+        except (ValueError, TypeError):
+            return time.time()
 
-    def set_domain_resolution(self, domain, ips):
+    def set_domain_resolution(self, domain, ips, ts=None):
         """
         stores all the resolved domains with their ips in the db
         """
-        self.r.hset("DomainsResolved", domain, json.dumps(ips))
+        last_seen = self.get_dns_resolution_time(ts)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset("DomainsResolved", domain, json.dumps(ips))
+        pipe.zadd("DomainsResolved_last_seen", {domain: last_seen})
+        pipe.execute()
+
+    def evict_old_dns_resolutions(self):
+        """
+        forgets the resolved ips and domains that weren't seen in the last
+        dns_resolutions_ttl seconds of traffic, and the least recently seen
+        ones when there are more than max_dns_resolutions of them
+        runs once every dns_eviction_interval calls
+        """
+        RedisDB.dns_resolutions_since_eviction += 1
+        if self.dns_resolutions_since_eviction < self.dns_eviction_interval:
+            return
+        RedisDB.dns_resolutions_since_eviction = 0
+
+        for resolutions, last_seen in (
+            ('DNSresolution', 'DNSresolution_last_seen'),
+            ('DomainsResolved', 'DomainsResolved_last_seen'),
+        ):
+            to_evict = self.r.zcard(last_seen) - self.max_dns_resolutions
+            if self.dns_resolutions_ttl > 0:
+                newest = self.r.zrange(last_seen, -1, -1, withscores=True)
+                if newest:
+                    oldest_to_keep = newest[0][1] - self.dns_resolutions_ttl
+                    expired = self.r.zcount(
+                        last_seen, '-inf', f'({oldest_to_keep}'
+                    )
+                    to_evict = max(to_evict, expired)
+
+            if to_evict <= 0:
+                continue
+
+            # evict in chunks to avoid huge redis commands
+            chunk_size = 10000
+            while to_evict > 0:
+                chunk = min(to_evict, chunk_size)
+                evicted = self.r.zrange(last_seen, 0, chunk - 1)
+                if not evicted:
+                    break
+                pipe = self.r.pipeline(transaction=False)
+                pipe.hdel(resolutions, *evicted)
+                pipe.zrem(last_seen, *evicted)
+                pipe.execute()
+                to_evict -= len(evicted)
 
 
     @staticmethod
@@ -1134,53 +1362,45 @@ class RedisDB(IoCHandler, AlertHandler, ProfileHandler, IObservable):
         """
         Stores the range of asn in cached_asn hash
         """
-
         range_info = {
-            asn_range: {
-                'org': org
-            }
+            'org': org
         }
         if asn_number:
-            range_info[asn_range].update(
-                {'number': f'AS{asn_number}'}
-            )
-
-        first_octet = utils.get_first_octet(asn_range)
-        if not first_octet:
-            return
+            range_info['number'] = f'AS{asn_number}'
 
-        # this is how we store ASNs; sorted by first octet
+        # this is how we store ASNs; 1 field per range, so caching a new
+        # range doesn't rewrite the others
         """
         {
-            '192' : {
-                '192.168.1.0/x': {'number': 'AS123', 'org':'Test'},
-                '192.168.1.0/x': {'number': 'AS123', 'org':'Test'},
-            },
-            '10': {
-                '10.0.0.0/x': {'number': 'AS123', 'org':'Test'},
-            }
-            
+            '192.168.1.0/x': '{"number": "AS123", "org": "Test"}',
+            '10.0.0.0/x': '{"number": "AS123", "org": "Test"}',
         }
         """
-        if cached_asn := self.get_asn_cache(first_octet=first_octet):
-            # we already have a cached asn of a range that
-            # starts with the same first octet
-            cached_asn: dict = json.loads(cached_asn)
-            cached_asn.update(range_info)
-            self.rcache.hset('cached_asn', first_octet, json.dumps(cached_asn))
-        else:
-            # first time storing a range starting with the same first octet
-            self.rcache.hset('cached_asn', first_octet, json.dumps(range_info))
-
-    def get_asn_cache(self, first_octet=False):
-        """
-         cached ASNs are sorted by first octet
-        Returns cached asn of ip if present, or False.
-        """
-        if first_octet:
-            return self.rcache.hget('cached_asn', first_octet)
-        else:
-            return self.rcache.hgetall('cached_asn')
+        self.rcache.hset('cached_asn', asn_range, json.dumps(range_info))
+
+    def get_asn_cache(self) -> Dict[str, str]:
+        """
+        Returns all the cached asn ranges
+        {range: serialized {'org':.., 'number':..}}
+        """
+        cached_asn: Dict[str, str] = self.rcache.hgetall('cached_asn')
+        # older versions stored all the ranges with the same first octet
+        # in 1 field, split them
+        old_fields = [field for field in cached_asn if '/' not in field]
+        if not old_fields:
+            return cached_asn
+
+        ranges = {}
+        for first_octet in old_fields:
+            for asn_range, range_info in json.loads(
+                    cached_asn.pop(first_octet)
+            ).items():
+                ranges[asn_range] = json.dumps(range_info)
+        if ranges:
+            self.rcache.hset('cached_asn', mapping=ranges)
+        self.rcache.hdel('cached_asn', *old_fields)
+        cached_asn.update(ranges)
+        return cached_asn
 
     def store_pid(self, process, pid):
         """
@@ -1,5 +1,13 @@
 import json
 import ast
+import time
+from typing import Iterator, \
+    Dict, \
+    List, \
+    Optional, \
+    Tuple
+from uuid import uuid4
+from slips_files.common.ioc_snapshot import IoCSnapshot
 
 class IoCHandler():
     """
@@ -7,6 +15,24 @@ class IoCHandler():
     Contains all the logic related to setting and retrieving evidence and alerts in the db
     """
     name = 'DB'
+    # number of IoCs written to or deleted from the db using 1 pipeline
+    ioc_chunk_size = 10000
+    # the hashes of the IoCs that are indexed by the source they're read from
+    indexed_ioc_types = ('IoC_ips', 'IoC_domains', 'IoC_ip_ranges')
+    # the hashes of the IoCs that are written to the IoC snapshot
+    snapshot_ioc_types = (
+        'IoC_ips',
+        'IoC_domains',
+        'IoC_ip_ranges',
+        'IoC_ASNs',
+        'IoC_JA3',
+        'IoC_JARM',
+        'IoC_SSL',
+    )
+    # generation of the IoCs in the db, read from the db at most once
+    # per IoCSnapshot.check_interval
+    ioc_generation: Optional[str] = None
+    last_ioc_generation_check = 0
 
 
     def set_loaded_ti_files(self, number_of_loaded_files: int):
@@ -44,48 +70,247 @@ class IoCHandler():
 
         return data_to_send
 
+    def update_IoC_generation(self, client=None):
+        """
+        marks the IoCs in the db as changed, the IoC snapshot is ignored
+        until it's written again from the db.
+        should be called after every change to the IoCs, using the
+        pipeline of the change if there's one
+        """
+        generation = uuid4().hex
+        (client or self.rcache).set('IoC_generation', generation)
+        # this process notices its own changes right away
+        self.ioc_generation = generation
+        self.last_ioc_generation_check = time.time()
+
     def delete_ips_from_IoC_ips(self, ips):
         """
         Delete old IPs from IoC
         """
         self.rcache.hdel('IoC_ips', *ips)
+        self.update_IoC_generation()
 
     def delete_domains_from_IoC_domains(self, domains):
         """
         Delete old domains from IoC
         """
         self.rcache.hdel('IoC_domains', *domains)
+        self.update_IoC_generation()
+
+    def get_source_index_key(self, ioc_type: str, source: str) -> str:
+        """
+        returns the key of the set of IoCs of the given type
+        that were read from the given source
+        :param ioc_type: IoC_ips, IoC_domains or IoC_ip_ranges
+        """
+        return f'{ioc_type}_from_{source}'
+
+    def add_IoCs(
+            self,
+            ioc_type: str,
+            iocs: dict,
+            source: str = None,
+            update_generation: bool = True,
+    ):
+        """
+        Stores the given IoCs in the ioc_type hash in chunks of
+        ioc_chunk_size IoCs, each chunk using 1 pipeline.
+        If a source is given, the IoCs are added to the index of the IoCs
+        read from this source, so they can be deleted without going
+        through all the IoCs in the db
+        :param ioc_type: IoC_ips, IoC_domains or IoC_ip_ranges
+        :param iocs: {ioc: json.dumps{'source':..,'tags':..,
+                                      'threat_level':... ,'description'}}
+        :param update_generation: False for the IoCs found while
+        analyzing the traffic. the IoC snapshot stays in use, the
+        instances reading it find these IoCs again when they see them
+        """
+        if source:
+            index_key = self.get_source_index_key(ioc_type, source)
+            # even if this source has no IoCs of this type, we know now
+            # that all of them are in the index
+            self.rcache.sadd('IoC_indexed_sources', index_key)
+
+        iocs = list(iocs.items())
+        for i in range(0, len(iocs), self.ioc_chunk_size):
+            chunk = dict(iocs[i: i + self.ioc_chunk_size])
+            pipe = self.rcache.pipeline(transaction=False)
+            pipe.hset(ioc_type, mapping=chunk)
+            if source:
+                pipe.sadd(index_key, *chunk)
+            if update_generation:
+                self.update_IoC_generation(pipe)
+            pipe.execute()
+
+    def get_IoCs_of_source(
+            self, ioc_type: str, source: str
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        yields (ioc, description) of the IoCs of the given type that may
+        belong to the given source
+        """
+        index_key = self.get_source_index_key(ioc_type, source)
+        if not self.rcache.sismember('IoC_indexed_sources', index_key):
+            # these IoCs were stored before indexing them by source,
+            # we have to go through all of them
+            yield from self.rcache.hgetall(ioc_type).items()
+            return
 
-    def add_ips_to_IoC(self, ips_and_description: dict) -> None:
+        iocs = list(self.rcache.smembers(index_key))
+        for i in range(0, len(iocs), self.ioc_chunk_size):
+            chunk = iocs[i: i + self.ioc_chunk_size]
+            descriptions = self.rcache.hmget(ioc_type, chunk)
+            for ioc, description in zip(chunk, descriptions):
+                if description is not None:
+                    yield ioc, description
+
+    def delete_IoCs_of_source(self, source: str):
+        """
+        Deletes the IPs, domains and IP ranges read from the given source
+        :param source: name of the feed or TI file, e.g. 'malicious_ips.txt'
+        """
+        for ioc_type in self.indexed_ioc_types:
+            to_delete = []
+            for ioc, description in self.get_IoCs_of_source(ioc_type, source):
+                # the IoC may be overwritten by another source after being
+                # added to the index of this one. IoCs found in many
+                # sources (e.g. 'a.txt, b.txt') are kept, they still
+                # belong to the other ones
+                ioc_source = json.loads(description)['source']
+                if ioc_source == source:
+                    to_delete.append(ioc)
+            self.remove_IoCs_of_source(ioc_type, source, to_delete)
+
+    def remove_IoCs_of_source(
+            self,
+            ioc_type: str,
+            source: str,
+            to_delete: List[str],
+            to_update: Dict[str, str] = None,
+    ):
+        """
+        deletes the given IoCs and the index of the given source
+        :param to_update: {ioc: new description} of the IoCs that are
+        kept but no longer belong to the given source
+        """
+        to_update = to_update or {}
+        pipe = self.rcache.pipeline(transaction=False)
+        for i in range(0, len(to_delete), self.ioc_chunk_size):
+            pipe.hdel(ioc_type, *to_delete[i: i + self.ioc_chunk_size])
+        updates = list(to_update.items())
+        for i in range(0, len(updates), self.ioc_chunk_size):
+            pipe.hset(
+                ioc_type, mapping=dict(updates[i: i + self.ioc_chunk_size])
+            )
+        # the source is still marked as indexed, it has no IoCs now
+        pipe.delete(self.get_source_index_key(ioc_type, source))
+        if to_delete or to_update:
+            self.update_IoC_generation(pipe)
+        pipe.execute()
+
+    def write_IoC_snapshot(self):
+        """
+        writes all the IoCs in the cache db to the IoC snapshot shared by
+        all the slips instances on this host
+        """
+        if not self.ioc_snapshot_path:
+            return
+        # the IoCs and their generation are read at once, so the snapshot
+        # never has IoCs of another generation
+        pipe = self.rcache.pipeline(transaction=True)
+        pipe.get('IoC_generation')
+        for ioc_type in self.snapshot_ioc_types:
+            pipe.hgetall(ioc_type)
+        generation, *tables = pipe.execute()
+        IoCSnapshot.write(
+            self.ioc_snapshot_path,
+            dict(zip(self.snapshot_ioc_types, tables)),
+            generation=generation,
+        )
+
+    def is_IoC_snapshot_up_to_date(self) -> bool:
+        """
+        the snapshot is only used while it has the same IoCs as the db,
+        e.g. IoCs deleted from the db after the snapshot was written
+        shouldn't be found in it
+        """
+        if not self.ioc_snapshot or not self.ioc_snapshot.is_loaded():
+            return False
+
+        now = time.time()
+        if (
+            now - self.last_ioc_generation_check
+            >= IoCSnapshot.check_interval
+        ):
+            self.ioc_generation = self.rcache.get('IoC_generation')
+            self.last_ioc_generation_check = now
+
+        return (
+            self.ioc_generation is not None
+            and self.ioc_snapshot.generation == self.ioc_generation
+        )
+
+    def get_IoC(self, ioc_type: str, ioc: str) -> Optional[str]:
+        """
+        returns the description of the given IoC, or None if it's not
+        in the db. read from the IoC snapshot if it's up to date
+        """
+        if self.is_IoC_snapshot_up_to_date():
+            return self.ioc_snapshot.get(ioc_type, ioc)
+        return self.rcache.hget(ioc_type, ioc)
+
+    def get_IoCs(self, ioc_type: str, iocs: List[str]) -> List[Optional[str]]:
+        """
+        does the same as get_IoC() for all the given IoCs at once
+        """
+        if self.is_IoC_snapshot_up_to_date():
+            return self.ioc_snapshot.get_many(ioc_type, iocs)
+        return self.rcache.hmget(ioc_type, iocs)
+
+    def add_ips_to_IoC(
+            self,
+            ips_and_description: dict,
+            source: str = None,
+            update_generation: bool = True,
+    ) -> None:
         """
         Store a group of IPs in the db as they were obtained from an IoC source
         :param ips_and_description: is {ip: json.dumps{'source':..,
                                                         'tags':..,
                                                         'threat_level':... ,
                                                         'description':...}}
+        :param source: the file the IPs were read from, used for deleting
+        them when this file is updated
+        :param update_generation: False for the IPs found while analyzing
+        the traffic, see add_IoCs()
+        """
+        self.add_IoCs(
+            'IoC_ips',
+            ips_and_description,
+            source=source,
+            update_generation=update_generation,
+        )
 
-        """
-        if ips_and_description:
-            self.rcache.hmset('IoC_ips', ips_and_description)
-
-    def add_domains_to_IoC(self, domains_and_description: dict) -> None:
+    def add_domains_to_IoC(self, domains_and_description: dict, source: str = None) -> None:
         """
         Store a group of domains in the db as they were obtained from
         an IoC source
         :param domains_and_description: is {domain: json.dumps{'source':..,'tags':..,
                                                             'threat_level':... ,'description'}}
+        :param source: the file the domains were read from, used for
+        deleting them when this file is updated
         """
-        if domains_and_description:
-            self.rcache.hmset('IoC_domains', domains_and_description)
+        self.add_IoCs('IoC_domains', domains_and_description, source=source)
 
-    def add_ip_range_to_IoC(self, malicious_ip_ranges: dict) -> None:
+    def add_ip_range_to_IoC(self, malicious_ip_ranges: dict, source: str = None) -> None:
         """
         Store a group of IP ranges in the db as they were obtained from an IoC source
         :param malicious_ip_ranges: is {range: json.dumps{'source':..,'tags':..,
                                                             'threat_level':... ,'description'}}
+        :param source: the file the ranges were read from, used for
+        deleting them when this file is updated
         """
-        if malicious_ip_ranges:
-            self.rcache.hmset('IoC_ip_ranges', malicious_ip_ranges)
+        self.add_IoCs('IoC_ip_ranges', malicious_ip_ranges, source=source)
 
     def add_asn_to_IoC(self, blacklisted_ASNs: dict):
         """
@@ -95,9 +320,10 @@ class IoCHandler():
         """
         if blacklisted_ASNs:
             self.rcache.hmset('IoC_ASNs', blacklisted_ASNs)
+            self.update_IoC_generation()
 
     def is_blacklisted_ASN(self, ASN) -> bool:
-        return self.rcache.hget('IoC_ASNs', ASN)
+        return self.get_IoC('IoC_ASNs', ASN)
 
 
     def add_ja3_to_IoC(self, ja3: dict) -> None:
@@ -108,6 +334,7 @@ class IoCHandler():
 
         """
         self.rcache.hmset('IoC_JA3', ja3)
+        self.update_IoC_generation()
 
     def add_jarm_to_IoC(self, jarm: dict) -> None:
         """
@@ -116,6 +343,7 @@ class IoCHandler():
                             'threat_level':... ,'description'}}
         """
         self.rcache.hmset('IoC_JARM', jarm)
+        self.update_IoC_generation()
 
     def add_ssl_sha1_to_IoC(self, malicious_ssl_certs):
         """
@@ -125,6 +353,7 @@ class IoCHandler():
 
         """
         self.rcache.hmset('IoC_SSL', malicious_ssl_certs)
+        self.update_IoC_generation()
 
     def get_malicious_ip_ranges(self) -> dict:
         """
@@ -133,6 +362,14 @@ class IoCHandler():
                                             'threat_level':... ,'description'}}
         """
         return self.rcache.hgetall('IoC_ip_ranges')
+
+    def get_malicious_ip_range_info(self, ip_range: str):
+        """
+        Returns the description of the given malicious ip range
+        or None if it's not in our db
+        """
+        return self.get_IoC('IoC_ip_ranges', ip_range)
+
     def get_IPs_in_IoC(self):
         """
         Get all IPs and their description from IoC_ips
@@ -155,14 +392,14 @@ class IoCHandler():
         """
         search for the given hash in the malicious hashes stored in the db
         """
-        return self.rcache.hget('IoC_JARM', jarm_hash)
+        return self.get_IoC('IoC_JARM', jarm_hash)
 
     def search_IP_in_IoC(self, ip: str) -> str:
         """
         Search in the dB of malicious IPs and return a
         description if we found a match
         """
-        ip_description = self.rcache.hget('IoC_ips', ip)
+        ip_description = self.get_IoC('IoC_ips', ip)
         return False if ip_description is None else ip_description
 
 
@@ -233,7 +470,7 @@ class IoCHandler():
         return data
 
     def get_ssl_info(self, sha1):
-        info = self.rcache.hmget('IoC_SSL', sha1)[0]
+        info = self.get_IoC('IoC_SSL', sha1)
         return False if info is None else info
 
     def is_domain_malicious(self, domain: str) -> tuple:
@@ -244,39 +481,47 @@ class IoCHandler():
         description: description of the subdomain if found
         bool: True if we found a match for exactly the given domain False if we matched a subdomain
         """
-        domain_description = self.rcache.hget('IoC_domains', domain)
-        if domain_description is None:
-            # try to match subdomain
-            ioc_domains = self.rcache.hgetall('IoC_domains')
-            for malicious_domain, description in ioc_domains.items():
-                #  if the we contacted images.google.com and we have google.com in our blacklists, we find a match
-                if malicious_domain in domain:
-                    return description, True
-            return False, False
-        else:
-            return domain_description, False
+        # if the we contacted images.google.com and we have google.com in
+        # our blacklists, we find a match. so look for the domain and all
+        # its parent domains in 1 hmget instead of going through all the
+        # blacklisted domains
+        labels = domain.split('.')
+        parent_domains = ['.'.join(labels[i:]) for i in range(len(labels))]
+        descriptions = self.get_IoCs('IoC_domains', parent_domains)
+        for parent_domain, description in zip(parent_domains, descriptions):
+            if description is not None:
+                return description, parent_domain != domain
+        return False, False
 
     def delete_feed(self, url: str):
         """
-        Delete all entries in IoC_domains and IoC_ips that contain the given feed as source
+        Delete all entries in IoC_domains, IoC_ips and IoC_ip_ranges that were read from the given feed
+        IoCs found in other feeds too are kept, only the given feed is
+        removed from their source
         """
         # get the feed name from the given url
         feed_to_delete = url.split('/')[-1]
-        # get all domains that are read from TI files in our db
-        IoC_domains = self.rcache.hgetall('IoC_domains')
-        for domain, domain_description in IoC_domains.items():
-            domain_description = json.loads(domain_description)
-            if feed_to_delete in domain_description['source']:
-                # this entry has the given feed as source, delete it
-                self.rcache.hdel('IoC_domains', domain)
-
-        # get all IPs that are read from TI files in our db
-        IoC_ips = self.rcache.hgetall('IoC_ips')
-        for ip, ip_description in IoC_ips.items():
-            ip_description = json.loads(ip_description)
-            if feed_to_delete in ip_description['source']:
-                # this entry has the given feed as source, delete it
-                self.rcache.hdel('IoC_ips', ip)
+        for ioc_type in self.indexed_ioc_types:
+            to_delete = []
+            to_update = {}
+            # the IoCs are scanned if the feed has no index
+            for ioc, description in self.get_IoCs_of_source(
+                    ioc_type, feed_to_delete
+            ):
+                description = json.loads(description)
+                sources = description['source'].split(', ')
+                if feed_to_delete not in sources:
+                    continue
+
+                sources = [src for src in sources if src != feed_to_delete]
+                if not sources:
+                    to_delete.append(ioc)
+                    continue
+                description['source'] = ', '.join(sources)
+                to_update[ioc] = json.dumps(description)
+            self.remove_IoCs_of_source(
+                ioc_type, feed_to_delete, to_delete, to_update
+            )
 
     def is_profile_malicious(self, profileid: str) -> str:
         return self.r.hget(profileid, 'labeled_as_malicious') if profileid else False
@@ -449,7 +694,7 @@ class IoCHandler():
             domain_data = json.dumps(domain_data)
             self.rcache.hset('DomainsInfo', domain, domain_data)
             # Publish the changes
-            self.r.publish('dns_info_change', domain)
+            self.send_msg(self.r, 'dns_info_change', domain)
 
     def set_info_for_urls(self, url: str, urldata: dict):
         """
@@ -27,6 +27,13 @@ class ProfileHandler(IObservable):
     """
 
     name = "DB"
+    # when batching is on, profile and tw writes are buffered in memory
+    # and stored using 1 redis pipeline in commit_batch()
+    batching = False
+    # port and ip stats of each tw are stored in flat hashes, the nested
+    # keys of each value are joined using this separator
+    # e.g. '80|dstips|1.1.1.1|pkts'
+    stats_separator = "|"
 
     def __init__(self, logger: Output):
         IObservable.__init__(self)
@@ -54,13 +61,191 @@ class ProfileHandler(IObservable):
             {"from": self.name, "txt": text, "verbose": verbose, "debug": debug}
         )
 
+    def start_batch(self):
+        """
+        Starts buffering the profile and timewindow writes in memory
+        instead of sending each one of them to redis.
+        everything buffered is stored using 1 redis pipeline when
+        commit_batch() is called.
+        used by the profiler to store many flows at once
+        """
+        self.batching = True
+        # counters that don't need to be read before being updated are
+        # queued here directly
+        self.batch_pipe = self.r.pipeline(transaction=True)
+        # {profileid_twid: {field: serialized value}}
+        self.pending_tw_fields: Dict[str, Dict[str, str]] = {}
+        # {(profileid, twid): time of last modification}
+        self.pending_modified_tws: Dict[Tuple[str, str], float] = {}
+        # (channel, msg) in the order they were published
+        self.pending_msgs: List[Tuple[str, str]] = []
+        # profiles and tws that are already registered in the db
+        # by a flow in this batch
+        self.registered_profiles: Set[str] = set()
+        self.registered_tws: Set[Tuple[str, str]] = set()
+        self.batch_file_start: Optional[str] = None
+
+    def is_batching(self) -> bool:
+        return self.batching
+
+    def buffer_msg(self, channel: str, msg: str):
+        """
+        keeps the given msg until the batch is committed, this way
+        modules never receive a msg about data that isn't in the db yet
+        """
+        self.pending_msgs.append((channel, msg))
+
+    def commit_batch(self):
+        """
+        Stores all the buffered profile and tw changes using 1 redis
+        transaction, then sends the msgs published while batching
+        """
+        if not self.batching:
+            return
+
+        modified_tws = self.pending_modified_tws
+        try:
+            pipe = self.batch_pipe
+            for profileid_twid, fields in self.pending_tw_fields.items():
+                pipe.hset(profileid_twid, mapping=fields)
+
+            if modified_tws:
+                pipe.zadd(
+                    "ModifiedTW",
+                    {
+                        f"{profileid}{self.separator}{twid}": ts
+                        for (profileid, twid), ts in modified_tws.items()
+                    },
+                )
+
+            for channel, msg in self.pending_msgs:
+                self.send_msg(pipe, channel, msg)
+
+            # tw_modified is sent once per tw instead of once per flow
+            for profileid, twid in modified_tws:
+                self.send_msg(pipe, "tw_modified", f"{profileid}:{twid}")
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            # the failed batch is dropped, some of its counters may be
+            # stored already and retrying it would count them twice
+            self.print("Problem storing a batch of flows, dropping it.", 0, 1)
+            self.print(traceback.format_exc(), 0, 1)
+            return
+        finally:
+            # whether the batch is stored or not, the writes after it
+            # shouldn't be buffered in it
+            self.batching = False
+            self.pending_tw_fields = {}
+            self.pending_modified_tws = {}
+            self.pending_msgs = []
+
+        if modified_tws:
+            self.check_tw_to_close()
+
+    def get_profile_tw_field(self, profileid_twid: str, field: str):
+        """
+        returns the given field of the given profileid_twid hash,
+        including the changes that aren't committed yet when batching
+        """
+        if self.batching:
+            pending: dict = self.pending_tw_fields.get(profileid_twid, {})
+            if field in pending:
+                return pending[field]
+        return self.r.hget(profileid_twid, field)
+
+    def set_profile_tw_field(self, profileid_twid: str, field: str, value):
+        """
+        sets the given field of the given profileid_twid hash,
+        the change is buffered if we're batching
+        """
+        if self.batching:
+            self.pending_tw_fields.setdefault(
+                profileid_twid, {}
+            )[field] = value
+            return
+        self.r.hset(profileid_twid, field, value)
+
+    def get_write_pipeline(self):
+        """
+        returns the pipeline to queue the profile and tw writes in.
+        when batching, this is the pipeline executed by commit_batch(),
+        otherwise it's a new one that should be passed to
+        execute_write_pipeline()
+        """
+        if self.batching:
+            return self.batch_pipe
+        return self.r.pipeline(transaction=False)
+
+    def execute_write_pipeline(self, pipe):
+        """
+        executes the given pipeline unless it's the batch pipeline,
+        that one is executed when the batch is committed
+        """
+        if not self.batching:
+            pipe.execute()
+
+    def get_profile_tw_stats(self, stats_key: str) -> dict:
+        """
+        rebuilds the nested dict of port or ip stats from the flat hash
+        and the list of uids they're stored in
+        e.g. {'80|totalflows': '2'} and ['80|dstips|1.1.1.1|uid|C1']
+        become {'80': {'totalflows': 2,
+                       'dstips': {'1.1.1.1': {'uid': ['C1']}}}}
+        the counters queued in a batch that isn't committed yet aren't
+        included. they're only read by the detection modules, and those
+        never batch
+        :param stats_key: the key of the flat hash of the stats
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hgetall(stats_key)
+        pipe.lrange(f"{stats_key}{self.separator}uids", 0, -1)
+        fields, uids = pipe.execute()
+
+        stats = {}
+        for path, value in fields.items():
+            *keys, leaf = path.split(self.stats_separator)
+            node = stats
+            for key in keys:
+                node = node.setdefault(key, {})
+            # the start time is the only value that isn't a counter
+            node[leaf] = value if leaf == "stime" else int(value)
+
+        for entry in uids:
+            path, uid = entry.rsplit(self.stats_separator, 1)
+            *keys, leaf = path.split(self.stats_separator)
+            node = stats
+            for key in keys:
+                node = node.setdefault(key, {})
+            node.setdefault(leaf, []).append(uid)
+        return stats
+
+    def get_tuples_from_profile_tw(self, profileid, twid, direction):
+        """
+        returns a json str with all the tuples of the given direction
+        in the given tw, including the ones that aren't committed yet
+        :param direction: 'OutTuples' or 'InTuples'
+        """
+        tuples_key = f"{profileid}{self.separator}{twid}{self.separator}" \
+                     f"{direction}"
+        tuples: dict = self.r.hgetall(tuples_key)
+        if self.batching:
+            tuples.update(self.pending_tw_fields.get(tuples_key, {}))
+        if not tuples:
+            return None
+        return json.dumps(
+            {
+                tupleid: json.loads(tuple_info)
+                for tupleid, tuple_info in tuples.items()
+            }
+        )
+
     def get_outtuples_from_profile_tw(self, profileid, twid):
         """Get the out tuples"""
-        return self.r.hget(profileid + self.separator + twid, "OutTuples")
+        return self.get_tuples_from_profile_tw(profileid, twid, "OutTuples")
 
     def get_intuples_from_profile_tw(self, profileid, twid):
         """Get the in tuples"""
-        return self.r.hget(profileid + self.separator + twid, "InTuples")
+        return self.get_tuples_from_profile_tw(profileid, twid, "InTuples")
 
     def get_dhcp_flows(self, profileid, twid) -> list:
         """
@@ -104,7 +289,7 @@ class ProfileHandler(IObservable):
             tw_start = float(flowtime - (31536000 * 100))
             tw_number: int = 1
         else:
-            starttime_of_first_tw: str = self.r.hget("analysis", "file_start")
+            starttime_of_first_tw: str = self.get_first_flow_time()
 
             if starttime_of_first_tw:
                 starttime_of_first_tw = float(starttime_of_first_tw)
@@ -121,6 +306,12 @@ class ProfileHandler(IObservable):
 
         tw_id: str = f"timewindow{tw_number}"
 
+        if self.batching:
+            if (profileid, tw_id) in self.registered_tws:
+                # a flow in this batch already added this tw
+                return tw_id
+            self.registered_tws.add((profileid, tw_id))
+
         # Add this TW, of this profile, to the DB
         self.add_new_tw(profileid, tw_id, tw_start)
         return tw_id
@@ -331,45 +522,26 @@ class ProfileHandler(IObservable):
         # Get the state. Established, NotEstablished
         summaryState = self.get_final_state_from_flags(state, pkts)
 
-        old_profileid_twid_data = self.get_data_from_profile_tw(
-            profileid, twid, port_type, summaryState, proto, role, "Ports"
-        )
-
-        try:
-            # we already have info about this dport, update it
-            port_data = old_profileid_twid_data[port]
-            port_data["totalflows"] += 1
-            port_data["totalpkt"] += pkts
-            port_data["totalbytes"] += totbytes
-
-            # if there's a conn from this ip on this port, update the pkts of this conn
-            if ip in port_data[ip_key]:
-                port_data[ip_key][ip]["pkts"] += pkts
-                port_data[ip_key][ip]["spkts"] += spkts
-                port_data[ip_key][ip]["uid"].append(uid)
-            else:
-                port_data[ip_key][ip] = {
-                    "pkts": pkts,
-                    "spkts": spkts,
-                    "stime": starttime,
-                    "uid": [uid],
-                }
-
-        except KeyError:
-            # First time for this dport
-            port_data = {
-                "totalflows": 1,
-                "totalpkt": pkts,
-                "totalbytes": totbytes,
-                ip_key: {
-                    ip: {"pkts": pkts, "spkts": spkts, "stime": starttime, "uid": [uid]}
-                },
-            }
-        old_profileid_twid_data[port] = port_data
-        data = json.dumps(old_profileid_twid_data)
-        hash_key = f"{profileid}{self.separator}{twid}"
         key_name = f"{port_type}Ports{role}{proto}{summaryState}"
-        self.r.hset(hash_key, key_name, str(data))
+        stats_key = f"{profileid}{self.separator}{twid}{self.separator}" \
+                    f"{key_name}"
+        sep = self.stats_separator
+        ip_path = f"{port}{sep}{ip_key}{sep}{ip}"
+
+        # the stats are updated in place using counters, no need to read
+        # the old ones first
+        pipe = self.get_write_pipeline()
+        pipe.hincrby(stats_key, f"{port}{sep}totalflows", 1)
+        pipe.hincrby(stats_key, f"{port}{sep}totalpkt", pkts)
+        pipe.hincrby(stats_key, f"{port}{sep}totalbytes", totbytes)
+        pipe.hincrby(stats_key, f"{ip_path}{sep}pkts", pkts)
+        pipe.hincrby(stats_key, f"{ip_path}{sep}spkts", int(spkts))
+        # only the first time this ip used this port is kept
+        pipe.hsetnx(stats_key, f"{ip_path}{sep}stime", starttime)
+        pipe.rpush(
+            f"{stats_key}{self.separator}uids", f"{ip_path}{sep}uid{sep}{uid}"
+        )
+        self.execute_write_pipeline(pipe)
         self.mark_profile_tw_as_modified(profileid, twid, starttime)
 
     def get_final_state_from_flags(self, state, pkts):
@@ -538,10 +710,12 @@ class ProfileHandler(IObservable):
             # Not Establihed]
             # Example: key_name = 'SrcPortClientTCPEstablished'
             key = direction + type_data + role + protocol.upper() + state
-            data = self.r.hget(f"{profileid}{self.separator}{twid}", key)
+            data: dict = self.get_profile_tw_stats(
+                f"{profileid}{self.separator}{twid}{self.separator}{key}"
+            )
 
             if data:
-                return json.loads(data)
+                return data
 
             self.print(
                 f"There is no data for Key: {key}. Profile {profileid} TW {twid}",
@@ -556,79 +730,46 @@ class ProfileHandler(IObservable):
             )
             self.print(traceback.format_exc(), 0, 1)
 
-    def update_ip_info(
-        self,
-        old_profileid_twid_data: dict,
-        pkts,
-        dport,
-        spkts,
-        totbytes,
-        ip,
-        starttime,
-        uid,
-    ) -> dict:
+    def update_ip_info(self, pipe, stats_key: str, ip: str, flow):
         """
         #  Updates how many times each individual DstPort was contacted,
         the total flows sent by this ip and their uids,
         the total packets sent by this ip,
         and total bytes sent by this ip
-        """
-        dport = str(dport)
-        spkts = int(spkts)
-        pkts = int(pkts)
-        totbytes = int(totbytes)
-        if ip in old_profileid_twid_data:
-            # update info about an existing ip
-            ip_data = old_profileid_twid_data[ip]
-            ip_data["totalflows"] += 1
-            ip_data["totalpkt"] += pkts
-            ip_data["totalbytes"] += totbytes
-            ip_data["uid"].append(uid)
-
-            ip_data["dstports"]: dict
-
-            if dport in ip_data["dstports"]:
-                ip_data["dstports"][dport] += spkts
-            else:
-                ip_data["dstports"].update({dport: spkts})
-        else:
-            # First time seeing this ip
-            ip_data = {
-                "totalflows": 1,
-                "totalpkt": pkts,
-                "totalbytes": totbytes,
-                "stime": starttime,
-                "uid": [uid],
-                "dstports": {dport: spkts},
-            }
-        old_profileid_twid_data.update({ip: ip_data})
-
-        return old_profileid_twid_data
+        :param pipe: the pipeline to queue the updates in
+        :param stats_key: the key of the flat hash of the ip stats
+        """
+        sep = self.stats_separator
+        pipe.hincrby(stats_key, f"{ip}{sep}totalflows", 1)
+        pipe.hincrby(stats_key, f"{ip}{sep}totalpkt", int(flow.pkts))
+        pipe.hincrby(stats_key, f"{ip}{sep}totalbytes", int(flow.bytes))
+        # only the first time we saw this ip is kept
+        pipe.hsetnx(stats_key, f"{ip}{sep}stime", str(flow.starttime))
+        pipe.hincrby(
+            stats_key, f"{ip}{sep}dstports{sep}{flow.dport}", int(flow.spkts)
+        )
+        pipe.rpush(
+            f"{stats_key}{self.separator}uids", f"{ip}{sep}uid{sep}{flow.uid}"
+        )
 
-    def update_times_contacted(self, ip, direction, profileid, twid):
+    def update_times_contacted(self, ip, direction, profileid, twid, pipe=None):
         """
         :param ip: the ip that we want to update the times we contacted
+        :param pipe: the pipeline to queue the update in, if not given
+        the update is stored right away
         """
+        # The DstIPs of this tw in this profile are stored as
+        # {'1.1.1.1' :  3}
+        ips_contacted_key = (
+            f"{profileid}{self.separator}{twid}{self.separator}{direction}IPs"
+        )
+        if pipe:
+            pipe.hincrby(ips_contacted_key, ip, 1)
+            return
 
-        # Get the hash of the timewindow
-        profileid_twid = f"{profileid}{self.separator}{twid}"
-
-        # Get the DstIPs data for this tw in this profile
-        # The format is {'1.1.1.1' :  3}
-        ips_contacted = self.r.hget(profileid_twid, f"{direction}IPs")
-        if not ips_contacted:
-            ips_contacted = {}
-
-        try:
-            ips_contacted = json.loads(ips_contacted)
-            # Add 1 because we found this ip again
-            ips_contacted[ip] += 1
-        except (TypeError, KeyError):
-            # There was no previous data stored in the DB
-            ips_contacted[ip] = 1
-
-        ips_contacted = json.dumps(ips_contacted)
-        self.r.hset(profileid_twid, f"{direction}IPs", str(ips_contacted))
+        pipe = self.get_write_pipeline()
+        pipe.hincrby(ips_contacted_key, ip, 1)
+        self.execute_write_pipeline(pipe)
 
     def add_ips(self, profileid, twid, flow, role):
         """
@@ -695,38 +836,17 @@ class ProfileHandler(IObservable):
                 "dstip",
             )
 
-        self.update_times_contacted(ip, direction, profileid, twid)
+        pipe = self.get_write_pipeline()
+        self.update_times_contacted(ip, direction, profileid, twid, pipe=pipe)
 
         # Get the state. Established, NotEstablished
         summaryState = self.get_final_state_from_flags(flow.state, flow.pkts)
         key_name = f"{direction}IPs{role}{flow.proto.upper()}{summaryState}"
-        # Get the previous data about this key
-        old_profileid_twid_data = self.get_data_from_profile_tw(
-            profileid,
-            twid,
-            direction,
-            summaryState,
-            flow.proto,
-            role,
-            "IPs",
-        )
-        profileid_twid_data: dict = self.update_ip_info(
-            old_profileid_twid_data,
-            flow.pkts,
-            flow.dport,
-            flow.spkts,
-            flow.bytes,
-            ip,
-            starttime,
-            uid,
-        )
-
-        # Store this data in the profile hash
-        self.r.hset(
-            f"{profileid}{self.separator}{twid}",
-            key_name,
-            json.dumps(profileid_twid_data),
+        stats_key = (
+            f"{profileid}{self.separator}{twid}{self.separator}{key_name}"
         )
+        self.update_ip_info(pipe, stats_key, ip, flow)
+        self.execute_write_pipeline(pipe)
         return True
 
     def get_all_contacted_ips_in_profileid_twid(self, profileid, twid) -> dict:
@@ -825,11 +945,6 @@ class ProfileHandler(IObservable):
         }
         to_send = json.dumps(to_send)
 
-        # set the pcap/file stime in the analysis key
-        if self.first_flow:
-            self.set_input_metadata({"file_start": flow.starttime})
-            self.first_flow = False
-
         # dont send arp flows in this channel, they have their own new_arp channel
         if flow.type_ != "arp":
             self.publish("new_flow", to_send)
@@ -1034,16 +1149,10 @@ class ProfileHandler(IObservable):
             # Verify that the SNI is equal to any of the domains in the DNS
             # resolution
             # only add this SNI to our db if it has a DNS resolution
-            if dns_resolutions := self.r.hgetall("DNSresolution"):
-                # dns_resolutions is a dict with {ip:{'ts'..,'domains':...,
-                # 'uid':..}}
-                for ip, resolution in dns_resolutions.items():
-                    resolution = json.loads(resolution)
-                    if SNI_port["server_name"] in resolution["domains"]:
-                        # add SNI to our db as it has a DNS resolution
-                        sni_ipdata.append(SNI_port)
-                        self.setInfoForIPs(flow.daddr, {"SNI": sni_ipdata})
-                        break
+            if self.r.hexists("DomainsResolved", SNI_port["server_name"]):
+                # add SNI to our db as it has a DNS resolution
+                sni_ipdata.append(SNI_port)
+                self.setInfoForIPs(flow.daddr, {"SNI": sni_ipdata})
 
     def get_profileid_from_ip(self, ip: str) -> Optional[str]:
         """
@@ -1083,33 +1192,45 @@ class ProfileHandler(IObservable):
         """
         return len(self.getTWsfromProfile(profileid)) if profileid else 0
 
+    def get_ips_contacted_from_profile_tw(self, profileid, twid, direction):
+        """
+        returns a json str with how many times each ip was contacted in
+        the given tw. e.g. '{"1.1.1.1": 3}'
+        :param direction: 'Src' or 'Dst'
+        """
+        ips_contacted: dict = self.r.hgetall(
+            f"{profileid}{self.separator}{twid}{self.separator}{direction}IPs"
+        )
+        if not ips_contacted:
+            return None
+        return json.dumps(
+            {ip: int(times) for ip, times in ips_contacted.items()}
+        )
+
     def get_srcips_from_profile_tw(self, profileid, twid):
         """
         Get the src ip for a specific TW for a specific profileid
         """
-        return self.r.hget(profileid + self.separator + twid, "SrcIPs")
+        return self.get_ips_contacted_from_profile_tw(profileid, twid, "Src")
 
     def get_dstips_from_profile_tw(self, profileid, twid):
         """
         Get the dst ip for a specific TW for a specific profileid
         """
-        return self.r.hget(profileid + self.separator + twid, "DstIPs")
+        return self.get_ips_contacted_from_profile_tw(profileid, twid, "Dst")
 
     def get_t2_for_profile_tw(self, profileid, twid, tupleid, tuple_key: str):
         """
         Get T1 and the previous_time for this previous_time, twid and tupleid
         """
         try:
-            hash_id = profileid + self.separator + twid
-            data = self.r.hget(hash_id, tuple_key)
+            tuples_key = f"{profileid}{self.separator}{twid}" \
+                         f"{self.separator}{tuple_key}"
+            data = self.get_profile_tw_field(tuples_key, tupleid)
             if not data:
                 return False, False
-            data = json.loads(data)
-            try:
-                (_, previous_two_timestamps) = data[tupleid]
-                return previous_two_timestamps
-            except KeyError:
-                return False, False
+            (_, previous_two_timestamps) = json.loads(data)
+            return previous_two_timestamps
         except Exception as e:
             exception_line = sys.exc_info()[2].tb_lineno
             self.print(
@@ -1513,7 +1634,21 @@ class ProfileHandler(IObservable):
         if not is_dhcp_set:
             self.r.hset(profileid, "dhcp", "true")
 
+    def set_first_flow_time(self, starttime):
+        """
+        sets the pcap/file stime in the analysis key.
+        only the first call sets it, the timewindows of all profiles
+        are numbered starting from it
+        """
+        self.r.hsetnx("analysis", "file_start", starttime)
+
     def get_first_flow_time(self) -> Optional[str]:
+        if self.batching:
+            # the start of the first flow never changes once it's set,
+            # no need to ask redis for it on every flow of the batch
+            if not self.batch_file_start:
+                self.batch_file_start = self.r.hget("analysis", "file_start")
+            return self.batch_file_start
         return self.r.hget("analysis", "file_start")
 
     def add_profile(self, profileid, starttime, duration):
@@ -1526,6 +1661,12 @@ class ProfileHandler(IObservable):
         Nothing operational
         """
         try:
+            if self.batching:
+                if profileid in self.registered_profiles:
+                    # a flow in this batch already added this profile
+                    return False
+                self.registered_profiles.add(profileid)
+
             if self.r.sismember("profiles", profileid):
                 # we already have this profile
                 return False
@@ -1607,6 +1748,7 @@ class ProfileHandler(IObservable):
         """
         self.r.sadd("ClosedTW", profileid_tw)
         self.r.zrem("ModifiedTW", profileid_tw)
+        self.mark_tw_for_archiving(profileid_tw)
         self.publish("tw_closed", profileid_tw)
 
     def mark_profile_tw_as_modified(self, profileid, twid, timestamp):
@@ -1620,6 +1762,12 @@ class ProfileHandler(IObservable):
         4- To check if we should 'close' some TW
         """
         timestamp = time.time()
+        if self.batching:
+            # ModifiedTW is updated, and tw_modified is published once
+            # per tw when the batch is committed
+            self.pending_modified_tws[(profileid, twid)] = float(timestamp)
+            return
+
         data = {f"{profileid}{self.separator}{twid}": float(timestamp)}
         self.r.zadd("ModifiedTW", data)
         self.publish("tw_modified", f"{profileid}:{twid}")
@@ -1688,16 +1836,17 @@ class ProfileHandler(IObservable):
             direction = "InTuples"
 
         try:
-            profileid_twid = f"{profileid}{self.separator}{twid}"
-
-            # prev_symbols is a dict with {tulpeid: ['symbols_so_far',
-            # [timestamps]]}
-            prev_symbols: str = self.r.hget(profileid_twid, direction) or "{}"
-            prev_symbols: dict = json.loads(prev_symbols)
+            # each tuple is stored in its own field of this hash as
+            # ['symbols_so_far', [timestamps]]
+            tuples_key = f"{profileid}{self.separator}{twid}" \
+                         f"{self.separator}{direction}"
+            prev_symbols: Optional[str] = self.get_profile_tw_field(
+                tuples_key, tupleid
+            )
 
             try:
                 # Get the last symbols of letters in the DB
-                prev_symbol: str = prev_symbols[tupleid][0]
+                prev_symbol: str = json.loads(prev_symbols)[0]
 
                 # Separate the symbol to add and the previous data
                 (symbol_to_add, previous_two_timestamps) = symbol
@@ -1716,7 +1865,7 @@ class ProfileHandler(IObservable):
 
                 self.publish_new_letter(new_symbol, profileid, twid, tupleid, flow)
 
-                prev_symbols[tupleid] = (new_symbol, previous_two_timestamps)
+                tuple_info = (new_symbol, previous_two_timestamps)
                 self.print(
                     f"\tLetters so far for tuple {tupleid}:" f" {new_symbol}", 3, 0
                 )
@@ -1731,10 +1880,11 @@ class ProfileHandler(IObservable):
                     3,
                     0,
                 )
-                prev_symbols[tupleid] = symbol
+                tuple_info = symbol
 
-            prev_symbols = json.dumps(prev_symbols)
-            self.r.hset(profileid_twid, direction, prev_symbols)
+            self.set_profile_tw_field(
+                tuples_key, tupleid, json.dumps(tuple_info)
+            )
             self.mark_profile_tw_as_modified(profileid, twid, flow.starttime)
 
         except Exception:
@@ -1764,7 +1914,9 @@ class ProfileHandler(IObservable):
         key = str(profileid + self.separator + twid + self.separator + "timeline")
         data = json.dumps(data)
         mapping = {data: timestamp}
-        self.r.zadd(key, mapping)
+        pipe = self.get_write_pipeline()
+        pipe.zadd(key, mapping)
+        self.execute_write_pipeline(pipe)
         # Mark the tw as modified since the timeline line is new data in the TW
         self.mark_profile_tw_as_modified(profileid, twid, timestamp="")
 
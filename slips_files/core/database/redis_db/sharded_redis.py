@@ -0,0 +1,278 @@
+import re
+import zlib
+from itertools import chain
+from typing import (
+    Dict,
+    List,
+    Optional,
+    )
+
+import redis
+
+
+class ShardedRedis:
+    """
+    Redis client that spreads the keys of the profiles over several redis
+    servers (shards) and keeps all the other keys (IoCs, whitelist,
+    analysis metadata, pub/sub, etc.) in the main server.
+
+    All the keys of the same profile (profile_<ip>, profile_<ip>_timewindow*,
+    tws<profileid>) are in the same shard, chosen by hashing the profileid,
+    so the commands, pipelines and transactions about 1 profile always run
+    in 1 server.
+
+    It has the same interface as redis.StrictRedis, every command is
+    sent to the server of its key.
+    """
+
+    # the profileid a key belongs to, if any
+    profile_key = re.compile(r'^(?:tws)?(profile_[^_]+)')
+    # commands that don't have a key and are sent to the main server only
+    main_commands = {
+        'publish',
+        'pubsub',
+        'info',
+        'client_list',
+        'client_setname',
+        'ping',
+        'time',
+        'pubsub_channels',
+        'pubsub_numsub',
+    }
+    # commands that are sent to all the servers, the result of the main
+    # server is returned
+    all_commands = {
+        'flushdb',
+        'flushall',
+        'script_flush',
+        'config_set',
+        'save',
+        'bgsave',
+    }
+    # commands that take many keys and return the number of keys affected
+    multi_key_commands = {'delete', 'exists', 'unlink', 'touch'}
+
+    def __init__(self, main: redis.StrictRedis, shards: List[redis.StrictRedis]):
+        self.main = main
+        self.shards = shards
+        self.nodes: List[redis.StrictRedis] = [main, *shards]
+
+    def get_node_index(self, key) -> int:
+        """returns the index of the server the given key is stored in"""
+        if (
+                isinstance(key, str)
+                and (match := self.profile_key.match(key))
+        ):
+            profile = match.group(1).encode()
+            return 1 + zlib.crc32(profile) % len(self.shards)
+        return 0
+
+    def get_node(self, key) -> redis.StrictRedis:
+        return self.nodes[self.get_node_index(key)]
+
+    @staticmethod
+    def get_key(args: tuple, kwargs: dict):
+        if args:
+            return args[0]
+        return kwargs.get('name', kwargs.get('key'))
+
+    def group_keys(self, keys) -> Dict[int, list]:
+        """returns {index of the server: [keys stored in it]}"""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_node_index(key), []).append(key)
+        return groups
+
+    def __getattr__(self, command: str):
+        # only called the first time a command is used, the function that
+        # runs it is cached in the instance
+        run = self.get_command(command)
+        setattr(self, command, run)
+        return run
+
+    def get_command(self, command: str):
+        if (
+                command in self.main_commands
+                or not callable(getattr(self.main, command))
+        ):
+            return getattr(self.main, command)
+
+        if command in self.all_commands:
+            def run_in_all_nodes(*args, **kwargs):
+                results = [
+                    getattr(node, command)(*args, **kwargs)
+                    for node in self.nodes
+                ]
+                return results[0]
+            return run_in_all_nodes
+
+        if command in self.multi_key_commands:
+            def run_in_nodes_of_keys(*keys):
+                return sum(
+                    getattr(self.nodes[i], command)(*node_keys)
+                    for i, node_keys in self.group_keys(keys).items()
+                )
+            return run_in_nodes_of_keys
+
+        def run_in_node_of_key(*args, **kwargs):
+            node = self.get_node(self.get_key(args, kwargs))
+            return getattr(node, command)(*args, **kwargs)
+        return run_in_node_of_key
+
+    def dbsize(self) -> int:
+        return sum(node.dbsize() for node in self.nodes)
+
+    def keys(self, pattern='*', **kwargs) -> list:
+        return list(
+            chain.from_iterable(
+                node.keys(pattern, **kwargs) for node in self.nodes
+            )
+        )
+
+    def scan_iter(self, *args, **kwargs):
+        for node in self.nodes:
+            yield from node.scan_iter(*args, **kwargs)
+
+    def mget(self, keys, *args) -> list:
+        keys = list(keys) + list(args)
+        values = {}
+        for i, node_keys in self.group_keys(keys).items():
+            values.update(zip(node_keys, self.nodes[i].mget(node_keys)))
+        return [values[key] for key in keys]
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+
+class ShardedPipeline:
+    """
+    Pipeline of a ShardedRedis client. The commands are queued in 1
+    pipeline per server and the results are returned in the order the
+    commands were queued.
+
+    Transactions are atomic per server, not across servers. When the
+    pipeline is executed, the pipeline of the watched server runs first
+    and the one of the main server runs last, so the msgs published in
+    a pipeline are sent after the data of the profiles it's about
+    is stored.
+    """
+
+    def __init__(self, client: ShardedRedis, transaction: bool):
+        self.client = client
+        self.transaction = transaction
+        # {index of the server: its pipeline}
+        self.pipes: Dict[int, redis.client.Pipeline] = {}
+        # [(index of the server, or a tuple of indexes if it was sent to
+        # many servers, command)] of each queued command
+        self.queued: List[tuple] = []
+        # index of the server whose keys are watched
+        self.watched: Optional[int] = None
+        self.watching = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.queued)
+
+    def get_pipe(self, index: int):
+        if index not in self.pipes:
+            self.pipes[index] = self.client.nodes[index].pipeline(
+                transaction=self.transaction
+            )
+        return self.pipes[index]
+
+    def watch(self, *keys):
+        """
+        watches the given keys, they should all be stored in the
+        same server, e.g. keys of the same profile
+        """
+        indexes = set(self.client.group_keys(keys))
+        if len(indexes) > 1:
+            raise redis.RedisError(
+                'Keys of different shards can not be watched at once'
+            )
+        self.watched = indexes.pop() if indexes else 0
+        self.watching = True
+        return self.get_pipe(self.watched).watch(*keys)
+
+    def multi(self):
+        self.watching = False
+        if self.watched is not None:
+            self.get_pipe(self.watched).multi()
+
+    def queue(self, index: int, command: str, *args, **kwargs):
+        if self.watching:
+            # like redis pipelines, commands run immediately
+            # until multi() is called
+            if index == self.watched:
+                node = self.get_pipe(index)
+            else:
+                node = self.client.nodes[index]
+            return getattr(node, command)(*args, **kwargs)
+
+        getattr(self.get_pipe(index), command)(*args, **kwargs)
+        self.queued.append((index, command))
+        return self
+
+    def __getattr__(self, command: str):
+        client = self.client
+        if command in client.main_commands:
+            return lambda *args, **kwargs: self.queue(
+                0, command, *args, **kwargs
+            )
+
+        if command in client.multi_key_commands:
+            def queue_in_nodes_of_keys(*keys):
+                groups = client.group_keys(keys)
+                if len(groups) == 1:
+                    index, node_keys = groups.popitem()
+                    return self.queue(index, command, *node_keys)
+                # the results of the servers are added together when
+                # executing the pipeline
+                for index, node_keys in groups.items():
+                    getattr(self.get_pipe(index), command)(*node_keys)
+                self.queued.append((tuple(groups), command))
+                return self
+            return queue_in_nodes_of_keys
+
+        def queue_in_node_of_key(*args, **kwargs):
+            index = client.get_node_index(client.get_key(args, kwargs))
+            return self.queue(index, command, *args, **kwargs)
+        return queue_in_node_of_key
+
+    def execute(self, raise_on_error=True) -> list:
+        order = sorted(
+            self.pipes,
+            key=lambda index: (index != self.watched, index == 0)
+        )
+        results = {}
+        try:
+            for index in order:
+                results[index] = iter(
+                    self.pipes[index].execute(raise_on_error=raise_on_error)
+                )
+        finally:
+            queued = self.queued
+            self.reset()
+
+        ordered_results = []
+        for index, _ in queued:
+            if isinstance(index, tuple):
+                ordered_results.append(
+                    sum(next(results[i]) for i in index)
+                )
+            else:
+                ordered_results.append(next(results[index]))
+        return ordered_results
+
+    def reset(self):
+        for pipe in self.pipes.values():
+            pipe.reset()
+        self.pipes = {}
+        self.queued = []
+        self.watched = None
+        self.watching = False
@@ -0,0 +1,135 @@
+from collections import deque
+from typing import (
+    Deque,
+    Dict,
+    List,
+    Optional,
+    )
+
+import redis
+
+
+class StreamConsumer:
+    """
+    Reads the msgs of the redis streams a subscriber (e.g. a module) is
+    subscribed to, using 1 consumer group per subscriber so every
+    subscriber gets every msg.
+
+    All the streams that have no buffered msgs are read at once with
+    XREADGROUP, up to batch_size msgs per stream. get_message() never
+    blocks, when none of the channels of the subscriber had msgs, wait()
+    blocks for up to block_time seconds instead of polling redis in a loop.
+    The msgs returned by get_message() are acknowledged with the next read.
+    """
+
+    def __init__(
+            self,
+            client,
+            group: str,
+            batch_size: int = 100,
+            block_time: float = 0.1,
+    ):
+        self.client = client
+        self.group = group
+        self.batch_size = batch_size
+        self.block_time = block_time
+        # {stream key: channel}
+        self.channels: Dict[str, str] = {}
+        # {channel: msgs read but not returned by get_message() yet}
+        self.buffers: Dict[str, Deque[dict]] = {}
+        # {stream key: ids of the msgs returned by get_message()}
+        self.to_ack: Dict[str, List[str]] = {}
+
+    def subscribe(self, stream: str, channel: str) -> 'StreamSubscription':
+        try:
+            self.client.xgroup_create(stream, self.group, id='$', mkstream=True)
+        except redis.exceptions.ResponseError as ex:
+            # the group already exists
+            if 'BUSYGROUP' not in str(ex):
+                raise
+        self.channels[stream] = channel
+        self.buffers[channel] = deque()
+        return StreamSubscription(self, channel)
+
+    def read(self, timeout: float):
+        """
+        reads the msgs of all the streams that have no buffered msgs
+        :param timeout: how long to block if none of them has msgs
+        """
+        streams = {
+            stream: '>'
+            for stream, channel in self.channels.items()
+            if not self.buffers[channel]
+        }
+        if not streams:
+            return
+
+        # BLOCK 0 means waiting forever
+        block = int(timeout * 1000) or None
+
+        pipe = self.client.pipeline(transaction=False)
+        for stream, ids in self.to_ack.items():
+            if ids:
+                pipe.xack(stream, self.group, *ids)
+        pipe.xreadgroup(
+            self.group,
+            self.group,
+            streams,
+            count=self.batch_size,
+            block=block,
+        )
+        read: Optional[list] = pipe.execute()[-1]
+        self.to_ack = {}
+
+        for stream, msgs in read or []:
+            channel = self.channels[stream]
+            for msg_id, fields in msgs:
+                self.buffers[channel].append(
+                    {
+                        'type': 'message',
+                        'pattern': None,
+                        'channel': channel,
+                        'data': fields.get('data'),
+                        'id': msg_id,
+                        'stream': stream,
+                    }
+                )
+
+    def wait(self):
+        """
+        blocks for up to block_time until any of the streams has msgs.
+        called by the subscriber once per loop when none of its channels
+        had msgs, the msgs read are returned by the next get_message()
+        """
+        if any(self.buffers.values()):
+            return
+        self.read(self.block_time)
+
+    def get_message(self, channel: str, timeout: float = 0.0) -> Optional[dict]:
+        """
+        returns the next msg of the given channel in the same format
+        redis pubsub msgs have, or None if there's none
+        """
+        buffer = self.buffers[channel]
+        if not buffer:
+            self.read(timeout)
+        if not buffer:
+            return None
+
+        msg = buffer.popleft()
+        self.to_ack.setdefault(msg['stream'], []).append(msg['id'])
+        return msg
+
+
+class StreamSubscription:
+    """
+    Subscription to 1 channel sent using redis streams, has the
+    get_message() of the redis pubsub objects returned by subscribe()
+    """
+
+    def __init__(self, consumer: StreamConsumer, channel: str):
+        self.consumer = consumer
+        self.channel = channel
+
+    def get_message(self, timeout: float = 0.0, **kwargs) -> Optional[dict]:
+        return self.consumer.get_message(self.channel, timeout=timeout)
@@ -0,0 +1,237 @@
+import re
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+    )
+
+import redis
+
+
+class TWArchiveHandler:
+    """
+    Helper class for the Redis class in database.py
+    Contains all the logic related to moving the data of closed timewindows
+    out of redis to the archive (the sqlite db), and restoring it when
+    it's needed again
+    """
+    name = 'DB'
+    # all the keys of a tw start with its profileid_twid
+    # e.g. profile_1.1.1.1_timewindow1_OutTuples
+    tw_key_pattern = re.compile(r'^(profile_[^_]+_timewindow\d+)(?:_|$)')
+
+    def is_tw_archiving_enabled(self) -> bool:
+        return self.archive_closed_tws_after >= 0
+
+    def mark_tw_for_archiving(self, profileid_twid: str, pipe=None):
+        """
+        the given tw is archived once archive_closed_tws_after seconds
+        pass without it being modified
+        """
+        if not self.is_tw_archiving_enabled():
+            return
+        client = pipe or self.r
+        client.zadd('TWsToArchive', {profileid_twid: time.time()})
+
+    def get_tws_to_archive(self) -> List[str]:
+        """
+        returns the tws that were closed more than
+        archive_closed_tws_after seconds ago and weren't modified since
+        """
+        if not self.is_tw_archiving_enabled():
+            return []
+        tws = self.r.zrangebyscore(
+            'TWsToArchive', 0, time.time() - self.archive_closed_tws_after
+        )
+        if not tws:
+            return []
+
+        # tws that got new flows after they were closed are archived once
+        # they're closed again
+        pipe = self.r.pipeline(transaction=False)
+        for profileid_twid in tws:
+            pipe.zscore('ModifiedTW', profileid_twid)
+        return [
+            profileid_twid
+            for profileid_twid, modified in zip(tws, pipe.execute())
+            if modified is None
+        ]
+
+    def get_keys_of_tws(self, profileid_twids: List[str]) -> Dict[str, list]:
+        """
+        returns all the keys of the given tws, found by going through the
+        keys of all the tws once
+        {profileid_twid: [keys]}
+        """
+        profileid_twids = set(profileid_twids)
+        keys = {profileid_twid: [] for profileid_twid in profileid_twids}
+        for key in self.r.scan_iter(match='profile_*_timewindow*', count=10000):
+            if (
+                    (match := self.tw_key_pattern.match(key))
+                    and match.group(1) in profileid_twids
+            ):
+                keys[match.group(1)].append(key)
+        return keys
+
+    def get_keys_of_tw(self, profileid_twid: str) -> List[str]:
+        """returns all the keys of the given tw"""
+        return [
+            key
+            for key in self.r.scan_iter(match=f'{profileid_twid}*', count=10000)
+            if (
+                    (match := self.tw_key_pattern.match(key))
+                    and match.group(1) == profileid_twid
+            )
+        ]
+
+    @staticmethod
+    def export_keys(client, keys: List[str]) -> Dict[str, list]:
+        """
+        reads the given keys, whatever their type is
+        returns {key: [type, value]}
+        """
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        types = pipe.execute()
+
+        readers = {
+            'hash': lambda key: pipe.hgetall(key),
+            'zset': lambda key: pipe.zrange(key, 0, -1, withscores=True),
+            'list': lambda key: pipe.lrange(key, 0, -1),
+            'set': lambda key: pipe.smembers(key),
+            'string': lambda key: pipe.get(key),
+        }
+        exported_keys = [
+            (key, key_type)
+            for key, key_type in zip(keys, types)
+            if key_type in readers
+        ]
+        for key, key_type in exported_keys:
+            readers[key_type](key)
+
+        exported = {}
+        for (key, key_type), value in zip(exported_keys, pipe.execute()):
+            if key_type == 'set':
+                value = list(value)
+            exported[key] = [key_type, value]
+        return exported
+
+    @staticmethod
+    def import_keys(pipe, exported: Dict[str, list]):
+        """
+        queues writing back the keys returned by export_keys() in the
+        given pipeline, replacing them if they exist
+        """
+        for key, (key_type, value) in exported.items():
+            pipe.delete(key)
+            if not value:
+                continue
+            if key_type == 'hash':
+                pipe.hset(key, mapping=value)
+            elif key_type == 'zset':
+                pipe.zadd(key, dict(value))
+            elif key_type == 'list':
+                pipe.rpush(key, *value)
+            elif key_type == 'set':
+                pipe.sadd(key, *value)
+            elif key_type == 'string':
+                pipe.set(key, value)
+
+    @staticmethod
+    def merge_exported(
+            old: Dict[str, list], new: Dict[str, list]
+    ) -> Dict[str, list]:
+        """
+        merges the keys of a tw that was archived before with the ones
+        that were added to redis after archiving it
+        """
+        merged = dict(old)
+        for key, (key_type, value) in new.items():
+            if key not in merged or merged[key][0] != key_type:
+                merged[key] = [key_type, value]
+                continue
+
+            old_value = merged[key][1]
+            if key_type == 'hash':
+                value = {**old_value, **value}
+            elif key_type == 'zset':
+                value = list({**dict(old_value), **dict(value)}.items())
+            elif key_type == 'list':
+                value = old_value + value
+            elif key_type == 'set':
+                value = list(set(old_value) | set(value))
+            merged[key] = [key_type, value]
+        return merged
+
+    def archive_tw(
+            self, profileid_twid: str, keys: List[str], store: Callable
+    ) -> bool:
+        """
+        Reads all the given keys of the given tw, calls store(profileid_twid,
+        exported keys) to archive them, and deletes them from redis
+        returns False if the tw was modified while archiving it or store()
+        failed, its keys are kept in redis and it's archived the next time
+        """
+        with self.r.pipeline(transaction=True) as pipe:
+            try:
+                if keys:
+                    pipe.watch(*keys)
+                exported = self.export_keys(self.r, keys)
+                # keys created after listing the keys of the tw aren't
+                # watched, they'd be left behind in redis
+                if set(self.get_keys_of_tw(profileid_twid)) - set(keys):
+                    return False
+                if not store(profileid_twid, exported):
+                    return False
+
+                pipe.multi()
+                if keys:
+                    pipe.delete(*keys)
+                pipe.sadd('ArchivedTW', profileid_twid)
+                pipe.zrem('TWsToArchive', profileid_twid)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def is_tw_archived(self, profileid_twid: str) -> bool:
+        return bool(self.r.sismember('ArchivedTW', profileid_twid))
+
+    def restore_tw(
+            self, profileid_twid: str, exported: Dict[str, list]
+    ) -> bool:
+        """
+        Writes back the given archived keys of the given tw to redis,
+        merged with the keys the tw got after it was archived.
+        the tw is archived again if it's not used for
+        archive_closed_tws_after seconds
+        returns False if the tw kept being modified while restoring it
+        """
+        for trial in range(3):
+            with self.r.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch('ArchivedTW')
+                    if not pipe.sismember('ArchivedTW', profileid_twid):
+                        # restored by another process
+                        return True
+
+                    keys: List[str] = self.get_keys_of_tw(profileid_twid)
+                    # the archived keys are watched too, creating one of
+                    # them now would be overwritten by the restored one
+                    if to_watch := set(keys) | set(exported):
+                        pipe.watch(*to_watch)
+                    merged = self.merge_exported(
+                        exported, self.export_keys(self.r, keys)
+                    )
+
+                    pipe.multi()
+                    self.import_keys(pipe, merged)
+                    pipe.srem('ArchivedTW', profileid_twid)
+                    self.mark_tw_for_archiving(profileid_twid, pipe=pipe)
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+        return False
@@ -1,5 +1,8 @@
 from typing import List, \
-    Dict
+    Dict, \
+    Iterator, \
+    Callable, \
+    Tuple
 import os.path
 import sqlite3
 import json
@@ -15,7 +18,42 @@ class SQLiteDB(IObservable):
     name = "SQLiteDB"
     # used to lock each call to commit()
     cursor_lock = Lock()
-    trial = 0
+    # WAL lets the modules read the db while the profiler writes to it,
+    # and with it, NORMAL syncs to disk once per checkpoint instead of
+    # once per commit
+    pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # in KiB when negative
+        'cache_size': -64000,
+        'temp_store': 'MEMORY',
+    }
+    # version of the tables, stored in the db. dbs created by older
+    # versions are migrated when slips connects to them
+    schema_version = 2
+    # (column, field of the flow it's filled from, type) of the flows
+    # table, used to query the flows without parsing them. only add the
+    # fields a query reads, they're written for every flow
+    flow_columns = (
+        ('ts', 'starttime', 'REAL'),
+        ('daddr', 'daddr', 'TEXT'),
+        ('sbytes', 'sbytes', 'INTEGER'),
+    )
+    indexes = {
+        'flows_profileid_twid': 'flows (profileid, twid)',
+        'altflows_profileid_twid': 'altflows (profileid, twid)',
+    }
+    # columns of the flows that are exported
+    exported_columns = ['uid', 'flow', 'label', 'profileid', 'twid']
+    add_flow_query = (
+        'INSERT OR REPLACE INTO flows (profileid, twid, uid, flow, label, aid, '
+        f'{", ".join(column for column, _, _ in flow_columns)}) '
+        f'VALUES ({", ".join("?" * (6 + len(flow_columns)))});'
+    )
+    add_altflow_query = (
+        'INSERT OR REPLACE INTO altflows (profileid, twid, uid, flow, label, flow_type) '
+        'VALUES (?, ?, ?, ?, ?, ?);'
+    )
 
     def __init__(self,
                  logger: Output,
@@ -24,6 +62,11 @@ class SQLiteDB(IObservable):
         self.logger = logger
         self.add_observer(self.logger)
         self._flows_db = os.path.join(output_dir, 'flows.sqlite')
+        # when True, the flows are queued and written using 1
+        # transaction when commit_batch() is called
+        self.batching = False
+        # {query: [params of each row]}
+        self.pending_rows: Dict[str, List[tuple]] = {}
         self.connect()
 
     def connect(self):
@@ -40,9 +83,13 @@ class SQLiteDB(IObservable):
         self.conn = sqlite3.connect(self._flows_db, check_same_thread=False, timeout=20)
 
         self.cursor = self.conn.cursor()
+        for pragma, value in self.pragmas.items():
+            self.cursor.execute(f'PRAGMA {pragma}={value}')
         if db_newly_created:
             # only init tables if the db is newly created
             self.init_tables()
+        else:
+            self.migrate()
 
     def get_number_of_tables(self):
         """
@@ -55,13 +102,59 @@ class SQLiteDB(IObservable):
 
     def init_tables(self):
         """creates the tables we're gonna use"""
+        flow_columns = ''.join(
+            f', {column} {type_}' for column, _, type_ in self.flow_columns
+        )
         table_schema = {
-            'flows': "uid TEXT PRIMARY KEY, flow TEXT, label TEXT, profileid TEXT, twid TEXT, aid TEXT",
+            'flows': "uid TEXT PRIMARY KEY, flow TEXT, label TEXT, profileid TEXT, twid TEXT, aid TEXT"
+                     f"{flow_columns}",
             'altflows': "uid TEXT PRIMARY KEY, flow TEXT, label TEXT, profileid TEXT, twid TEXT, flow_type TEXT",
-            'alerts': 'alert_id TEXT PRIMARY KEY, alert_time TEXT, ip_alerted TEXT, timewindow TEXT, tw_start TEXT, tw_end TEXT, label TEXT'
+            'alerts': 'alert_id TEXT PRIMARY KEY, alert_time TEXT, ip_alerted TEXT, timewindow TEXT, tw_start TEXT, tw_end TEXT, label TEXT',
+            'archived_tws': 'profileid_twid TEXT PRIMARY KEY, data TEXT',
             }
         for table_name, schema in table_schema.items():
             self.create_table(table_name, schema)
+        self.create_indexes()
+        self.execute(f'PRAGMA user_version = {self.schema_version}')
+
+    def create_indexes(self):
+        for index, columns in self.indexes.items():
+            self.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {columns}')
+
+    def migrate(self):
+        """
+        adds the flow columns and the indexes to the tables of dbs
+        created before they existed, and fills the columns from the
+        stored flows
+        """
+        self.execute('PRAGMA user_version')
+        if self.fetchone()[0] >= self.schema_version:
+            return
+
+        columns: list = self.get_columns('flows')
+        if not columns:
+            # the db was created but its tables weren't
+            self.init_tables()
+            return
+
+        def run():
+            for column, field, type_ in self.flow_columns:
+                if column not in columns:
+                    self.cursor.execute(
+                        f'ALTER TABLE flows ADD COLUMN {column} {type_}'
+                    )
+            set_clause = ', '.join(
+                f"{column} = json_extract(flow, '$.{field}')"
+                for column, field, _ in self.flow_columns
+            )
+            self.cursor.execute(f'UPDATE flows SET {set_clause}')
+            for index, indexed_columns in self.indexes.items():
+                self.cursor.execute(
+                    f'CREATE INDEX IF NOT EXISTS {index} ON {indexed_columns}'
+                )
+            self.cursor.execute(f'PRAGMA user_version = {self.schema_version}')
+
+        self.run_in_transaction(run, 'migrating flows to the new schema')
 
     def _init_db(self):
         """
@@ -110,55 +203,81 @@ class SQLiteDB(IObservable):
 
     def get_altflow_from_uid(self, profileid, twid, uid) -> dict:
         """ Given a uid, get the alternative flow associated with it """
-        condition = f'uid = "{uid}"'
-        altflow = self.select('altflows', condition=condition)
+        self.execute('SELECT flow FROM altflows WHERE uid = ?', (uid,))
+        altflow = self.fetchone()
         if altflow:
-            flow: str = altflow[0][1]
-            return json.loads(flow)
+            return json.loads(altflow[0])
         return False
 
-    def get_all_contacted_ips_in_profileid_twid(self, profileid, twid) -> dict:
-        all_flows: dict = self.get_all_flows_in_profileid_twid(profileid, twid)
-
-        if not all_flows:
-            return {}
-
-        contacted_ips = {}
-        for uid, flow in all_flows.items():
-            # get the daddr of this flow
-            daddr = flow['daddr']
-            contacted_ips[daddr] = uid
-        return contacted_ips
+    def get_altflows_from_uids(self, uids: List[str]) -> Dict[str, dict]:
+        """
+        Given a list of uids, get the alternative flows associated with them
+        returns {uid: altflow} of the uids that have one
+        """
+        altflows = {}
+        # sqlite limits the number of parameters of 1 query
+        chunk_size = 500
+        for i in range(0, len(uids), chunk_size):
+            chunk = uids[i: i + chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            self.execute(
+                f'SELECT uid, flow FROM altflows WHERE uid IN ({placeholders})',
+                chunk,
+            )
+            for uid, flow in self.fetchall():
+                altflows[uid] = json.loads(flow)
+        return altflows
 
+    def get_all_contacted_ips_in_profileid_twid(self, profileid, twid) -> dict:
+        """
+        returns {daddr: uid of the last flow to it} of the flows
+        in the given tw
+        """
+        self.execute(
+            'SELECT daddr, uid FROM flows WHERE profileid = ? AND twid = ? '
+            'ORDER BY rowid',
+            (profileid, twid),
+        )
+        return dict(self.fetchall())
 
     def get_all_flows_in_profileid_twid(self, profileid, twid):
-        condition = f'profileid = "{profileid}" ' \
-                    f'AND twid = "{twid}"'
-        all_flows: list = self.select('flows', condition=condition)
+        self.execute(
+            'SELECT uid, flow FROM flows WHERE profileid = ? AND twid = ?',
+            (profileid, twid),
+        )
+        all_flows: list = self.fetchall()
         if not all_flows:
             return False
-        res = {}
-        for flow in all_flows:
-            uid = flow[0]
-            flow = flow[1]
-            res[uid] = json.loads(flow)
-        return res
+        return {uid: json.loads(flow) for uid, flow in all_flows}
 
     def get_all_flows_in_profileid(self, profileid) -> Dict[str, dict]:
         """
         Return a list of all the flows in this profileid
         [{'uid':flow},...]
         """
-        condition = f'profileid = "{profileid}"'
-        flows = self.select('flows', condition=condition)
-        all_flows: Dict[str, dict] = {}
-        if flows:
-            for flow in flows:
-                uid = flow[0]
-                flow: str = flow[1]
-                all_flows[uid] = json.loads(flow)
+        self.execute(
+            'SELECT uid, flow FROM flows WHERE profileid = ?', (profileid,)
+        )
+        return {uid: json.loads(flow) for uid, flow in self.fetchall()}
 
-        return all_flows
+    def get_sent_bytes_per_daddr(
+            self, profileid: str, twid: str
+    ) -> Dict[str, Tuple[int, List[str], float]]:
+        """
+        returns the bytes sent by the given profile to each ip it
+        contacted in the given tw
+        {daddr: (sum of sbytes, [uids of the flows], ts of the last flow)}
+        """
+        self.execute(
+            'SELECT daddr, SUM(sbytes), group_concat(uid), MAX(ts) '
+            'FROM flows WHERE profileid = ? AND twid = ? '
+            "AND sbytes > 0 AND daddr != '' GROUP BY daddr",
+            (profileid, twid),
+        )
+        return {
+            daddr: (sbytes, uids.split(','), ts)
+            for daddr, sbytes, uids, ts in self.fetchall()
+        }
 
     def get_all_flows(self):
         """
@@ -187,7 +306,7 @@ class SQLiteDB(IObservable):
     def export_labeled_flows(self, output_dir, format):
         if 'tsv' in format:
             csv_output_file = os.path.join(output_dir, 'labeled_flows.tsv')
-            header: list = self.get_columns('flows')
+            header: list = self.exported_columns
 
             with open(csv_output_file, 'w', newline='') as tsv_file:
                 writer = csv.writer(tsv_file, delimiter='\t')
@@ -226,7 +345,10 @@ class SQLiteDB(IObservable):
         # generator function to iterate over the rows
         def row_generator():
             # select all flows and altflows
-            self.execute('SELECT * FROM flows UNION SELECT uid, flow, label, profileid, twid FROM altflows')
+            columns = ', '.join(self.exported_columns)
+            self.execute(
+                f'SELECT {columns} FROM flows UNION SELECT {columns} FROM altflows'
+            )
 
             while True:
                 row = self.fetchone()
@@ -237,52 +359,98 @@ class SQLiteDB(IObservable):
         # Return the combined iterator
         return iter(row_generator())
 
+    def iterate_flows_in_chunks(self, chunk_size: int) \
+            -> Iterator[List[dict]]:
+        """
+        yields lists of at most chunk_size flows from the flows table,
+        so only 1 chunk of flows is in memory at a time
+        """
+        # use a separate cursor so the iteration isn't affected by other
+        # queries done while the chunks are being processed
+        with self.cursor_lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT flow FROM flows')
+
+        try:
+            while True:
+                with self.cursor_lock:
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [json.loads(row[0]) for row in rows]
+        finally:
+            cursor.close()
+
     def get_flow(self, uid: str, twid=False) -> dict:
         """
         Returns the flow with the given uid
         the flow returned is read from conn.log
         """
-        condition = f'uid = "{uid}"'
+        query = 'SELECT flow FROM flows WHERE uid = ?'
+        params = [uid]
         if twid:
-            condition += f'AND twid = "{twid}"'
+            query += ' AND twid = ?'
+            params.append(twid)
 
-        res = self.select('flows', condition=condition)
-        res = res[0][1] if res else {}
+        self.execute(query, params)
+        res = self.fetchone()
+        res = res[0] if res else {}
         return {uid: res}
 
+    def start_batch(self):
+        """
+        Starts queueing the flows and altflows instead of writing each one
+        of them in its own transaction.
+        they're all written when commit_batch() is called.
+        used by the profiler to store many flows at once
+        """
+        self.batching = True
+
+    def commit_batch(self):
+        """writes all the queued flows and altflows using 1 transaction"""
+        self.batching = False
+        if not self.pending_rows:
+            return
+        pending_rows = self.pending_rows
+        self.pending_rows = {}
+        self.executemany(pending_rows)
+
+    def add_row(self, query: str, parameters: tuple):
+        if self.batching:
+            self.pending_rows.setdefault(query, []).append(parameters)
+            return
+        self.execute(query, parameters)
+
     def add_flow(
             self, flow, profileid: str, twid:str, label='benign'
             ):
-        if hasattr(flow, 'aid'):
-            parameters = (profileid, twid, flow.uid, json.dumps(asdict(flow)), label, flow.aid)
-            self.execute(
-                'INSERT OR REPLACE INTO flows (profileid, twid, uid, flow, label, aid) '
-                'VALUES (?, ?, ?, ?, ?, ?);',
-                parameters,
-            )
-        else:
-            parameters = (profileid, twid, flow.uid, json.dumps(asdict(flow)), label)
-
-            self.execute(
-                'INSERT OR REPLACE INTO flows (profileid, twid, uid, flow, label) '
-                'VALUES (?, ?, ?, ?, ?);',
-                parameters,
-            )
+        parameters = (
+            profileid,
+            twid,
+            flow.uid,
+            json.dumps(asdict(flow)),
+            label,
+            getattr(flow, 'aid', None),
+            *(getattr(flow, field, None) for _, field, _ in self.flow_columns),
+        )
+        self.add_row(self.add_flow_query, parameters)
 
     def get_flows_count(self, profileid=None, twid=None) -> int:
         """
         returns the total number of flows
          in the db for this profileid and twid if given
         """
-        condition = ''
+        conditions, params = [], []
         if profileid:
-            condition = f'profileid="{profileid}"'
-        elif twid and not profileid:
-            condition += f'twid= "{twid}"'
-        elif profileid and twid:
-            condition += f'AND twid= "{twid}"'
+            conditions.append('profileid = ?')
+            params.append(profileid)
+        if twid:
+            conditions.append('twid = ?')
+            params.append(twid)
 
-        flows = self.get_count('flows', condition=condition)
+        flows = self.get_count(
+            'flows', condition=' AND '.join(conditions), params=params
+        )
         # flows += self.get_count('altflows', condition=condition)
         return flows
 
@@ -291,11 +459,7 @@ class SQLiteDB(IObservable):
             self, flow, profileid: str, twid:str, label='benign'
             ):
         parameters = (profileid, twid, flow.uid, json.dumps(asdict(flow)), label, flow.type_)
-        self.execute(
-            'INSERT OR REPLACE INTO altflows (profileid, twid, uid, flow, label, flow_type) '
-            'VALUES (?, ?, ?, ?, ?, ?);',
-            parameters,
-        )
+        self.add_row(self.add_altflow_query, parameters)
 
     def add_alert(self, alert: dict):
         """
@@ -319,6 +483,39 @@ class SQLiteDB(IObservable):
 
 
 
+    def archive_tw(self, profileid_twid: str, data: dict) -> bool:
+        """
+        stores the redis keys of the given closed tw
+        :param data: {key: [type, value]}
+        returns False if they weren't stored
+        """
+        data = json.dumps(data)
+        self.execute(
+            'INSERT OR REPLACE INTO archived_tws (profileid_twid, data) '
+            'VALUES (?, ?);',
+            (profileid_twid, data),
+        )
+        # execute() discards the queries that keep failing, make sure it's
+        # there before the tw is deleted from redis
+        self.execute(
+            'SELECT length(data) FROM archived_tws WHERE profileid_twid = ?;',
+            (profileid_twid,),
+        )
+        row = self.fetchone()
+        return bool(row) and row[0] == len(data)
+
+    def get_archived_tw(self, profileid_twid: str) -> dict:
+        """
+        returns the redis keys of the given archived tw,
+        {key: [type, value]}
+        """
+        self.execute(
+            'SELECT data FROM archived_tws WHERE profileid_twid = ?;',
+            (profileid_twid,),
+        )
+        row = self.fetchone()
+        return json.loads(row[0]) if row else {}
+
     def insert(self, table_name, values):
         query = f"INSERT INTO {table_name} VALUES ({values})"
         self.execute(query)
@@ -342,7 +539,7 @@ class SQLiteDB(IObservable):
         result = self.fetchall()
         return result
 
-    def get_count(self, table, condition=None):
+    def get_count(self, table, condition=None, params=None):
         """
         returns th enumber of matching rows in the given table based on a specific contioins
         """
@@ -351,11 +548,12 @@ class SQLiteDB(IObservable):
         if condition:
             query += f" WHERE {condition}"
 
-        self.execute(query)
+        self.execute(query, params)
         return self.fetchone()[0]
 
 
     def close(self):
+        self.commit_batch()
         self.cursor.close()
         self.conn.close()
 
@@ -385,46 +583,48 @@ class SQLiteDB(IObservable):
         since sqlite is terrible with multi-process applications
         this should be used instead of all calls to commit() and execute()
         """
-        try:
-            self.cursor_lock.acquire(True)
-            #start a transaction
-            self.cursor.execute('BEGIN')
-
+        def run():
             if not params:
                 self.cursor.execute(query)
             else:
                 self.cursor.execute(query, params)
 
-            self.conn.commit()
-
-            self.cursor_lock.release()
-            # counter for the number of times we tried executing a tx and failed
-            self.trial = 0
+        self.run_in_transaction(run, query)
 
-        except sqlite3.Error as e:
-            self.cursor_lock.release()
-            self.conn.rollback()
-            if self.trial >= 2:
-                # tried 2 times to exec a query and it's still failing
-                self.trial = 0
-                # discard query
-                self.print(f"Error executing query: {query} - {e}. Query discarded", 0, 1)
+    def executemany(self, queries: Dict[str, List[tuple]]):
+        """
+        runs each query once per params in the given list, all of them
+        in 1 transaction
+        :param queries: {query: [params of each row]}
+        """
+        def run():
+            for query, rows in queries.items():
+                self.cursor.executemany(query, rows)
 
-            elif "database is locked" in str(e):
-                # keep track of failed trials
-                self.trial += 1
+        self.run_in_transaction(run, ', '.join(queries))
 
+    def run_in_transaction(self, run: Callable, query: str) -> bool:
+        """
+        calls run() in a transaction, tries again 2 times if it fails
+        :param query: the query run() executes, for logging
+        returns False if the query was discarded
+        """
+        for trial in range(3):
+            with self.cursor_lock:
+                try:
+                    # start a transaction
+                    self.cursor.execute('BEGIN')
+                    run()
+                    self.conn.commit()
+                    return True
+                except sqlite3.Error as e:
+                    self.conn.rollback()
+                    error = e
+
+            if "database is locked" in str(error):
                 # Retry after a short delay
                 sleep(5)
-                self.execute(query, params=params)
-            else:
-                # An error occurred during execution
-                self.conn.rollback()
-                # print(f"Re-trying to execute query ({query}). reason: {e}")
-                # keep track of failed trials
-                self.trial += 1
-                self.execute(query, params=params)
-
 
-
-        
\ No newline at end of file
+        # tried 3 times to exec a query and it's still failing
+        self.print(f"Error executing query: {query} - {error}. Query discarded", 0, 1)
+        return False
@@ -17,7 +17,8 @@
 # Contact: eldraco@gmail.com, sebastian.garcia@agents.fel.cvut.cz, stratosphere@aic.fel.cvut.cz
 
 import json
-from typing import Union, List, Tuple, Dict, Optional
+from collections import OrderedDict
+from typing import Union, List, Tuple, Dict, Optional, Set
 from datetime import datetime
 from os import path
 from colorama import Fore, Style
@@ -52,6 +53,8 @@ class EvidenceHandler(ICore):
     This should be converted into a module
     """
     name = 'Evidence'
+    # max number of tws whose evidence are kept in memory
+    max_cached_tws = 10000
 
     def init(self):
         self.whitelist = Whitelist(self.logger, self.db)
@@ -90,6 +93,16 @@ class EvidenceHandler(ICore):
         # this list will have our local and public ips when using -i
         self.our_ips = utils.get_own_IPs()
         self.discarded_bc_never_processed = {}
+        # {(profileid, twid): {evidence id: evidence dict}} of the processed
+        # evidence of each tw that weren't whitelisted, in the order they
+        # were processed. used instead of reading all the evidence of the
+        # tw from the db each time we check if they cause an alert
+        self.tw_evidence: Dict[
+            Tuple[str, str], Dict[str, dict]
+        ] = OrderedDict()
+        # {(profileid, twid): ids of the evidence that were part of an
+        # alert in this tw}
+        self.tw_alerted_evidence: Dict[Tuple[str, str], Set[str]] = {}
 
     def read_configuration(self):
         conf = ConfigParser()
@@ -103,6 +116,9 @@ class EvidenceHandler(ICore):
         self.GID = conf.get_GID()
         self.UID = conf.get_UID()
 
+        # how many evidence are read from the evidence_added channel
+        # at once
+        self.evidence_batch_size: int = conf.evidence_batch_size()
         self.popup_alerts = conf.popup_alerts()
         # In docker, disable alerts no matter what slips.conf says
         if IS_IN_A_DOCKER_CONTAINER:
@@ -413,17 +429,53 @@ class EvidenceHandler(ICore):
         self.logfile.close()
         self.jsonfile.close()
 
-    def get_evidence_that_were_part_of_a_past_alert(
-            self, profileid: str, twid: str) -> List[str]:
+    def load_tw_evidence(self, profileid: str, twid: str):
+        """
+        reads the processed evidence of the given tw and the ids of the
+        evidence that were part of its past alerts from the db.
+        only needed the first time an evidence of the tw is seen, or when
+        the tw was removed from the cache
+        """
+        tw_evidence: Dict[str, str] = self.db.get_twid_evidence(
+            profileid, twid
+        )
+        self.tw_evidence[(profileid, twid)] = {
+            evidence_id: json.loads(evidence)
+            for evidence_id, evidence in tw_evidence.items()
+            # sometimes the db has evidence that didn't come yet to
+            # evidence.py, they're cached when they're processed
+            if self.db.is_evidence_processed(evidence_id)
+        }
 
-        past_alerts: dict = self.db.get_profileid_twid_alerts(profileid, twid)
-        try:
-            past_evidence_ids = list(past_alerts.values())[0]
-            past_evidence_ids: List[str] = json.loads(past_evidence_ids)
-        except IndexError:
-            # no past evidence
-            past_evidence_ids = []
-        return past_evidence_ids
+        past_alerts: Dict[str, str] = self.db.get_profileid_twid_alerts(
+            profileid, twid
+        )
+        alerted_evidence = set()
+        for evidence_ids in past_alerts.values():
+            alerted_evidence.update(json.loads(evidence_ids))
+        self.tw_alerted_evidence[(profileid, twid)] = alerted_evidence
+
+        # the tws that didn't get new evidence for the longest time
+        # are removed from the cache
+        while len(self.tw_evidence) > self.max_cached_tws:
+            tw, _ = self.tw_evidence.popitem(last=False)
+            self.tw_alerted_evidence.pop(tw, None)
+
+    def cache_evidence(self, profileid: str, twid: str, evidence: dict):
+        """
+        adds the given processed evidence to the cached evidence of its tw
+        """
+        tw = (profileid, twid)
+        if tw not in self.tw_evidence:
+            self.load_tw_evidence(profileid, twid)
+        self.tw_evidence.move_to_end(tw)
+        self.tw_evidence[tw][evidence['id']] = evidence
+
+    def get_evidence_that_were_part_of_a_past_alert(
+            self, profileid: str, twid: str) -> Set[str]:
+        if (profileid, twid) not in self.tw_alerted_evidence:
+            self.load_tw_evidence(profileid, twid)
+        return self.tw_alerted_evidence[(profileid, twid)]
 
     def is_evidence_done_by_others(self, evidence: Evidence) -> bool:
         # given all the tw evidence, we should only
@@ -438,23 +490,24 @@ class EvidenceHandler(ICore):
         filters and returns all the evidence for this profile in this TW
         returns the dict with filtered evidence
         """
-        tw_evidence: Dict[str, dict] = self.db.get_twid_evidence(
-            profileid, twid
-        )
+        if (profileid, twid) not in self.tw_evidence:
+            self.load_tw_evidence(profileid, twid)
+
+        # the cache only has the evidence that were processed and weren't
+        # whitelisted, so they are ready to be a part of an alert
+        tw_evidence: Dict[str, dict] = self.tw_evidence[(profileid, twid)]
         if not tw_evidence:
             return
 
-        past_evidence_ids: List[str] = \
+        past_evidence_ids: Set[str] = \
             self.get_evidence_that_were_part_of_a_past_alert(profileid, twid)
 
         # to store all the ids causing this alert in the database
         self.IDs_causing_an_alert = []
         filtered_evidence = {}
 
-        for id, evidence in tw_evidence.items():
-            id: str
-            evidence: str
-            evidence: dict = json.loads(evidence)
+        for evidence in tw_evidence.values():
+            evidence: dict
             evidence: Evidence = dict_to_evidence(evidence)
 
             if self.is_filtered_evidence(
@@ -463,20 +516,6 @@ class EvidenceHandler(ICore):
                 ):
                 continue
 
-            whitelisted: bool = self.db.is_whitelisted_evidence(id)
-            if whitelisted:
-                continue
-
-            # delete not processed evidence
-            # sometimes the db has evidence that didn't come yet to evidence.py
-            # and they are alerted without checking the whitelist!
-            # to fix this, we keep track of processed evidence
-            # that came to new_evidence channel and were processed by it.
-            # so they are ready to be a part of an alert
-            processed: bool = self.db.is_evidence_processed(id)
-            if not processed:
-                continue
-
             evidence_id: str = evidence.id
             # we keep track of these IDs to be able to label the flows
             # of these evidence later if this was detected as an alert
@@ -492,7 +531,7 @@ class EvidenceHandler(ICore):
 
     def is_filtered_evidence(self,
                              evidence: Evidence,
-                             past_evidence_ids: List[str]):
+                             past_evidence_ids: Set[str]):
         """
         filters the following
         * evidence that were part of a past alert in this same profileid
@@ -574,6 +613,9 @@ class EvidenceHandler(ICore):
             alert_ID,
             self.IDs_causing_an_alert
         )
+        self.get_evidence_that_were_part_of_a_past_alert(
+            profileid, twid
+        ).update(self.IDs_causing_an_alert)
         # when an alert is generated , we should set the threat level of the
         # attacker's profile to 1(critical) and confidence 1
         # so that it gets reported to other peers with these numbers
@@ -660,12 +702,9 @@ class EvidenceHandler(ICore):
         twid: str = str(evidence.timewindow)
         evidence_threat_level: float = self.get_threat_level(evidence)
 
-        self.db.update_accumulated_threat_level(
-            profileid, twid, evidence_threat_level
-        )
         accumulated_threat_level: float = \
-            self.db.get_accumulated_threat_level(
-                profileid, twid
+            self.db.update_accumulated_threat_level(
+                profileid, twid, evidence_threat_level
             )
         return accumulated_threat_level
 
@@ -685,146 +724,168 @@ class EvidenceHandler(ICore):
                                  f'{evidence.threat_level.name.lower()}.')
         return evidence
 
-    def main(self):
-        while not self.should_stop():
-            if msg := self.get_msg('evidence_added'):
-                msg['data']: str
-                evidence: dict = json.loads(msg['data'])
-                evidence: Evidence = dict_to_evidence(evidence)
-                profileid: str = str(evidence.profile)
-                twid: str = str(evidence.timewindow)
-                evidence_type: EvidenceType = evidence.evidence_type
-                timestamp: str = evidence.timestamp
-                # this is all the uids of the flows that cause this evidence
-                all_uids: list = evidence.uid
-                # FP whitelisted alerts happen when the db returns an evidence
-                # that isn't processed in this channel, in the tw_evidence
-                # below.
-                # to avoid this, we only alert about processed evidence
-                self.db.mark_evidence_as_processed(evidence.id)
-                # Ignore evidence if IP is whitelisted
-                if self.whitelist.is_whitelisted_evidence(evidence):
-                    self.db.cache_whitelisted_evidence_ID(evidence.id)
-                    # Modules add evidence to the db before
-                    # reaching this point, now remove evidence from db so
-                    # it could be completely ignored
-                    self.db.delete_evidence(
-                        profileid, twid, evidence.id
-                    )
-                    continue
+    def get_evidence_batch(self) -> List[dict]:
+        """
+        returns up to evidence_batch_size evidence received in the
+        evidence_added channel
+        """
+        evidence_batch = []
+        while len(evidence_batch) < self.evidence_batch_size:
+            msg = self.get_msg('evidence_added')
+            if not msg:
+                break
+            msg['data']: str
+            evidence_batch.append(json.loads(msg['data']))
+        return evidence_batch
 
-                # convert time to local timezone
-                if self.running_non_stop:
-                    timestamp: datetime = utils.convert_to_local_timezone(
-                        timestamp
-                        )
-                flow_datetime = utils.convert_format(timestamp, 'iso')
+    def handle_evidence(self, evidence_dict: dict):
+        """
+        logs the given evidence, updates the accumulated threat level of
+        its tw and generates an alert if it's over the threshold
+        """
+        evidence: Evidence = dict_to_evidence(evidence_dict)
+        profileid: str = str(evidence.profile)
+        twid: str = str(evidence.timewindow)
+        evidence_type: EvidenceType = evidence.evidence_type
+        timestamp: str = evidence.timestamp
+        # this is all the uids of the flows that cause this evidence
+        all_uids: list = evidence.uid
+        # Ignore evidence if IP is whitelisted
+        if self.whitelist.is_whitelisted_evidence(evidence):
+            self.db.cache_whitelisted_evidence_ID(evidence.id)
+            # Modules add evidence to the db before
+            # reaching this point, now remove evidence from db so
+            # it could be completely ignored
+            self.db.delete_evidence(
+                profileid, twid, evidence.id
+            )
+            return
 
-                evidence: Evidence = (
-                    self.add_threat_level_to_evidence_description(evidence)
-                )
-                
-                evidence_to_log: str = self.get_evidence_to_log(
-                    evidence,
-                    flow_datetime,
+        # the evidence is cached before its description is changed below
+        self.cache_evidence(profileid, twid, evidence_dict)
+
+        # convert time to local timezone
+        if self.running_non_stop:
+            timestamp: datetime = utils.convert_to_local_timezone(
+                timestamp
                 )
-                # Add the evidence to alerts.log
-                self.add_to_log_file(evidence_to_log)
+        flow_datetime = utils.convert_format(timestamp, 'iso')
 
-                self.increment_attack_counter(
-                    evidence.profile.ip,
-                    evidence.victim,
-                    evidence_type
-                    )
+        evidence: Evidence = (
+            self.add_threat_level_to_evidence_description(evidence)
+        )
+        
+        evidence_to_log: str = self.get_evidence_to_log(
+            evidence,
+            flow_datetime,
+        )
+        # Add the evidence to alerts.log
+        self.add_to_log_file(evidence_to_log)
+
+        self.increment_attack_counter(
+            evidence.profile.ip,
+            evidence.victim,
+            evidence_type
+            )
+
+        past_evidence_ids: Set[str] = \
+            self.get_evidence_that_were_part_of_a_past_alert(
+                profileid,
+                twid
+                )
+        if not self.is_filtered_evidence(evidence, past_evidence_ids):
+            accumulated_threat_level: float = \
+                self.update_accumulated_threat_level(evidence)
+        else:
+            accumulated_threat_level: float = \
+                self.db.get_accumulated_threat_level(
+                    profileid,
+                    twid
+                )
+        # prepare evidence for json log file
+        idea_dict: dict = idea_format(evidence)
+        # add to alerts.json
+        self.add_to_json_log_file(
+              idea_dict,
+              all_uids,
+              twid,
+              accumulated_threat_level,
+            )
 
-                past_evidence_ids: List[str] = \
-                    self.get_evidence_that_were_part_of_a_past_alert(
-                        profileid,
-                        twid
-                        )
-                if not self.is_filtered_evidence(evidence, past_evidence_ids):
-                    accumulated_threat_level: float = \
-                        self.update_accumulated_threat_level(evidence)
-                else:
-                    accumulated_threat_level: float = \
-                        self.db.get_accumulated_threat_level(
-                            profileid,
-                            twid
-                        )
-                # prepare evidence for json log file
-                idea_dict: dict = idea_format(evidence)
-                # add to alerts.json
-                self.add_to_json_log_file(
-                      idea_dict,
-                      all_uids,
-                      twid,
-                      accumulated_threat_level,
+        evidence_dict: dict = evidence_to_dict(evidence)
+        self.db.publish('report_to_peers', json.dumps(evidence_dict))
+
+
+        # This is the part to detect if the accumulated
+        # evidence was enough for generating a detection
+        # The detection should be done in attacks per minute.
+        # The parameter in the configuration
+        # is attacks per minute
+        # So find out how many attacks corresponds
+        # to the width we are using
+        if (
+            accumulated_threat_level >= self.detection_threshold_in_this_width
+            # if the profile was already blocked in
+            # this twid, we shouldn't alert
+            and not self.db.checkBlockedProfTW(profileid, twid)
+        ):
+            tw_evidence: Dict[str, dict] = \
+                self.get_evidence_for_tw(
+                    profileid, twid
+                )
+            if tw_evidence:
+                # store the alert in our database
+                last_id: str = self.get_last_evidence_ID(tw_evidence)
+                # the alert ID is profileid_twid + the ID of
+                # the last evidence causing this alert
+                alert_id: str = f'{profileid}_{twid}_{last_id}'
+
+                self.handle_new_alert(alert_id, tw_evidence)
+
+                # print the alert
+                alert_to_print: str = \
+                    self.format_evidence_causing_this_alert(
+                        tw_evidence,
+                        evidence.profile,
+                        evidence.timewindow,
+                        flow_datetime,
                     )
 
-                evidence_dict: dict = evidence_to_dict(evidence)
-                self.db.publish('report_to_peers', json.dumps(evidence_dict))
+                self.print(f'{alert_to_print}', 1, 0)
 
+                if self.popup_alerts:
+                    self.show_popup(alert_to_print)
 
-                # if the profile was already blocked in
-                # this twid, we shouldn't alert
-                profile_already_blocked = \
-                    self.db.checkBlockedProfTW(profileid, twid)
 
-                # This is the part to detect if the accumulated
-                # evidence was enough for generating a detection
-                # The detection should be done in attacks per minute.
-                # The parameter in the configuration
-                # is attacks per minute
-                # So find out how many attacks corresponds
-                # to the width we are using
+                blocked = False
+                # send ip to the blocking module
                 if (
-                    accumulated_threat_level >= self.detection_threshold_in_this_width
-                    and not profile_already_blocked
+                        self.is_blocking_module_enabled()
+                        and self.decide_blocking(profileid)
                 ):
-                    tw_evidence: Dict[str, dict] = \
-                        self.get_evidence_for_tw(
-                            profileid, twid
-                        )
-                    if tw_evidence:
-                        # store the alert in our database
-                        last_id: str = self.get_last_evidence_ID(tw_evidence)
-                        # the alert ID is profileid_twid + the ID of
-                        # the last evidence causing this alert
-                        alert_id: str = f'{profileid}_{twid}_{last_id}'
-
-                        self.handle_new_alert(alert_id, tw_evidence)
-
-                        # print the alert
-                        alert_to_print: str = \
-                            self.format_evidence_causing_this_alert(
-                                tw_evidence,
-                                evidence.profile,
-                                evidence.timewindow,
-                                flow_datetime,
-                            )
-
-                        self.print(f'{alert_to_print}', 1, 0)
-
-                        if self.popup_alerts:
-                            self.show_popup(alert_to_print)
-
-
-                        blocked = False
-                        # send ip to the blocking module
-                        if (
-                                self.is_blocking_module_enabled()
-                                and self.decide_blocking(profileid)
-                        ):
-                            blocked = True
-
-                        self.mark_as_blocked(
-                            profileid,
-                            twid,
-                            flow_datetime,
-                            accumulated_threat_level,
-                            idea_dict,
-                            blocked=blocked
-                        )
+                    blocked = True
+
+                self.mark_as_blocked(
+                    profileid,
+                    twid,
+                    flow_datetime,
+                    accumulated_threat_level,
+                    idea_dict,
+                    blocked=blocked
+                )
+
+    def main(self):
+        while not self.should_stop():
+            self.msgs_received_in_loop = False
+            if evidence_batch := self.get_evidence_batch():
+                for evidence in evidence_batch:
+                    self.handle_evidence(evidence)
+                # FP whitelisted alerts happen when the db returns an
+                # evidence that isn't processed in this channel.
+                # to avoid this, we only alert about processed evidence
+                self.db.mark_evidence_as_processed(
+                    *(evidence['id'] for evidence in evidence_batch)
+                )
 
             if msg := self.get_msg('new_blame'):
                 data = msg['data']
@@ -868,3 +929,8 @@ class EvidenceHandler(ICore):
                 blocking_data = json.dumps(blocking_data)
                 self.db.publish('new_blocking', blocking_data)
 
+            if not self.msgs_received_in_loop:
+                # none of the channels had msgs, wait for the streams
+                # instead of polling redis in a loop
+                self.db.wait_for_stream_msgs()
+
@@ -26,18 +26,28 @@ from slips_files.common.imports import *
 class FileEventHandler(RegexMatchingEventHandler):
     REGEX = [r'.*\.log$', r'.*\.conf$']
 
-    def __init__(self, dir_to_monitor, input_type, db):
+    def __init__(
+        self, dir_to_monitor, input_type, db, new_zeek_file_created=None
+    ):
+        """
+        :param new_zeek_file_created: threading.Event set whenever zeek
+        creates a new log file so the input process refreshes its
+        list of files
+        """
         super().__init__(self.REGEX)
         self.dir_to_monitor = dir_to_monitor
         utils.drop_root_privs()
         self.db = db
         self.input_type = input_type
+        self.new_zeek_file_created = new_zeek_file_created
 
     def on_created(self, event):
         """this will be triggered everytime zeek creates a log file"""
         filename, ext = os.path.splitext(event.src_path)
         if 'log' in ext:
             self.db.add_zeek_file(filename + ext)
+            if self.new_zeek_file_created:
+                self.new_zeek_file_created.set()
 
     def on_moved(self, event):
         """
@@ -0,0 +1,100 @@
+import json
+import multiprocessing
+import queue
+from collections import deque
+from typing import (
+    Deque,
+    Optional,
+    Union,
+    )
+
+from slips_files.common.shared_ring_buffer import SharedRingBuffer
+
+
+class ProfilerQueue(SharedRingBuffer):
+    """
+    Passes the lines read by the input process to the profiler using
+    a ring buffer in shared memory. Has the put() and get() of the
+    multiprocessing.Queue it replaces.
+
+    Lines whose data is a str (most of them, e.g. zeek json and tab
+    lines, argus, suricata) are sent as they were read, without pickling
+    or parsing them. The rest of the msgs are sent as json.
+    The profiler reads the lines in batches and get() returns them 1 by 1.
+    """
+
+    stop_msg = b'S'
+    raw_line = b'R'
+    json_msg = b'J'
+    separator = '\x1f'
+
+    def __init__(self, size: int = 32 * 1024 * 1024, batch_size: int = 1000):
+        super().__init__(size)
+        self.batch_size = batch_size
+        # msgs read from the buffer and not returned by get() yet
+        self.received: Deque[Union[dict, str]] = deque()
+
+    def encode(self, msg: Union[dict, str]) -> bytes:
+        if msg == 'stop':
+            return self.stop_msg
+
+        line = msg['line']
+        if (
+                len(msg) == 2
+                and isinstance(line, dict)
+                and line.keys() == {'type', 'data'}
+                and isinstance(line['data'], str)
+        ):
+            return self.raw_line + self.separator.join(
+                (msg['input_type'], line['type'], line['data'])
+            ).encode()
+
+        return self.json_msg + json.dumps(msg).encode()
+
+    def decode(self, record: bytes) -> Union[dict, str]:
+        kind, record = record[:1], record[1:]
+        if kind == self.stop_msg:
+            return 'stop'
+
+        if kind == self.raw_line:
+            # the data is last, it can have the separator
+            input_type, type_, data = record.decode().split(self.separator, 2)
+            return {
+                'line': {'type': type_, 'data': data},
+                'input_type': input_type,
+            }
+
+        return json.loads(record)
+
+    def put(
+            self,
+            msg: Union[dict, str],
+            block=True,
+            timeout: Optional[float] = None,
+            stop: Optional[multiprocessing.Event] = None,
+    ):
+        """
+        sends the given msg to the profiler, waits if the buffer is full
+        :param stop: stops waiting when it's set
+        raises queue.Full if the msg wasn't sent
+        """
+        if not self.put_record(
+            self.encode(msg), timeout=timeout if block else 0, stop=stop
+        ):
+            raise queue.Full
+
+    def get(self, block=True, timeout: float = 1) -> Union[dict, str]:
+        """
+        returns the next msg sent by the input process
+        raises queue.Empty if there's none
+        """
+        if not self.received:
+            records = self.get_records(
+                self.batch_size, timeout=timeout if block else 0
+            )
+            self.received.extend(self.decode(record) for record in records)
+
+        try:
+            return self.received.popleft()
+        except IndexError:
+            raise queue.Empty
@@ -1,11 +1,15 @@
 import json
 import ipaddress
 from typing import Optional, \
-    Dict
+    Dict, \
+    List, \
+    Set
 
 import validators
 from slips_files.common.imports import *
 from slips_files.common.abstracts.observer import IObservable
+from slips_files.common.domain_trie import DomainTrie
+from slips_files.common.ip_range_index import IPRangeIndex
 from slips_files.core.output import Output
 import tld
 import os
@@ -19,6 +23,9 @@ from slips_files.core.evidence_structure.evidence import (
 
 
 class Whitelist(IObservable):
+    # max number of ips whose asn org is kept in memory
+    max_cached_asn_orgs = 100000
+
     def __init__(self,
                  logger: Output,
                  db):
@@ -30,6 +37,16 @@ class Whitelist(IObservable):
         self.org_info_path = 'slips_files/organizations_info/'
         self.ignored_flow_types = ('arp')
         self.db = db
+        # the whitelist used for checking flows is compiled from the db
+        # the first time a flow is checked, and again every time
+        # whitelist.conf changes
+        self.is_flows_whitelist_compiled = False
+        # {org: IPRangeIndex of its ranges} loaded from the db the first
+        # time an ip is checked against each org
+        self.org_ranges: Dict[str, IPRangeIndex] = {}
+        # {ip: its asn org} of the ips whose asn is known, so the asn of
+        # each ip is read from the db once
+        self.asn_orgs: Dict[str, str] = {}
 
     def print(self, text, verbose=1, debug=0):
         """
@@ -63,11 +80,16 @@ class Whitelist(IObservable):
         conf = ConfigParser()
         self.whitelist_path = conf.whitelist_path()
 
-    def is_whitelisted_asn(self, ip, org):
+    def is_whitelisted_asn(self, ip, org, org_asn=None):
+        """
+        :param org_asn: the asns of the given org, read from the db
+        if not given
+        """
         ip_data = self.db.get_ip_info(ip)
         try:
             ip_asn = ip_data['asn']['asnorg']
-            org_asn = json.loads(self.db.get_org_info(org, 'asn'))
+            if org_asn is None:
+                org_asn = json.loads(self.db.get_org_info(org, 'asn'))
             if (
                 ip_asn
                 and ip_asn != 'Unknown'
@@ -192,20 +214,171 @@ class Whitelist(IObservable):
         return False
 
 
+    def compile_flows_whitelist(self):
+        """
+        builds the in-memory structures is_whitelisted_flow() uses from
+        the whitelisted IPs, MACs, domains and orgs in the db.
+        only the entries that ignore flows are used
+        """
+        # ips whitelisted as a src, as a dst, and in any direction
+        self.flows_src_ips: Set[str] = set()
+        self.flows_dst_ips: Set[str] = set()
+        self.flows_ips: Set[str] = set()
+        for ip, info in self.db.get_whitelist('IPs').items():
+            if not self.should_ignore_flows(info['what_to_ignore']):
+                continue
+            self.flows_ips.add(ip)
+            if self.should_ignore_from(info['from']):
+                self.flows_src_ips.add(ip)
+            if self.should_ignore_to(info['from']):
+                self.flows_dst_ips.add(ip)
+
+        self.flows_src_macs: Set[str] = set()
+        self.flows_dst_macs: Set[str] = set()
+        for mac, info in self.db.get_whitelist('mac').items():
+            if not self.should_ignore_flows(info['what_to_ignore']):
+                continue
+            if self.should_ignore_from(info['from']):
+                self.flows_src_macs.add(mac)
+            if self.should_ignore_to(info['from']):
+                self.flows_dst_macs.add(mac)
+
+        # domains whitelisted in any direction, and the ones the domains
+        # of the src and dst ips of the flow are checked against
+        self.flows_domains = DomainTrie()
+        self.flows_src_domains = DomainTrie()
+        self.flows_dst_domains = DomainTrie()
+        for domain, info in self.db.get_whitelist('domains').items():
+            if not self.should_ignore_flows(info['what_to_ignore']):
+                continue
+            self.flows_domains.add(domain)
+            if 'src' in info['from'] or 'both' in info['from']:
+                self.flows_src_domains.add(domain)
+            else:
+                self.flows_dst_domains.add(domain)
+            if 'both' in info['from']:
+                self.flows_dst_domains.add(domain)
+
+        # {'src': [orgs], 'dst': [orgs]}
+        self.flows_orgs: Dict[str, List[str]] = {'src': [], 'dst': []}
+        # the ranges of the orgs whitelisted as a src or as a dst
+        self.flows_org_ranges: Dict[str, IPRangeIndex] = {
+            'src': IPRangeIndex(),
+            'dst': IPRangeIndex(),
+        }
+        # {org: set of asns}
+        self.org_asns: Dict[str, Set[str]] = {}
+        # the asns of the orgs whitelisted as a src or as a dst
+        self.flows_org_asns: Dict[str, Set[str]] = {
+            'src': set(),
+            'dst': set(),
+        }
+        # {org: list of domains}
+        self.org_domains: Dict[str, List[str]] = {}
+        for org, info in self.db.get_whitelist('organizations').items():
+            if not self.should_ignore_flows(info['what_to_ignore']):
+                continue
+
+            directions = []
+            if self.should_ignore_from(info['from']):
+                directions.append('src')
+            if self.should_ignore_to(info['from']):
+                directions.append('dst')
+
+            org_subnets: dict = self.db.get_org_IPs(org)
+            for direction in directions:
+                self.flows_orgs[direction].append(org)
+                for ranges in org_subnets.values():
+                    for range_ in ranges:
+                        self.flows_org_ranges[direction].add(range_, org)
+
+            self.org_asns[org] = set(
+                json.loads(self.db.get_org_info(org, 'asn'))
+            )
+            for direction in directions:
+                self.flows_org_asns[direction].update(self.org_asns[org])
+            self.org_domains[org] = json.loads(
+                self.db.get_org_info(org, 'domains')
+            )
+
+        # asn orgs that contain the name of a whitelisted org belong to it
+        self.flows_org_names: Dict[str, List[str]] = {
+            direction: [org.lower() for org in orgs]
+            for direction, orgs in self.flows_orgs.items()
+        }
+        self.is_flows_whitelist_compiled = True
+
+    def get_ip_info(
+            self, ip: str, ips_info: Optional[Dict[str, dict]] = None
+    ) -> Optional[dict]:
+        """
+        returns the info of the given ip stored in the db
+        :param ips_info: the info of the ips of the flow being checked,
+        so the info of each ip is read from the db once per flow
+        """
+        if ips_info is None:
+            return self.db.get_ip_info(ip)
+        if ip not in ips_info:
+            ips_info[ip] = self.db.get_ip_info(ip)
+        return ips_info[ip]
+
+    def get_asn_org(
+            self, ip: str, ips_info: Optional[Dict[str, dict]] = None
+    ) -> Optional[str]:
+        """
+        returns the asn org of the given ip, or None if it's not known yet
+        """
+        if ip in self.asn_orgs:
+            return self.asn_orgs[ip]
+
+        ip_data = self.get_ip_info(ip, ips_info)
+        try:
+            asn_org = ip_data['asn']['asnorg']
+        except (KeyError, TypeError):
+            # No asn data for this ip
+            return None
+        if not asn_org or asn_org == 'Unknown':
+            return None
+
+        if len(self.asn_orgs) >= self.max_cached_asn_orgs:
+            self.asn_orgs.clear()
+        self.asn_orgs[ip] = asn_org
+        return asn_org
+
+    def is_whitelisted_asn_in_flow(
+            self,
+            ip: str,
+            direction: str,
+            ips_info: Optional[Dict[str, dict]] = None,
+    ) -> bool:
+        """
+        checks if the asn of the given ip belongs to any of the orgs
+        whitelisted in the given direction
+        """
+        ip_asn: Optional[str] = self.get_asn_org(ip, ips_info)
+        if not ip_asn:
+            return False
+        if ip_asn in self.flows_org_asns[direction]:
+            return True
+        ip_asn = ip_asn.lower()
+        return any(org in ip_asn for org in self.flows_org_names[direction])
+
     def is_whitelisted_flow(self, flow) -> bool:
         """
         Checks if the src IP or dst IP or domain or organization
          of this flow is whitelisted.
         """
+        if not self.is_flows_whitelist_compiled:
+            self.compile_flows_whitelist()
+
         saddr = flow.saddr
         daddr = flow.daddr
         flow_type = flow.type_
-        # get the domains of the IPs this flow
-        (
-            domains_to_check_dst,
-            domains_to_check_src,
-        ) = self.get_domains_of_flow(saddr, daddr)
-        # check if we have whitelisted domains
+        # the domains of the IPs of this flow are only retrieved from the db
+        # when there's a whitelisted domain or org to check them against
+        domains_of_flow = None
+        # {ip: its info in the db} of the src and dst ips of this flow
+        ips_info: Dict[str, dict] = {}
 
         # first get the domains of the flows we ewnt to check if whitelisted
         # Domain names are stored in different zeek files using different names.
@@ -222,53 +395,35 @@ class Whitelist(IObservable):
         elif flow_type == 'dns':
             domains_to_check.append(flow.query)
 
-
-        for domain in domains_to_check:
-            if self.is_whitelisted_domain(domain, saddr, daddr, 'flows'):
-                return True
-
-
-
-        if whitelisted_IPs := self.db.get_whitelist('IPs'):
-            # self.print('Check the IPs')
-            # Check if the IPs are whitelisted
-            ips_to_whitelist = list(whitelisted_IPs.keys())
-
-            if saddr in ips_to_whitelist:
-                # The flow has the src IP to whitelist
-                from_ = whitelisted_IPs[saddr]['from']
-                what_to_ignore = whitelisted_IPs[saddr]['what_to_ignore']
-                if ('src' in from_ or 'both' in from_) and (
-                        self.should_ignore_flows(what_to_ignore)
-                ):
-                    # self.print(f"Whitelisting the src IP {column_values['saddr']}")
+        if domains_to_check and self.flows_domains:
+            # Here we check subdomains too. If slack.com was whitelisted,
+            # then test.slack.com should be ignored too.
+            # But not 'slack.com.test'
+            for domain in domains_to_check:
+                if domain in self.flows_domains:
                     return True
 
-            if daddr in ips_to_whitelist:   # should be if and not elif
-                # The flow has the dst IP to whitelist
-                from_ = whitelisted_IPs[daddr]['from']
-                what_to_ignore = whitelisted_IPs[daddr]['what_to_ignore']
-                if ('dst' in from_ or 'both' in from_) and (
-                    self.should_ignore_flows(what_to_ignore)
-                ):
-                    # self.print(f"Whitelisting the dst IP
-                    # {column_values['daddr']}")
+            domains_to_check_dst, domains_to_check_src = (
+                domains_of_flow
+            ) = self.get_domains_of_flow(saddr, daddr, ips_info)
+            for domain in domains_to_check_src:
+                if domain and domain in self.flows_src_domains:
+                    return True
+            for domain in domains_to_check_dst:
+                if domain and domain in self.flows_dst_domains:
                     return True
 
-            if flow_type == 'dns':
-                # check all answers
-                for answer in flow.answers:
-                    if answer in ips_to_whitelist:
-                        # #TODO the direction doesn't matter here right?
-                        # direction = whitelisted_IPs[daddr]['from']
-                        what_to_ignore = whitelisted_IPs[answer]['what_to_ignore']
-                        if self.should_ignore_flows(what_to_ignore):
-                            # self.print(f"Whitelisting the IP {answer}
-                            # due to its presence in a dns answer")
-                            return True
+        if saddr in self.flows_src_ips or daddr in self.flows_dst_ips:
+            return True
 
+        if flow_type == 'dns' and self.flows_ips:
+            # check all answers
+            # #TODO the direction doesn't matter here right?
+            for answer in flow.answers:
+                if answer in self.flows_ips:
+                    return True
 
-        if whitelisted_macs := self.db.get_whitelist('mac'):
+        if self.flows_src_macs or self.flows_dst_macs:
             # try to get the mac address of the current flow
             src_mac = flow.smac if hasattr(flow, 'smac') else False
 
@@ -278,124 +433,68 @@ class Whitelist(IObservable):
                 ):
                     src_mac = src_mac[0]
 
-            if src_mac and src_mac in list(whitelisted_macs.keys()):
-                # the src mac of this flow is whitelisted, but which direction?
-                from_ = whitelisted_macs[src_mac]['from']
-                what_to_ignore = whitelisted_macs[src_mac]['what_to_ignore']
-
-                if (
-                    ('src' in from_ or 'both' in from_)
-                    and
-                    self.should_ignore_flows(what_to_ignore)
-                ):
-                    # self.print(f"The source MAC of this flow
-                    # {src_mac} is whitelisted")
-                    return True
+            if src_mac and src_mac in self.flows_src_macs:
+                return True
 
             dst_mac = flow.dmac if hasattr(flow, 'smac') else False
-            if dst_mac and dst_mac in list(whitelisted_macs.keys()):
-                # the dst mac of this flow is whitelisted, but which direction?
-                from_ = whitelisted_macs[dst_mac]['from']
-                what_to_ignore = whitelisted_macs[dst_mac]['what_to_ignore']
-
-                if (
-                    ('dst' in from_ or 'both' in from_)
-                    and
-                    self.should_ignore_flows(what_to_ignore)
-                ):
-                    # self.print(f"The dst MAC of this flow {dst_mac}
-                    # is whitelisted")
-                    return True
+            if dst_mac and dst_mac in self.flows_dst_macs:
+                return True
 
         if self.is_ignored_flow_type(flow_type):
             return False
 
-        if whitelisted_orgs := self.db.get_whitelist('organizations'):
-            # self.print('Check if the organization is whitelisted')
-            # Check if IP belongs to a whitelisted organization range
-            # Check if the ASN of this IP is any of these organizations
+        if not (self.flows_orgs['src'] or self.flows_orgs['dst']):
+            return False
 
-            for org in whitelisted_orgs:
-                from_ = whitelisted_orgs[org]['from']  # src or dst or both
-                what_to_ignore = whitelisted_orgs[org][
-                    'what_to_ignore'
-                ]  # flows, alerts or both
-                # self.print(f'Checking {org}, from:{from_} type {what_to_ignore}')
-
-                if self.should_ignore_flows(what_to_ignore):
-                    # We want to block flows from this org. get the domains
-                    # of this flow based on the direction.
-                    if 'both' in from_:
-                        domains_to_check = (
-                            domains_to_check_src + domains_to_check_dst
-                        )
-                    elif 'src' in from_:
-                        domains_to_check = domains_to_check_src
-                    elif 'dst' in from_:
-                        domains_to_check = domains_to_check_dst
-
-                    if 'src' in from_ or 'both' in from_:
-                        # Method 1 Check if src IP belongs to a whitelisted
-                        # organization range
-                        try:
-                            if self.is_ip_in_org(saddr, org):
-                                # self.print(f"The src IP {saddr} is in the
-                                # ranges of org {org}. Whitelisted.")
-                                return True
-                        except ValueError:
-                            # Some flows don't have IPs, but mac address or
-                            # just - in some cases
-                            return False
-
-                        # Method 2 Check if the ASN of this src IP is any of
-                        # these organizations
-                        if self.is_whitelisted_asn(saddr, org):
-                            # this ip belongs to a whitelisted org, ignore
-                            # flow
-                            # self.print(f"The src IP {saddr} belong to {org}.
-                            # Whitelisted because of ASN.")
-                            return True
-
-                    if 'dst' in from_ or 'both' in from_:
-                        # Method 1 Check if dst IP belongs to a whitelisted
-                        # organization range
-                        try:
-                            if self.is_ip_in_org(flow.daddr, org):
-                                # self.print(f"The dst IP
-                                # {column_values['daddr']} "
-                                #            f"is in the network range of org
-                                #            {org}. Whitelisted.")
-                                return True
-                        except ValueError:
-                            # Some flows don't have IPs, but mac address or
-                            # just - in some cases
-                            return False
-
-                        # Method 2 Check if the ASN of this dst IP is any of
-                        # these organizations
-                        if self.is_whitelisted_asn(daddr, org):
-                            # this ip belongs to a whitelisted org, ignore flow
-                            return True
-
-                    # either we're blocking src, dst, or both check the
-                    # domain of this flow
-                    # Method 3 Check if the domains of this flow belong
-                    # to this org
-                    # domains to check are usually 1 or 2 domains
-                    for flow_domain in domains_to_check:
-                        if self.is_domain_in_org(flow_domain, org):
-                            return True
+        # Method 1 Check if the IPs belong to a whitelisted
+        # organization range
+        if (
+            saddr in self.flows_org_ranges['src']
+            or daddr in self.flows_org_ranges['dst']
+        ):
+            return True
+
+        if domains_of_flow is None:
+            domains_of_flow = self.get_domains_of_flow(
+                saddr, daddr, ips_info
+            )
+        domains_to_check_dst, domains_to_check_src = domains_of_flow
+
+        for direction, ip, domains_to_check in (
+            ('src', saddr, domains_to_check_src),
+            ('dst', daddr, domains_to_check_dst),
+        ):
+            # Method 2 Check if the ASN of this IP is any of
+            # these organizations
+            if (
+                self.flows_orgs[direction]
+                and self.is_whitelisted_asn_in_flow(ip, direction, ips_info)
+            ):
+                return True
+
+            for org in self.flows_orgs[direction]:
+                # Method 3 Check if the domains of this flow belong
+                # to this org
+                # domains to check are usually 1 or 2 domains
+                for flow_domain in domains_to_check:
+                    if self.is_domain_in_org(
+                        flow_domain, org, org_domains=self.org_domains[org]
+                    ):
+                        return True
 
         return False
 
-    def is_domain_in_org(self, domain, org):
+    def is_domain_in_org(self, domain, org, org_domains=None):
         """
         Checks if the given domains belongs to the given org
+        :param org_domains: the domains of the given org, read from the db
+        if not given
         """
         try:
-            org_domains = json.loads(
-                self.db.get_org_info(org, 'domains')
-            )
+            if org_domains is None:
+                org_domains = json.loads(
+                    self.db.get_org_info(org, 'domains')
+                )
             if org in domain:
                 # self.print(f"The domain of this flow ({domain}) belongs to
                 # the domains of {org}")
@@ -587,20 +686,28 @@ class Whitelist(IObservable):
         self.db.set_whitelist('domains', whitelisted_domains)
         self.db.set_whitelist('organizations', whitelisted_orgs)
         self.db.set_whitelist('mac', whitelisted_mac)
+        # the whitelist changed, compile it again before checking
+        # the next flow
+        self.is_flows_whitelist_compiled = False
+        self.org_ranges = {}
 
         return whitelisted_IPs, whitelisted_domains, whitelisted_orgs, \
             whitelisted_mac
 
-    def get_domains_of_flow(self, saddr, daddr):
+    def get_domains_of_flow(
+            self, saddr, daddr, ips_info: Optional[Dict[str, dict]] = None
+    ):
         """
         Returns the domains of each ip (src and dst) that appeard in this flow
+        :param ips_info: the info of the ips of the flow, read from the db
+        if not given
         """
         # These separate lists, hold the domains that we should only
         # check if they are SRC or DST. Not both
         domains_to_check_src = []
         domains_to_check_dst = []
         try:
-            if ip_data := self.db.get_ip_info(saddr):
+            if ip_data := self.get_ip_info(saddr, ips_info):
                 if sni_info := ip_data.get('SNI', [{}])[0]:
                     domains_to_check_src.append(sni_info.get('server_name', ''))
         except (KeyError, TypeError):
@@ -614,7 +721,7 @@ class Whitelist(IObservable):
         except (KeyError, TypeError):
             pass
         try:
-            if ip_data := self.db.get_ip_info(daddr):
+            if ip_data := self.get_ip_info(daddr, ips_info):
                 if sni_info := ip_data.get('SNI', [{}])[0]:
                     domains_to_check_dst.append(sni_info.get('server_name'))
         except (KeyError, TypeError):
@@ -631,27 +738,32 @@ class Whitelist(IObservable):
 
         return domains_to_check_dst, domains_to_check_src
 
-    def is_ip_in_org(self, ip:str, org):
+    def get_org_ranges(self, org) -> IPRangeIndex:
         """
-        Check if the given ip belongs to the given org
+        returns an IPRangeIndex of the ranges of the given org
         """
-        try:
-            org_subnets: dict = self.db.get_org_IPs(org)
+        if org in self.org_ranges:
+            return self.org_ranges[org]
 
-            first_octet:str = utils.get_first_octet(ip)
-            if not first_octet:
-                return
-            ip_obj = ipaddress.ip_address(ip)
-            # organization IPs are sorted by first octet for faster search
-            for range in org_subnets.get(first_octet, []):
-                if ip_obj in ipaddress.ip_network(range):
-                    return True
-        except (KeyError, TypeError):
+        ranges = IPRangeIndex()
+        try:
+            # organization IPs are sorted by first octet
+            for org_subnets in self.db.get_org_IPs(org).values():
+                for range in org_subnets:
+                    ranges.add(range)
+        except (AttributeError, TypeError):
             # comes here if the whitelisted org doesn't have
             # info in slips/organizations_info (not a famous org)
-            # and ip doesn't have asn info.
             pass
-        return False
+
+        self.org_ranges[org] = ranges
+        return ranges
+
+    def is_ip_in_org(self, ip:str, org):
+        """
+        Check if the given ip belongs to the given org
+        """
+        return ip in self.get_org_ranges(org)
     
     def profile_has_whitelisted_mac(
             self, profile_ip, whitelisted_macs, direction: Direction
@@ -874,14 +986,12 @@ class Whitelist(IObservable):
             # see if the org has asn cached in our db
             asn_cache: dict = self.db.get_asn_cache()
             org_asn = []
-            # asn_cache is a dict sorted by first octet
-            for octet, range_info in asn_cache.items():
-                # range_info is a serialized dict of ranges
-                range_info = json.loads(range_info)
-                for range, asn_info in range_info.items():
-                    # we have the asn of this given org cached
-                    if org in asn_info['org'].lower():
-                        org_asn.append(org)
+            # asn_cache is a dict of ranges and their serialized asn info
+            for range, asn_info in asn_cache.items():
+                asn_info = json.loads(asn_info)
+                # we have the asn of this given org cached
+                if org in asn_info['org'].lower():
+                    org_asn.append(org)
 
         self.db.set_org_info(org, json.dumps(org_asn), 'asn')
         return org_asn
@@ -952,6 +1062,8 @@ class Whitelist(IObservable):
 
         # Store the IPs of this org
         self.db.set_org_info(org, json.dumps(org_subnets), 'IPs')
+        # the ranges of this org changed, load them again next time
+        self.org_ranges.pop(org, None)
         return org_subnets
 
     def is_ip_whitelisted(self, ip: str, direction: Direction):
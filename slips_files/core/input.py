@@ -12,8 +12,11 @@
 # GNU General Public License for more details.
 
 import datetime
+import heapq
 import json
 import os
+import queue
+import re
 import signal
 import subprocess
 import sys
@@ -23,6 +26,7 @@ import time
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 # Contact: eldraco@gmail.com, sebastian.garcia@agents.fel.cvut.cz, stratosphere@aic.fel.cvut.cz
+from collections import deque
 from pathlib import Path
 from re import split
 
@@ -55,6 +59,8 @@ class Input(ICore):
     """A class process to run the process of the flows"""
 
     name = "Input"
+    # the ts of zeek json lines, read without parsing the whole line
+    zeek_json_ts = re.compile(r'"ts":\s*([0-9.]+)')
 
     def init(
         self,
@@ -106,9 +112,21 @@ class Input(ICore):
         # used to give the profiler the total amount of flows to
         # read with the first flow only
         self.is_first_flow = True
+        # lines that couldn't be sent to the profiler because it stopped
+        self.dropped_lines = 0
         # is set by the profiler to tell this proc that we it is done processing
         # the input process and shut down and close the profiler queue no issue
         self.is_profiler_done_event = is_profiler_done_event
+        # how many lines to read from a zeek log file at once
+        self.read_ahead_lines = 100
+        # {filename: deque of (ts, line)} read from each file
+        # and not cached yet
+        self.read_ahead_buffers = {}
+        # min-heap of (ts, priority, filename) of the cached line of
+        # each file
+        self.earliest_lines = []
+        # set by the file monitor when zeek creates a new log file
+        self.new_zeek_file_created = threading.Event()
 
     def is_done_processing(self):
         """
@@ -122,9 +140,19 @@ class Input(ICore):
             f"Telling Profiler to stop because " f"no more input is arriving.",
             log_to_logfiles_only=True,
         )
-        self.profiler_queue.put("stop")
-        self.print(f"Waiting for Profiler to stop.", log_to_logfiles_only=True)
-        self.is_profiler_done_event.wait()
+        try:
+            self.profiler_queue.put("stop", stop=self.termination_event)
+            self.print(
+                f"Waiting for Profiler to stop.", log_to_logfiles_only=True
+            )
+            self.is_profiler_done_event.wait()
+        except queue.Full:
+            # slips is stopping and the profiler isn't reading anymore
+            self.print(
+                "Couldn't tell the Profiler to stop, it isn't reading "
+                "the input anymore.",
+                log_to_logfiles_only=True,
+            )
         self.print(f"Input is done processing.", log_to_logfiles_only=True)
         self.done_processing.release()
 
@@ -140,11 +168,9 @@ class Input(ICore):
 
     def stop_queues(self):
         """Stops the profiler queue"""
-        # By default if a process is not the creator of the queue then on
-        # exit it will attempt to join the queue’s background thread. The
-        # process can call cancel_join_thread() to make join_thread()
-        # do nothing.
-        self.profiler_queue.cancel_join_thread()
+        # detaches this process from the shared memory of the queue,
+        # the process manager frees it
+        self.profiler_queue.close()
 
     def read_nfdump_output(self) -> int:
         """
@@ -236,13 +262,18 @@ class Input(ICore):
             nline_list = nline.split("\t") if "\t" in nline else split(r"\s{2,}", nline)
             timestamp = nline_list[0]
         else:
-            try:
-                nline = json.loads(zeek_line)
-            except json.decoder.JSONDecodeError:
-                return False, False
-            # In some Zeek files there may not be a ts field
-            # Like in some weird smb files
-            timestamp = nline.get("ts", 0)
+            # the line is sent to the profiler as it is and parsed there,
+            # only its ts is needed here
+            nline = zeek_line
+            if match := self.zeek_json_ts.search(zeek_line):
+                timestamp = match.group(1)
+            else:
+                try:
+                    # In some Zeek files there may not be a ts field
+                    # Like in some weird smb files
+                    timestamp = json.loads(zeek_line).get("ts", 0)
+                except (json.decoder.JSONDecodeError, AttributeError):
+                    return False, False
         try:
             timestamp = float(timestamp)
         except ValueError:
@@ -251,42 +282,69 @@ class Input(ICore):
 
         return timestamp, nline
 
-    def cache_nxt_line_in_file(self, filename: str):
+    def read_ahead(self, filename: str) -> bool:
         """
-        reads 1 line of the given file and stores in queue for sending to the profiler
+        reads the next read_ahead_lines lines of the given file and stores
+        them in the file's read ahead buffer
+        returns True if the buffer has lines to cache
         :param: full path to the file. includes the .log extension
         """
         file_handle = self.get_file_handle(filename)
         if not file_handle:
             return False
 
-        # Only read the next line if the previous line from this file was sent to profiler
-        if filename in self.cache_lines:
-            # We have still something to send, do not read the next line from this file
-            return False
+        buffer = self.read_ahead_buffers.setdefault(filename, deque())
+        for _ in range(self.read_ahead_lines):
+            try:
+                zeek_line = file_handle.readline()
+            except ValueError:
+                # remover thread just finished closing all old handles.
+                # comes here if I/O operation failed due to a closed file.
+                # to get the new dict of open handles.
+                break
 
-        # We don't have any waiting line for this file, so proceed
-        try:
-            zeek_line = file_handle.readline()
-        except ValueError:
-            # remover thread just finished closing all old handles.
-            # comes here if I/O operation failed due to a closed file.
-            # to get the new dict of open handles.
-            return False
+            # Did the file end?
+            if not zeek_line:
+                # We reached the end of one of the files that we were
+                # reading. Wait for more lines to come from another file
+                break
+
+            if zeek_line.startswith("#"):
+                continue
 
-        # Did the file end?
-        if not zeek_line or zeek_line.startswith("#"):
-            # We reached the end of one of the files that we were reading.
-            # Wait for more lines to come from another file
+            timestamp, nline = self.get_ts_from_line(zeek_line)
+            if not timestamp:
+                continue
+            buffer.append((timestamp, nline))
+
+        return bool(buffer)
+
+    def cache_nxt_line_in_file(self, filename: str):
+        """
+        caches the next line of the given file for sending to the profiler
+        and adds it to the heap of earliest lines
+        :param: full path to the file. includes the .log extension
+        """
+        # Only cache the next line if the previous line from this file was sent to profiler
+        if filename in self.cache_lines:
+            # We have still something to send, do not read the next line from this file
             return False
 
-        timestamp, nline = self.get_ts_from_line(zeek_line)
-        if not timestamp:
+        # lines are read from disk in blocks, only read the next block
+        # when we're done with the current one
+        if (
+            not self.read_ahead_buffers.get(filename)
+            and not self.read_ahead(filename)
+        ):
             return False
 
-        self.file_time[filename] = timestamp
+        timestamp, nline = self.read_ahead_buffers[filename].popleft()
         # Store the line in the cache
         self.cache_lines[filename] = {"type": filename, "data": nline}
+        # when 2 lines have the same ts, the dns line is sent first to
+        # avoid FP connection without dns resolution alerts
+        priority = 0 if Path(filename).stem == "dns" else 1
+        heapq.heappush(self.earliest_lines, (timestamp, priority, filename))
         return True
 
     def reached_timeout(self) -> bool:
@@ -317,21 +375,17 @@ class Input(ICore):
 
     def get_earliest_line(self):
         """
-        loops through all the caches lines and returns the line with the
-        earliest ts
+        pops the cached line with the earliest ts from the heap of
+        cached lines and returns it with the file it was read from
         """
         # Now read lines in order. The line with the earliest timestamp first
-        files_sorted_by_ts = sorted(self.file_time, key=self.file_time.get)
         try:
             # get the file that has the earliest flow
-            file_with_earliest_flow = files_sorted_by_ts[0]
+            _, _, file_with_earliest_flow = heapq.heappop(
+                self.earliest_lines
+            )
         except IndexError:
-            # No more sorted keys. Just loop waiting for more lines
-            # It may happen that we check all the files in the folder,
-            # and there is still no files for us.
-            # To cover this case, just refresh the list of files
-            self.zeek_files = self.db.get_all_zeek_files()
-            # time.sleep(1)
+            # No cached lines. Just loop waiting for more lines
             return False, False
 
         # to fix the problem of evidence being generated BEFORE their corresponding flows are added to our db
@@ -347,24 +401,47 @@ class Input(ICore):
         earliest_line = self.cache_lines[file_with_earliest_flow]
         return earliest_line, file_with_earliest_flow
 
+    def update_zeek_files(self):
+        """
+        gets the list of zeek files to read from the db.
+        called when the file monitor tells us that zeek created a new file
+        """
+        self.new_zeek_file_created.clear()
+        self.zeek_files = [
+            filename
+            for filename in self.db.get_all_zeek_files()
+            if not self.is_ignored_file(filename)
+        ]
+
     def read_zeek_files(self) -> int:
-        self.zeek_files = self.db.get_all_zeek_files()
+        self.update_zeek_files()
         self.open_file_handlers = {}
-        self.file_time = {}
         self.cache_lines = {}
+        self.read_ahead_buffers = {}
+        self.earliest_lines = []
         # Try to keep track of when was the last update so we stop this reading
         self.last_updated_file_time = datetime.datetime.now()
+        # the file of the last line sent, the only file that needs a new
+        # line cached
+        file_with_earliest_flow = None
         while not self.should_stop():
             self.check_if_time_to_del_rotated_files()
-            # Go to all the files generated by Zeek and read 1
-            # line from each of them
-            for filename in self.zeek_files:
-                if self.is_ignored_file(filename):
-                    continue
+            if self.new_zeek_file_created.is_set():
+                self.update_zeek_files()
 
+            if file_with_earliest_flow:
                 # reads 1 line from the given file and cache it
                 # from in self.cache_lines
-                self.cache_nxt_line_in_file(filename)
+                self.cache_nxt_line_in_file(file_with_earliest_flow)
+
+            if (
+                not self.earliest_lines
+                or self.lines % self.read_ahead_lines == 0
+            ):
+                # check the files that had no new lines the last time
+                # we read them, new lines may have been written to them
+                for filename in self.zeek_files:
+                    self.cache_nxt_line_in_file(filename)
 
             if self.reached_timeout():
                 break
@@ -380,12 +457,8 @@ class Input(ICore):
             # when testing, no need to read the whole file!
             if self.lines == 10 and self.testing:
                 break
-            # Delete this line from the cache and the time list
+            # Delete this line from the cache
             del self.cache_lines[file_with_earliest_flow]
-            del self.file_time[file_with_earliest_flow]
-            # Get the new list of files. Since new files may have been created by
-            # Zeek while we were processing them.
-            self.zeek_files = self.db.get_all_zeek_files()
 
         self.close_all_handles()
         return self.lines
@@ -622,7 +695,12 @@ class Input(ICore):
         # some process to tell us which files to read in real time when they appear
         # Get the file eventhandler
         # We have to set event_handler and event_observer before running zeek.
-        event_handler = FileEventHandler(self.zeek_dir, self.input_type, self.db)
+        event_handler = FileEventHandler(
+            self.zeek_dir,
+            self.input_type,
+            self.db,
+            new_zeek_file_created=self.new_zeek_file_created,
+        )
         # Create an observer
         self.event_observer = Observer()
         # Schedule the observer with the callback on the file handler
@@ -898,9 +976,19 @@ class Input(ICore):
                     "total_flows": self.total_flows,
                 }
             )
-        # when the queue is full, the default behaviour is to block
-        # if necessary until a free slot is available
-        self.profiler_queue.put(to_send)
+        # when the queue is full, this blocks until the profiler
+        # reads enough lines or slips is stopping
+        try:
+            self.profiler_queue.put(to_send, stop=self.termination_event)
+        except queue.Full:
+            self.dropped_lines += 1
+            if self.dropped_lines == 1:
+                self.print(
+                    "Dropping the lines read, the Profiler isn't reading "
+                    "the input anymore.",
+                    0,
+                    1,
+                )
 
     def main(self):
         utils.drop_root_privs()
@@ -1,3 +1,4 @@
+import json
 from re import split
 
 from slips_files.common.abstracts.input_type import IInputType
@@ -19,6 +20,13 @@ class ZeekJSON(IInputType):
         (parse them into column_values dict) to send to the database
         """
         line = new_line['data']
+        if isinstance(line, str):
+            # zeek json lines are sent by the input process as they were
+            # read, they're parsed here
+            try:
+                line = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                return False
         file_type = new_line['type']
         # all zeek lines recieved from stdin should be of type conn
         if file_type in ('stdin', 'external_module') \
@@ -17,7 +17,9 @@
 # stratosphere@aic.fel.cvut.cz
 from dataclasses import asdict
 import queue
+import time
 import ipaddress
+import zlib
 import pprint
 from datetime import datetime
 from typing import List
@@ -62,6 +64,9 @@ class Profiler(ICore):
              profiler_queue=None,
              is_profiler_done_event : multiprocessing.Event =None,
              has_pbar: bool =False,
+             workers_queues: List[multiprocessing.Queue] = None,
+             workers_done: List[multiprocessing.Event] = None,
+             worker_id: int = None,
              ):
         # when profiler is done processing, it releases this semaphore,
         # that's how the process_manager knows it's done
@@ -75,6 +80,7 @@ class Profiler(ICore):
         self.whitelisted_flows_ctr = 0
         self.rec_lines = 0
         self.is_localnet_set = False
+        self.is_first_flow_time_set = False
         self.has_pbar = has_pbar
         self.whitelist = Whitelist(self.logger, self.db)
         self.read_configuration()
@@ -89,6 +95,18 @@ class Profiler(ICore):
         # is set by this proc to tell input proc that we are done
         # processing and it can exit no issue
         self.is_profiler_done_event = is_profiler_done_event
+        # number of flows added to the current batch
+        self.flows_in_batch = 0
+        self.batch_start_time = 0
+        # when profiler_workers is > 1, this process parses the flows and
+        # sends each one of them to the queue of the worker that profiles it
+        self.workers_queues: List[multiprocessing.Queue] = workers_queues
+        # each worker sets its event when it's done profiling its flows
+        self.workers_done: List[multiprocessing.Event] = workers_done
+        # is set only if this process is one of the profiler workers
+        self.worker_id = worker_id
+        if self.is_worker():
+            self.name = f'ProfilerWorker{worker_id}'
 
 
     def read_configuration(self):
@@ -99,6 +117,8 @@ class Profiler(ICore):
         self.label = conf.label()
         self.width = conf.get_tw_width_as_float()
         self.client_ips: List[str] = conf.client_ips()
+        self.batch_size: int = conf.profiler_batch_size()
+        self.batch_timeout: float = conf.profiler_batch_timeout()
 
 
     def convert_starttime_to_epoch(self):
@@ -132,13 +152,16 @@ class Profiler(ICore):
             self.flow.starttime, rev_profileid)
         return rev_profileid, rev_twid
 
-    def add_flow_to_profile(self):
+    def add_flow_to_profile(self, store_out=True, store_in=True):
         """
         This is the main function that takes the columns of a flow
         and does all the magic to convert it into a working data in our
         system.
         It includes checking if the profile exists and how to put
         the flow correctly. It interprets each column
+        :param store_out: store the flow in the profile of the saddr
+        :param store_in: store the flow in the profile of the daddr when
+        analysis_direction is 'all'
         """
         # try:
         if not hasattr(self, 'flow'):
@@ -165,7 +188,7 @@ class Profiler(ICore):
 
         # Check if the flow is whitelisted and we should not process
         if self.whitelist.is_whitelisted_flow(self.flow):
-            if 'conn' in self.flow.type_:
+            if 'conn' in self.flow.type_ and store_out:
                 self.whitelisted_flows_ctr +=1
             return True
 
@@ -180,10 +203,13 @@ class Profiler(ICore):
         self.twid = self.db.get_timewindow(self.flow.starttime, self.profileid)
         self.flow_parser.twid = self.twid
 
-        # Create profiles for all ips we see
-        self.db.add_profile(self.profileid, self.flow.starttime, self.width)
-        self.store_features_going_out()
-        if self.analysis_direction == 'all':
+        if store_out:
+            # Create profiles for all ips we see
+            self.db.add_profile(
+                self.profileid, self.flow.starttime, self.width
+            )
+            self.store_features_going_out()
+        if self.analysis_direction == 'all' and store_in:
             self.handle_in_flows()
 
         if self.db.is_cyst_enabled():
@@ -324,7 +350,8 @@ class Profiler(ICore):
         if input_type in ('zeek_folder', 'zeek_log_file', 'pcap', 'interface'):
             # is it tab separated or comma separated?
             actual_line = line['data']
-            if type(actual_line) == dict:
+            # json lines are sent as they were read from the file
+            if type(actual_line) == dict or actual_line.startswith('{'):
                 return 'zeek'
             return 'zeek-tabs'
         elif input_type in ('stdin'):
@@ -338,6 +365,8 @@ class Profiler(ICore):
 
 
     def shutdown_gracefully(self):
+        # store the flows that are still waiting in the batch
+        self.commit_batch()
         self.print(f"Stopping. Total lines read: {self.rec_lines}",
                    log_to_logfiles_only=True)
         # By default if a process(profiler) is not the creator of
@@ -352,6 +381,11 @@ class Profiler(ICore):
         is called to mark this process as done processing so
         slips.py would know when to terminate
         """
+        if self.is_worker():
+            # tell the main profiler process that this worker is done
+            self.is_profiler_done_event.set()
+            return
+
         # signal slips.py that this process is done
         self.print(f"Marking Profiler as done processing.",
                    log_to_logfiles_only=True)
@@ -363,6 +397,118 @@ class Profiler(ICore):
                    f"that it's done processing.", log_to_logfiles_only=True)
 
 
+    def is_worker(self) -> bool:
+        return self.worker_id is not None
+
+    def run(self):
+        try:
+            return super().run()
+        finally:
+            if self.is_worker():
+                # the main profiler waits for this event, set it even if
+                # this worker stopped because of an error
+                self.is_profiler_done_event.set()
+
+    def get_worker_of_ip(self, ip: str) -> int:
+        """
+        returns the index of the worker that profiles all the flows
+        of the given ip
+        """
+        return zlib.crc32(ip.encode()) % len(self.workers_queues)
+
+    def send_flow_to_workers(self):
+        """
+        sends the current flow to the worker of its saddr, and to the
+        worker of its daddr to be stored in the reverse profile.
+        since all the flows of an ip are profiled by the same worker,
+        the flows of each profile are still stored in order
+        """
+        # the uid has to be the same in both profiles
+        FlowHandler(self.db, self.symbol, self.flow).make_sure_theres_a_uid()
+
+        out_worker: int = self.get_worker_of_ip(self.flow.saddr)
+        in_worker = None
+        if self.analysis_direction == 'all' and self.flow.daddr:
+            in_worker: int = self.get_worker_of_ip(self.flow.daddr)
+
+        if in_worker is None or in_worker == out_worker:
+            self.workers_queues[out_worker].put({
+                'flow': self.flow,
+                'store_out': True,
+                'store_in': True,
+            })
+            return
+
+        self.workers_queues[out_worker].put({
+            'flow': self.flow,
+            'store_out': True,
+            'store_in': False,
+        })
+        self.workers_queues[in_worker].put({
+            'flow': self.flow,
+            'store_out': False,
+            'store_in': True,
+        })
+
+    def stop_workers(self):
+        """
+        tells the workers that no more flows are coming and waits for
+        them to profile the flows left in their queues
+        """
+        if not self.workers_queues:
+            return
+
+        for worker_queue in self.workers_queues:
+            worker_queue.put('stop')
+        self.print(f"Waiting for the profiler workers to stop.",
+                   log_to_logfiles_only=True)
+        for worker_done in self.workers_done:
+            # a worker that stopped because slips is terminating may not
+            # get to profile its flows, don't wait for it forever
+            while not worker_done.wait(timeout=1):
+                if self.termination_event.is_set():
+                    return
+
+    def is_batching_enabled(self) -> bool:
+        return self.batch_size > 1
+
+    def add_flow_to_batch(self):
+        """
+        makes sure the flows are stored in a batch when batching is
+        enabled in slips.conf
+        """
+        if not self.is_batching_enabled():
+            return
+
+        if not self.db.is_batching():
+            self.db.start_batch()
+            self.batch_start_time = time.time()
+        self.flows_in_batch += 1
+
+    def should_commit_batch(self) -> bool:
+        """
+        the batch is stored in the db when it's full or when
+        its oldest flow waited for profiler_batch_timeout
+        """
+        if not self.flows_in_batch:
+            return False
+
+        return (
+            self.flows_in_batch >= self.batch_size
+            or time.time() - self.batch_start_time >= self.batch_timeout
+        )
+
+    def commit_batch(self):
+        """
+        stores all the profile and tw changes of the current batch in the db
+        """
+        if not self.flows_in_batch:
+            return
+        try:
+            self.db.commit_batch()
+        finally:
+            self.flows_in_batch = 0
+
     def check_for_stop_msg(self, msg: str)-> bool:
         """
         this 'stop' msg is the last msg ever sent by the input process
@@ -372,6 +518,7 @@ class Profiler(ICore):
         if msg != 'stop':
             return False
 
+        self.stop_workers()
         self.print(f"Stopping profiler process. Number of whitelisted "
                    f"conn flows: "
                    f"{self.whitelisted_flows_ctr}", 2, 0)
@@ -440,15 +587,63 @@ class Profiler(ICore):
         local_net: str = self.get_local_net()
         self.db.set_local_network(local_net)
     
+    def handle_setting_first_flow_time(self):
+        """
+        stores the start of the first flow of the input, the timewindows
+        of all profiles start from it.
+        it's set here once, before the flow is sent to the workers,
+        the workers only read it
+        """
+        if self.is_first_flow_time_set:
+            return
+        self.db.set_first_flow_time(self.flow.starttime)
+        self.is_first_flow_time_set = True
+
     def pre_main(self):
         utils.drop_root_privs()
     
+    def run_worker(self):
+        """
+        profiles the flows the main profiler process sends to this worker
+        """
+        while not self.should_stop():
+            try:
+                msg = self.profiler_queue.get(timeout=self.batch_timeout or 1)
+                if self.check_for_stop_msg(msg):
+                    return 1
+            except queue.Empty:
+                # no new flows, don't keep the ones we have waiting
+                if self.should_commit_batch():
+                    self.commit_batch()
+                continue
+            except Exception as e:
+                # ValueError is raised when the queue is closed
+                continue
+
+            self.rec_lines += 1
+            self.flow = msg['flow']
+            self.add_flow_to_batch()
+            self.add_flow_to_profile(
+                store_out=msg['store_out'], store_in=msg['store_in']
+            )
+            if self.should_commit_batch():
+                self.commit_batch()
+
+            if self.get_msg('reload_whitelist'):
+                self.whitelist.read_whitelist()
+        return 1
+
     def main(self):
+        if self.is_worker():
+            return self.run_worker()
+
         while not self.should_stop():
             try:
                 # this msg can be a str only when it's a 'stop' msg indicating
                 # that this module should stop
-                msg = self.profiler_queue.get(timeout=1, block=False)
+                # the input process sends the lines through a ring buffer
+                # in shared memory, they're read in batches
+                msg = self.profiler_queue.get(timeout=self.batch_timeout or 1)
                 # ALYA, DO NOT REMOVE THIS CHECK
                 # without it, there's no way thi module will know it's time to
                 # stop and no new fows are coming
@@ -458,6 +653,9 @@ class Profiler(ICore):
                 input_type: str = msg['input_type']
                 total_flows: int = msg.get('total_flows', 0)
             except queue.Empty:
+                # no new flows, don't keep the ones we have waiting
+                if self.should_commit_batch():
+                    self.commit_batch()
                 continue
             except Exception as e:
                 # ValueError is raised when the queue is closed
@@ -493,9 +691,17 @@ class Profiler(ICore):
             # get the correct input type class and process the line based on it
             self.flow = self.input.process_line(line)
             if self.flow:
-                self.add_flow_to_profile()
+                self.handle_setting_first_flow_time()
+                if self.workers_queues:
+                    self.send_flow_to_workers()
+                else:
+                    self.add_flow_to_batch()
+                    self.add_flow_to_profile()
                 self.handle_setting_local_net()
 
+            if self.should_commit_batch():
+                self.commit_batch()
+
             # now that one flow is processed tell output.py
             # to update the bar
             if self.has_pbar:
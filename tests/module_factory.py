@@ -27,6 +27,7 @@ from slips_files.core.helpers.symbols_handler import SymbolHandler
 from modules.network_discovery.horizontal_portscan import HorizontalPortscan
 from modules.network_discovery.vertical_portscan import VerticalPortscan
 from modules.arp.arp import ARP
+from modules.flowmldetection.flowmldetection import FlowMLDetection
 
 
 
@@ -143,6 +144,18 @@ class ModuleFactory:
         flowalerts.print = do_nothing
         return flowalerts
 
+    def create_flowmldetection_obj(self, mock_db):
+        with patch.object(DBManager, 'create_sqlite_db', return_value=Mock()):
+            flowmldetection = FlowMLDetection(self.logger,
+                                              'dummy_output_dir',
+                                              6379,
+                                              self.dummy_termination_event)
+            flowmldetection.db.rdb = mock_db
+
+        # override the self.print function to avoid broken pipes
+        flowmldetection.print = do_nothing
+        return flowmldetection
+
     def create_inputProcess_obj(
             self, input_information, input_type, mock_db, line_type=False
             ):
@@ -3,11 +3,14 @@ import os
 import json
 import time
 import pytest
+from unittest.mock import Mock
 
 from slips_files.common.slips_utils import utils
 from slips_files.core.flows.zeek import Conn
 from slips_files.common.slips_utils import utils
 from tests.module_factory import ModuleFactory
+from slips_files.core.database.redis_db.sharded_redis import ShardedRedis
+from slips_files.common.ioc_snapshot import IoCSnapshot
 from slips_files.core.evidence_structure.evidence import (
     dict_to_evidence,
     Evidence,
@@ -94,21 +97,108 @@ def test_add_ips():
     assert (
         db.add_ips(profileid, twid, flow, 'Server') is True
     )
-    hash_id = f'{profileid}_{twid}'
-    stored_dstips = db.r.hget(hash_id, 'SrcIPs')
-    assert stored_dstips == '{"192.168.1.1": 1}'
+    stored_srcips = db.get_srcips_from_profile_tw(profileid, twid)
+    assert stored_srcips == '{"192.168.1.1": 1}'
+    ip_stats = db.get_data_from_profile_tw(
+        profileid, twid, 'Src', 'Not Established', 'TCP', 'Server', 'IPs'
+    )
+    assert ip_stats['192.168.1.1']['totalflows'] == 1
+    assert ip_stats['192.168.1.1']['uid'] == [flow.uid]
 
 
 def test_add_port():
     new_flow = flow
     new_flow.state = 'Not Established'
     db.add_port(profileid, twid, flow, 'Server', 'Dst')
-    hash_key = f'{profileid}_{twid}'
-    added_ports = db.r.hgetall(hash_key)
-    assert 'DstPortsServerTCPNot Established' in added_ports.keys()
-    assert flow.daddr in added_ports['DstPortsServerTCPNot Established']
+    added_ports = db.get_data_from_profile_tw(
+        profileid, twid, 'Dst', 'Not Established', 'TCP', 'Server', 'Ports'
+    )
+    port_data = added_ports[str(flow.dport)]
+    assert port_data['totalflows'] == 1
+    assert flow.daddr in port_data['srcips']
+
+
+def test_profile_tw_batch():
+    db.start_batch()
+    db.add_port(profileid, 'timewindow5', flow, 'Server', 'Dst')
+    db.add_tuple(
+        profileid, 'timewindow5', '8.8.8.8-80-tcp', ('1', (False, False)),
+        'Client', flow
+    )
+    hash_key = f'{profileid}_timewindow5'
+    # the counters are queued in the batch pipeline, they aren't stored
+    # before committing the batch. only detection modules read them and
+    # they never batch
+    assert not db.get_data_from_profile_tw(
+        profileid, 'timewindow5', 'Dst', 'Not Established', 'TCP', 'Server',
+        'Ports'
+    )
+    # the tuples are read by the profiler while profiling the flows of
+    # the batch, so the uncommitted ones are visible to the batch itself
+    assert not db.r.hgetall(f'{hash_key}_OutTuples')
+    assert '8.8.8.8-80-tcp' in json.loads(
+        db.get_outtuples_from_profile_tw(profileid, 'timewindow5')
+    )
+    db.commit_batch()
+    assert db.get_data_from_profile_tw(
+        profileid, 'timewindow5', 'Dst', 'Not Established', 'TCP', 'Server',
+        'Ports'
+    )
+    assert db.r.zscore('ModifiedTW', hash_key)
+
+
+def test_failed_batch():
+    db.start_batch()
+    db.add_port(profileid, 'timewindow6', flow, 'Server', 'Dst')
+    db.rdb.batch_pipe.execute = Mock(
+        side_effect=redis.exceptions.ConnectionError
+    )
+    db.commit_batch()
+    # the failed batch is dropped and the next writes aren't buffered
+    assert not db.is_batching()
+    assert not db.rdb.pending_modified_tws
+    db.add_port(profileid, 'timewindow6', flow, 'Server', 'Dst')
+    assert db.get_data_from_profile_tw(
+        profileid, 'timewindow6', 'Dst', 'Not Established', 'TCP', 'Server',
+        'Ports'
+    )
 
 
+def test_sqlite_flows_batch():
+    batch_flow = Conn(
+        '1601998398.945854', 'batched_uid', test_ip, '8.8.8.8', 5, 'TCP',
+        'dhcp', 80, 88, 20, 20, 20, 20, '', '', 'Established', ''
+    )
+    db.start_batch()
+    db.sqlite.add_flow(batch_flow, profileid, twid)
+    # the flow is written when the batch is committed
+    assert db.get_flow('batched_uid') == {'batched_uid': {}}
+    db.commit_batch()
+    assert db.get_flow('batched_uid')['batched_uid']
+    db.sqlite.execute('PRAGMA journal_mode')
+    assert db.sqlite.fetchone()[0] == 'wal'
+
+
+
+def test_get_sent_bytes_per_daddr():
+    profile = 'profile_192.168.1.2'
+    for uid, daddr, sbytes, tw in (
+        ('sent_uid1', '1.1.1.1', 100, twid),
+        ('sent_uid2', '1.1.1.1', 50, twid),
+        ('sent_uid3', '2.2.2.2', 0, twid),
+        ('sent_uid4', '1.1.1.1', 500, 'timewindow2'),
+    ):
+        sent_flow = Conn(
+            '1601998398.945854', uid, '192.168.1.2', daddr, 5, 'TCP',
+            'dhcp', 80, 88, 20, 20, sbytes, 20, '', '', 'Established', ''
+        )
+        db.sqlite.add_flow(sent_flow, profile, tw)
+    # flows without sent bytes and flows of other tws aren't counted
+    sbytes, uids, ts = db.get_sent_bytes_per_daddr(profile, twid)['1.1.1.1']
+    assert sbytes == 150
+    assert sorted(uids) == ['sent_uid1', 'sent_uid2']
+    assert list(db.get_sent_bytes_per_daddr(profile, twid)) == ['1.1.1.1']
+
 def test_set_evidence():
     attacker: Attacker = Attacker(
             direction=Direction.SRC,
@@ -144,6 +234,36 @@ def test_set_evidence():
     assert added
 
 
+def test_evidence_batch():
+    evidence: Evidence = Evidence(
+            evidence_type=EvidenceType.SSH_SUCCESSFUL,
+            attacker=Attacker(
+                direction=Direction.SRC,
+                attacker_type=IoCType.IP,
+                value=test_ip
+            ),
+            victim=None,
+            threat_level=ThreatLevel.HIGH,
+            confidence=0.8,
+            description='batched evidence',
+            profile=ProfileID(ip=test_ip),
+            timewindow=TimeWindow(number=2),
+            uid=['456'],
+            timestamp=time.time(),
+            category=IDEACategory.INFO,
+        )
+    evidence_key = f'{profileid}_timewindow2_evidence'
+    db.start_evidence_batch()
+    db.set_evidence(evidence)
+    # nothing is stored before committing the batch
+    assert not db.r.hget(evidence_key, evidence.id)
+    db.commit_evidence_batch()
+    db.end_evidence_batch()
+    assert db.r.hget(evidence_key, evidence.id)
+    assert db.get_flows_causing_evidence(evidence.id) == ['456']
+    assert db.r.hget(profileid, 'max_threat_level') == 'high'
+
+
 
 def test_setInfoForDomains():
     """ tests setInfoForDomains, setNewDomain and getDomainData """
@@ -222,7 +342,10 @@ def test_get_the_other_ip_version():
 )
 def test_add_tuple(tupleid: str, symbol, expected_direction, role, flow):
     db.add_tuple(profileid, twid, tupleid, symbol, role, flow)
-    assert symbol[0] in db.r.hget(f'profile_{flow.saddr}_{twid}', expected_direction)
+    tuple_info = db.r.hget(
+        f'profile_{flow.saddr}_{twid}_{expected_direction}', tupleid
+    )
+    assert symbol[0] in json.loads(tuple_info)[0]
 
 
 @pytest.mark.parametrize(
@@ -238,4 +361,249 @@ def test_update_max_threat_level(
     ):
     db.set_max_threat_level(profileid, max_threat_level)
     assert db.update_max_threat_level(
-        profileid, cur_threat_level) == expected_max
\ No newline at end of file
+        profileid, cur_threat_level) == expected_max
+
+@pytest.mark.parametrize(
+    'domain, expected_is_subdomain',
+    [
+        ('malicious.com', False),
+        ('images.malicious.com', True),
+        ('a.b.malicious.com', True),
+        ('notmalicious.com', None),
+        ('malicious.com.benign', None),
+    ],
+)
+def test_is_domain_malicious(domain, expected_is_subdomain):
+    description = json.dumps({'source': 'test_feed'})
+    db.add_domains_to_IoC({'malicious.com': description})
+    found_description, is_subdomain = db.is_domain_malicious(domain)
+    if expected_is_subdomain is None:
+        assert found_description is False
+    else:
+        assert found_description == description
+        assert is_subdomain == expected_is_subdomain
+
+
+def test_delete_IoCs_of_source():
+    db.add_ips_to_IoC(
+        {
+            '5.5.5.5': json.dumps({'source': 'old_feed.txt'}),
+            '6.6.6.6': json.dumps({'source': 'old_feed.txt'}),
+        },
+        source='old_feed.txt'
+    )
+    # 6.6.6.6 is now owned by another feed
+    db.add_ips_to_IoC(
+        {'6.6.6.6': json.dumps({'source': 'new_feed.txt'})},
+        source='new_feed.txt'
+    )
+    # 7.7.7.7 is in both feeds
+    db.add_ips_to_IoC(
+        {'7.7.7.7': json.dumps({'source': 'old_feed.txt, new_feed.txt'})},
+        source='old_feed.txt'
+    )
+    db.delete_IoCs_of_source('old_feed.txt')
+    assert db.search_IP_in_IoC('5.5.5.5') is False
+    assert db.search_IP_in_IoC('6.6.6.6')
+    assert db.search_IP_in_IoC('7.7.7.7')
+
+
+def test_delete_feed():
+    db.add_ips_to_IoC(
+        {
+            '5.5.5.5': json.dumps({'source': 'dropped_feed.txt'}),
+            '7.7.7.7': json.dumps(
+                {'source': 'dropped_feed.txt, kept_feed.txt'}
+            ),
+        },
+        source='dropped_feed.txt'
+    )
+    # stored before the IoCs were indexed by source
+    db.rdb.rcache.hset(
+        'IoC_ips', '8.8.4.4', json.dumps({'source': 'unindexed_feed.txt'})
+    )
+    db.delete_feed('https://example.com/dropped_feed.txt')
+    db.delete_feed('https://example.com/unindexed_feed.txt')
+    assert db.search_IP_in_IoC('5.5.5.5') is False
+    assert db.search_IP_in_IoC('8.8.4.4') is False
+    # only the dropped feed is removed from the IoCs of many feeds
+    assert json.loads(db.search_IP_in_IoC('7.7.7.7'))['source'] == (
+        'kept_feed.txt'
+    )
+
+
+def test_ioc_snapshot_is_up_to_date(tmp_path):
+    db.rdb.ioc_snapshot_path = str(tmp_path / 'ioc_snapshot.bin')
+    db.rdb.ioc_snapshot = IoCSnapshot(db.rdb.ioc_snapshot_path)
+    try:
+        db.add_ips_to_IoC(
+            {'9.9.9.9': json.dumps({'source': 'snapshot_feed.txt'})},
+            source='snapshot_feed.txt'
+        )
+        db.add_domains_to_IoC(
+            {
+                'example.org': json.dumps({'source': 'snapshot_feed.txt'}),
+                'www.example.org': json.dumps({'source': 'other_feed.txt'}),
+            },
+        )
+        db.write_IoC_snapshot()
+        db.rdb.ioc_snapshot.last_check = 0
+        assert db.rdb.is_IoC_snapshot_up_to_date()
+        assert db.search_IP_in_IoC('9.9.9.9')
+        assert db.is_domain_malicious('www.example.org')[1] is False
+
+        # IoCs deleted from the db after the snapshot was written
+        # aren't found in it
+        db.delete_IoCs_of_source('snapshot_feed.txt')
+        assert not db.rdb.is_IoC_snapshot_up_to_date()
+        assert db.search_IP_in_IoC('9.9.9.9') is False
+    finally:
+        db.rdb.ioc_snapshot = None
+        db.rdb.ioc_snapshot_path = ''
+
+
+def test_ti_hit_keeps_ioc_snapshot(tmp_path):
+    db.rdb.ioc_snapshot_path = str(tmp_path / 'ioc_snapshot.bin')
+    db.rdb.ioc_snapshot = IoCSnapshot(db.rdb.ioc_snapshot_path)
+    try:
+        db.add_ips_to_IoC(
+            {'9.9.9.8': json.dumps({'source': 'snapshot_feed.txt'})},
+            source='snapshot_feed.txt'
+        )
+        db.write_IoC_snapshot()
+        db.rdb.ioc_snapshot.last_check = 0
+        assert db.rdb.is_IoC_snapshot_up_to_date()
+        # the IPs found while analyzing the traffic are cached in the db
+        # without making the other instances ignore the snapshot
+        db.add_ips_to_IoC(
+            {'9.9.9.8': json.dumps({'source': 'snapshot_feed.txt'})},
+            update_generation=False
+        )
+        db.rdb.last_ioc_generation_check = 0
+        assert db.rdb.is_IoC_snapshot_up_to_date()
+    finally:
+        db.rdb.ioc_snapshot = None
+        db.rdb.ioc_snapshot_path = ''
+
+
+def test_asn_cache():
+    # ranges cached by older versions, sorted by first octet
+    db.rdb.rcache.hset(
+        'cached_asn',
+        '8',
+        json.dumps({'8.8.8.0/24': {'org': 'GOOGLE, US', 'number': 'AS15169'}})
+    )
+    db.set_asn_cache('CLOUDFLARENET', '1.1.1.0/24', '13335')
+    assert db.get_asn_cache() == {
+        '8.8.8.0/24': json.dumps({'org': 'GOOGLE, US', 'number': 'AS15169'}),
+        '1.1.1.0/24': json.dumps({'org': 'CLOUDFLARENET', 'number': 'AS13335'}),
+    }
+
+
+def test_set_dns_resolution():
+    for srcip in ('192.168.1.2', '192.168.1.3', '192.168.1.2'):
+        db.set_dns_resolution(
+            'example.com', ['93.184.216.34'], 1700000000.0, 'uid',
+            'A', srcip, twid
+        )
+    resolution = db.get_dns_resolution('93.184.216.34')
+    assert resolution['domains'] == ['example.com']
+    assert resolution['resolved-by'] == ['192.168.1.2', '192.168.1.3']
+    assert db.get_domain_resolution('example.com') == ['93.184.216.34']
+
+
+def test_archive_closed_tws():
+    profileid_twid = f'{profileid}_timewindow5'
+    db.rdb.r.hset(f'{profileid_twid}_OutTuples', '8.8.8.8-53-udp', '["A", []]')
+    db.rdb.r.zadd(f'{profileid_twid}_timeline', {'flow1': 1, 'flow2': 2})
+    db.rdb.archive_closed_tws_after = 0
+    db.mark_profile_tw_as_closed(profileid_twid)
+    db.archive_closed_tws()
+    assert not db.rdb.r.exists(f'{profileid_twid}_OutTuples')
+    assert db.rdb.is_tw_archived(profileid_twid)
+
+    # new data of the tw after archiving it
+    db.rdb.r.hset(f'{profileid_twid}_OutTuples', '1.1.1.1-53-udp', '["B", []]')
+    # reading the tw restores it and merges it with the new data
+    assert json.loads(
+        db.get_outtuples_from_profile_tw(profileid, 'timewindow5')
+    ) == {'8.8.8.8-53-udp': ['A', []], '1.1.1.1-53-udp': ['B', []]}
+    assert db.rdb.r.zrange(f'{profileid_twid}_timeline', 0, -1) == [
+        'flow1', 'flow2'
+    ]
+    assert not db.rdb.is_tw_archived(profileid_twid)
+    db.rdb.archive_closed_tws_after = -1
+
+
+def test_sharded_redis():
+    shard_ports = [6382, 6383]
+    for port in shard_ports:
+        os.system(f'redis-server --port {port} --daemonize yes > /dev/null 2>&1')
+    time.sleep(1)
+    main = db.rdb.start_redis_instance(6379, 2)
+    shards = [db.rdb.start_redis_instance(port, 0) for port in shard_ports]
+    r = ShardedRedis(main, shards)
+    r.flushdb()
+
+    r.hset(profileid, 'ipv4', test_ip)
+    r.hset(f'{profileid}_{twid}', 'alerts', '{}')
+    r.zadd(f'tws{profileid}', {twid: 0})
+    r.sadd('profiles', profileid)
+    # all the keys of the profile are in the same shard
+    shard = r.get_node(profileid)
+    assert shard in shards
+    assert sorted(shard.keys()) == sorted(
+        [profileid, f'{profileid}_{twid}', f'tws{profileid}']
+    )
+    assert main.keys() == ['profiles']
+
+    pipe = r.pipeline(transaction=True)
+    pipe.hget(profileid, 'ipv4')
+    pipe.smembers('profiles')
+    pipe.delete(f'{profileid}_{twid}', 'profiles')
+    assert pipe.execute() == [test_ip, {profileid}, 2]
+    assert r.dbsize() == 2
+    r.flushdb()
+
+
+def test_redis_streams():
+    db.rdb.stream_channels = {'new_dns'}
+    channel_1 = db.rdb.subscribe('new_dns', subscriber='module_1')
+    channel_2 = db.rdb.subscribe('new_dns', subscriber='module_2')
+    for msg in ('msg1', 'msg2'):
+        db.publish('new_dns', msg)
+
+    # every subscriber gets every msg
+    for channel in (channel_1, channel_2):
+        assert channel.get_message()['data'] == 'msg1'
+        assert channel.get_message()['data'] == 'msg2'
+        assert channel.get_message() is None
+
+    db.trim_streams()
+    assert db.get_streams_backlog()['module_1']['new_dns']['pending'] == 0
+    del db.rdb.stream_channels
+
+
+def test_redis_streams_idle_channel():
+    db.rdb.stream_channels = {'new_flow', 'new_dns'}
+    busy_channel = db.rdb.subscribe('new_flow', subscriber='module_3')
+    idle_channel = db.rdb.subscribe('new_dns', subscriber='module_3')
+    consumer = db.rdb.stream_consumers['module_3']
+    consumer.block_time = 0.5
+    for i in range(10):
+        db.publish('new_flow', f'msg{i}')
+
+    start = time.time()
+    received = 0
+    for _ in range(10):
+        # the idle channel doesn't slow down reading the busy one
+        assert idle_channel.get_message() is None
+        received += bool(busy_channel.get_message())
+    assert received == 10
+    assert time.time() - start < consumer.block_time
+
+    # blocks only when none of the channels has msgs
+    start = time.time()
+    db.rdb.wait_for_stream_msgs('module_3')
+    assert time.time() - start >= consumer.block_time
+    del db.rdb.stream_channels
@@ -1,5 +1,9 @@
 """Unit test for modules/flowalerts/flowalerts.py"""
+from unittest.mock import Mock
+import time
+
 from tests.module_factory import ModuleFactory
+from modules.flowalerts.timer_scheduler import TimerScheduler
 import json
 from numpy import arange
 
@@ -187,3 +191,57 @@ def test_detect_young_domains(
             uid
         ) is False
     )
+
+
+def test_detect_data_upload_in_twid(
+        mock_db
+        ):
+    flowalerts = ModuleFactory().create_flowalerts_obj(mock_db)
+    flowalerts.gateway = '192.168.1.254'
+    flowalerts.data_exfiltration_threshold = 100
+    flowalerts.set_evidence.data_exfiltration = Mock()
+    mbs = 1024 * 1024
+    mock_db.get_sent_bytes_per_daddr.return_value = {
+        daddr: (200 * mbs, [uid, 'uid2'], timestamp),
+        '8.8.8.8': (1024, ['uid3'], timestamp),
+        flowalerts.gateway: (200 * mbs, ['uid4'], timestamp),
+    }
+    flowalerts.detect_data_upload_in_twid(profileid, twid)
+
+    # only the stored flows of the closed tw are counted
+    mock_db.get_sent_bytes_per_daddr.assert_called_once_with(
+        profileid, twid
+    )
+    flowalerts.set_evidence.data_exfiltration.assert_called_once()
+    args = flowalerts.set_evidence.data_exfiltration.call_args.args
+    assert args[0] == daddr
+    assert args[4] == [uid, 'uid2']
+
+
+def test_timer_scheduler():
+    scheduler = TimerScheduler()
+    ran = []
+    assert scheduler.schedule(uid, 0.1, ran.append, [uid])
+    # the same uid can't be checked twice at once
+    assert not scheduler.schedule(uid, 0.1, ran.append, ['duplicate'])
+    assert scheduler.schedule(
+        'uid2', 0.1, ran.append, ['uid2'], groups=[daddr]
+    )
+    # the flow uid2 was waiting for arrived
+    assert scheduler.cancel_group(daddr) == ['uid2']
+    time.sleep(0.5)
+    assert ran == [uid]
+    assert not scheduler.pending
+
+
+def test_timer_scheduler_failing_task():
+    errors = []
+    scheduler = TimerScheduler(log_error=errors.append)
+    ran = []
+    assert scheduler.schedule(uid, 0.1, int, ['not a number'])
+    assert scheduler.schedule('uid2', 0.1, ran.append, ['uid2'])
+    time.sleep(0.5)
+    # the failing task is logged and doesn't stop the others
+    assert ran == ['uid2']
+    assert 'Problem in the scheduled task int' in errors[0]
+    assert 'ValueError' in errors[1]
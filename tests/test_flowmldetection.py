@@ -0,0 +1,86 @@
+"""Unit test for modules/flowmldetection/flowmldetection.py"""
+from unittest.mock import Mock
+from tests.module_factory import ModuleFactory
+
+
+def get_flow_dict(proto: str, dport: int) -> dict:
+    return {
+        'proto': proto,
+        'state': 'Established',
+        'dport': dport,
+        'sport': 1234,
+        'dur': 1,
+        'pkts': 2,
+        'spkts': 1,
+        'allbytes': 100,
+        'sbytes': 50,
+        'label': 'unknown',
+        'module_labels': {},
+        'saddr': '192.168.1.1',
+        'daddr': '8.8.8.8',
+        'ts': 1.0,
+        'appproto': '',
+        'origstate': '',
+        'flow_type': 'conn',
+        'smac': '',
+        'dmac': '',
+    }
+
+
+def test_detect_batch(mock_db):
+    flowmldetection = ModuleFactory().create_flowmldetection_obj(mock_db)
+    flowmldetection.scaler = Mock(transform=lambda x_flow: x_flow)
+    # the prediction of each flow is its dport
+    flowmldetection.clf = Mock(
+        predict=lambda x_flow: [str(int(dport)) for dport in x_flow.dport]
+    )
+    flowmldetection.report_prediction = Mock()
+    flowmldetection.batch = [
+        (get_flow_dict('tcp', 80), 'timewindow1', 'uid1'),
+        # icmp flows are dropped by process_features()
+        (get_flow_dict('icmp', 0), 'timewindow1', 'uid2'),
+        (get_flow_dict('udp', 53), 'timewindow1', 'uid3'),
+    ]
+    flowmldetection.detect_batch()
+    predictions = {
+        call.args[2]: call.args[3]
+        for call in flowmldetection.report_prediction.call_args_list
+    }
+    assert predictions == {'uid1': '80', 'uid3': '53'}
+    assert not flowmldetection.batch
+
+
+def test_detect_batch_with_malformed_flow(mock_db):
+    flowmldetection = ModuleFactory().create_flowmldetection_obj(mock_db)
+    flowmldetection.scaler = Mock(transform=lambda x_flow: x_flow)
+    flowmldetection.clf = Mock(
+        predict=lambda x_flow: [str(int(dport)) for dport in x_flow.dport]
+    )
+    flowmldetection.report_prediction = Mock()
+    flowmldetection.batch = [
+        (get_flow_dict('tcp', 80), 'timewindow1', 'uid1'),
+        # this flow makes the prediction of the whole batch fail
+        (get_flow_dict('tcp', 'malformed'), 'timewindow1', 'uid2'),
+        (get_flow_dict('udp', 53), 'timewindow1', 'uid3'),
+    ]
+    flowmldetection.detect_batch()
+    predictions = {
+        call.args[2]: call.args[3]
+        for call in flowmldetection.report_prediction.call_args_list
+    }
+    # only the malformed flow isn't detected
+    assert predictions == {'uid1': '80', 'uid3': '53'}
+
+
+def test_detect_batch_after_failed_batch(mock_db):
+    flowmldetection = ModuleFactory().create_flowmldetection_obj(mock_db)
+    flowmldetection.report_prediction = Mock()
+    # the df of a previous, bigger batch
+    flowmldetection.flow = Mock(empty=False, index=[0, 1, 2])
+    flowmldetection.process_features = Mock(side_effect=ValueError)
+    flowmldetection.batch = [
+        (get_flow_dict('tcp', 80), 'timewindow1', 'uid1'),
+    ]
+    flowmldetection.detect_batch()
+    assert flowmldetection.flow is None
+    flowmldetection.report_prediction.assert_not_called()
@@ -5,6 +5,7 @@ from unittest.mock import patch
 import shutil
 import os
 import json
+import heapq
 
 
 @pytest.mark.parametrize(
@@ -91,7 +92,6 @@ def test_cache_nxt_line_in_file(
     """
     input = ModuleFactory().create_inputProcess_obj(path, 'zeek_log_file', mock_db)
     input.cache_lines = {}
-    input.file_time = {}
     input.is_zeek_tabs = is_tabs
 
     assert input.cache_nxt_line_in_file(path) == line_cached
@@ -99,6 +99,7 @@ def test_cache_nxt_line_in_file(
         assert input.cache_lines[path]['type'] == path
         # make sure it did read 1 line from the file
         assert input.cache_lines[path]['data']
+        assert input.earliest_lines[0][2] == path
 
 @pytest.mark.parametrize(
     'path, is_tabs, zeek_line, expected_val',
@@ -184,7 +185,7 @@ def test_get_earliest_line(
     input = ModuleFactory().create_inputProcess_obj(
         '', 'zeek_log_file', mock_db
         )
-    input.file_time = {
+    file_time = {
         'software.log': 3,
          'ssh.log': 2,
          'notice.log': 1,
@@ -202,7 +203,10 @@ def test_get_earliest_line(
          'conn.log': 'line5',
          'dns.log': 'line6',
         }
+    for filename, ts in file_time.items():
+        heapq.heappush(input.earliest_lines, (ts, 1, filename))
     assert input.get_earliest_line() == ('line1' , 'notice.log')
+    assert input.get_earliest_line() == ('line2' , 'ssh.log')
 
 
 
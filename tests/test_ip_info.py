@@ -2,8 +2,12 @@
 from tests.module_factory import ModuleFactory
 from slips_files.core.database.database_manager import DBManager
 import modules.ip_info.asn_info as asn
+from modules.ip_info.online_lookups import OnlineLookups
 from unittest.mock import patch
+import threading
+import time
 import maxminddb
+import pytest
 
 
 # ASN unit tests
@@ -27,6 +31,21 @@ def test_cache_ip_range(
     ASN_info = ModuleFactory().create_asn_obj(mock_db)
     assert ASN_info.cache_ip_range('8.8.8.8') == {'asn': {'number': 'AS15169', 'org': 'GOOGLE, US'}}
 
+@pytest.mark.parametrize(
+    'ip, expected_asn_info',
+    [
+        ('8.8.8.8', {'asn': {'org': 'GOOGLE, US', 'number': 'AS15169'}}),
+        ('8.9.8.8', None),
+        ('invalid', None),
+    ],
+)
+def test_get_cached_asn(ip, expected_asn_info, mock_db):
+    ASN_info = ModuleFactory().create_asn_obj(mock_db)
+    mock_db.get_asn_cache.return_value = {
+        '8.8.8.0/24': '{"org": "GOOGLE, US", "number": "AS15169"}'
+    }
+    assert ASN_info.get_cached_asn(ip) == expected_asn_info
+
 # GEOIP unit tests
 def test_get_geocountry(
         mock_db
@@ -66,3 +85,102 @@ def test_get_vendor(mocker,
 
     assert mac_info is not False
     assert mac_info['Vendor'].lower() == 'Pcs Systemtechnik GmbH'.lower()
+
+
+def wait_for_lookups(lookups: OnlineLookups, timeout=5):
+    end = time.time() + timeout
+    while lookups.pending and time.time() < end:
+        lookups.last_deadline_check = 0
+        lookups.handle_results()
+        time.sleep(0.01)
+
+
+def test_online_lookups_coalescing_and_negative_cache():
+    calls = []
+
+    def lookup(ip):
+        calls.append(ip)
+        return False if ip.startswith('10.') else f'host-{ip}'
+
+    lookups = OnlineLookups('test', lookup, max_workers=2)
+    results = []
+    assert lookups.submit('8.8.8.0/24', results.append, '8.8.8.8')
+    # same key while the first lookup is pending, doesn't look it up again
+    assert lookups.submit('8.8.8.0/24', results.append, '8.8.8.9')
+    assert lookups.submit('10.0.0.0/24', results.append, '10.0.0.1')
+    wait_for_lookups(lookups)
+
+    assert sorted(calls) == ['10.0.0.1', '8.8.8.8']
+    assert sorted(results, key=str) == [None, 'host-8.8.8.8', 'host-8.8.8.8']
+    # the failed key isn't looked up again
+    assert not lookups.submit('10.0.0.0/24', results.append, '10.0.0.2')
+    lookups.shutdown()
+
+
+def test_online_lookups_timeout():
+    release = threading.Event()
+
+    def slow_lookup(ip):
+        release.wait(5)
+        return 'too late'
+
+    lookups = OnlineLookups('test', slow_lookup, max_workers=1, timeout=0.05)
+    results = []
+    lookups.submit('1.1.1.1', results.append, '1.1.1.1')
+    lookups.submit('1.1.1.2', results.append, '1.1.1.2')
+    time.sleep(0.1)
+    wait_for_lookups(lookups)
+    release.set()
+
+    assert results == [None, None]
+    assert not lookups.submit('1.1.1.1', results.append, '1.1.1.1')
+    lookups.shutdown()
+
+
+def test_online_lookups_shutdown():
+    release = threading.Event()
+    calls = []
+
+    def slow_lookup(ip):
+        calls.append(ip)
+        release.wait(5)
+
+    lookups = OnlineLookups('test', slow_lookup, max_workers=1)
+    lookups.submit('1.1.1.1', lambda result: None, '1.1.1.1')
+    lookups.submit('1.1.1.2', lambda result: None, '1.1.1.2')
+    # wait for the first lookup to start
+    end = time.time() + 5
+    while not calls and time.time() < end:
+        time.sleep(0.01)
+    lookups.shutdown()
+    release.set()
+    lookups.executor.shutdown(wait=True)
+    # the lookup that didn't start yet was cancelled
+    assert calls == ['1.1.1.1']
+
+
+def test_get_asn_in_background(mocker, mock_db):
+    ip_info = ModuleFactory().create_ip_info_obj(mock_db)
+    ip_info.init_online_lookups()
+    mock_db.get_asn_cache.return_value = {}
+    mocker.patch.object(
+        ip_info.asn, 'get_asn_info_from_geolite', return_value={}
+    )
+    rdap = mocker.patch.object(
+        ip_info.asn,
+        'get_ip_range_online',
+        return_value={'org': 'TEST', 'cidr': '1.2.3.0/24', 'number': '123'},
+    )
+    ip_info.rdap_lookups.lookup = rdap
+    update_ip_info = mocker.patch.object(ip_info.asn, 'update_ip_info')
+
+    ip_info.get_asn('1.2.3.4', {})
+    ip_info.get_asn('1.2.3.5', {})
+    wait_for_lookups(ip_info.rdap_lookups)
+
+    # both ips share the same rdap lookup
+    assert rdap.call_count == 1
+    expected_asn = {'asn': {'org': 'TEST', 'number': 'AS123'}}
+    update_ip_info.assert_any_call('1.2.3.4', {}, expected_asn)
+    update_ip_info.assert_any_call('1.2.3.5', {}, expected_asn)
+    ip_info.shutdown_gracefully()
@@ -3,11 +3,14 @@ from unittest.mock import Mock
 
 from tests.module_factory import ModuleFactory
 from tests.common_test_utils import do_nothing
+import queue
 import subprocess
+import time
 import pytest
 import json
 from slips_files.core.profiler import SUPPORTED_INPUT_TYPES, SEPARATORS
 from slips_files.core.flows.zeek import Conn
+from slips_files.core.helpers.profiler_queue import ProfilerQueue
 
 
 
@@ -76,6 +79,12 @@ def test_define_separator_zeek_dict(file, input_type, expected_value,
     }
     profiler_detected_type: str = profilerProcess.define_separator(sample_flow, input_type)
     assert profiler_detected_type == expected_value
+    # json lines are sent to the profiler without parsing them
+    sample_flow = {
+        'data': json.dumps(sample_flow['data']),
+    }
+    profiler_detected_type: str = profilerProcess.define_separator(sample_flow, input_type)
+    assert profiler_detected_type == expected_value
 
 
 @pytest.mark.parametrize('nfdump_file', [('dataset/test1-normal.nfdump')])
@@ -219,3 +228,148 @@ def test_get_rev_profile_no_daddr(flow, mock_db):
     profiler.daddr_as_obj = None
     assert profiler.get_rev_profile() == (False, False)
 
+
+
+@pytest.mark.parametrize(
+    'flows_in_batch, batch_size, waited, expected',
+    [
+        (0, 100, 10, False),
+        (100, 100, 0, True),
+        (5, 100, 0, False),
+        # the oldest flow in the batch waited longer than the batch timeout
+        (5, 100, 10, True),
+    ],
+)
+def test_should_commit_batch(
+        flows_in_batch, batch_size, waited, expected, mock_db
+    ):
+    profiler = ModuleFactory().create_profiler_obj(mock_db)
+    profiler.batch_size = batch_size
+    profiler.batch_timeout = 0.5
+    profiler.flows_in_batch = flows_in_batch
+    profiler.batch_start_time = time.time() - waited
+    assert profiler.should_commit_batch() == expected
+
+
+@pytest.mark.parametrize(
+    'saddr, daddr, analysis_direction, expected_msgs',
+    [
+        # the reverse profile is only stored when the direction is 'all'
+        ('192.168.1.1', '8.8.8.8', 'out', 1),
+        ('192.168.1.1', '8.8.8.8', 'all', 2),
+        # both ips are profiled by the same worker
+        ('192.168.1.1', '192.168.1.1', 'all', 1),
+    ],
+)
+def test_send_flow_to_workers(
+        saddr, daddr, analysis_direction, expected_msgs, mock_db
+    ):
+    profiler = ModuleFactory().create_profiler_obj(mock_db)
+    profiler.workers_queues = [Mock(), Mock()]
+    profiler.get_worker_of_ip = lambda ip: 0 if ip == saddr else 1
+    profiler.analysis_direction = analysis_direction
+    profiler.flow = Conn(
+                '1.0',
+                '1234',
+                saddr,
+                daddr,
+                5,
+                'TCP',
+                'dhcp',
+                80,88,
+                20,20,
+                20,20,
+                '','',
+                'Established',''
+            )
+    profiler.send_flow_to_workers()
+    msgs = [
+        call.args[0]
+        for worker_queue in profiler.workers_queues
+        for call in worker_queue.put.call_args_list
+    ]
+    assert len(msgs) == expected_msgs
+    # the flow is always stored in the profile of the saddr
+    assert profiler.workers_queues[0].put.call_args.args[0]['store_out']
+
+
+def test_handle_setting_first_flow_time(mock_db):
+    profiler = ModuleFactory().create_profiler_obj(mock_db)
+    for starttime in ('1.0', '2.0'):
+        profiler.flow = Conn(
+            starttime, '1234', '192.168.1.1', '8.8.8.8', 5, 'TCP', 'dhcp',
+            80, 88, 20, 20, 20, 20, '', '', 'Established', ''
+        )
+        profiler.handle_setting_first_flow_time()
+    # only the first flow sets it, before it's sent to the workers
+    mock_db.set_first_flow_time.assert_called_once_with('1.0')
+
+
+def test_stop_workers_on_termination(mock_db):
+    profiler = ModuleFactory().create_profiler_obj(mock_db)
+    profiler.workers_queues = [Mock()]
+    # the worker never sets its done event, e.g. it crashed
+    worker_done = Mock()
+    worker_done.wait.return_value = False
+    profiler.workers_done = [worker_done]
+    profiler.termination_event = Mock()
+    profiler.termination_event.is_set.return_value = True
+    profiler.stop_workers()
+    profiler.workers_queues[0].put.assert_called_once_with('stop')
+
+
+def test_profiler_queue():
+    profiler_queue = ProfilerQueue(size=1024, batch_size=3)
+    msgs = [
+        {
+            'line': {'type': 'conn.log', 'data': f'{{"ts":{i}, "uid":"C{i}"}}'},
+            'input_type': 'zeek_folder',
+        }
+        for i in range(20)
+    ]
+    msgs.append(
+        {
+            'line': {'type': 'stdin', 'line_type': 'zeek', 'data': {'ts': 1}},
+            'input_type': 'stdin',
+            'total_flows': 1,
+        }
+    )
+    try:
+        # the msgs take more space than the buffer has, so it
+        # wraps around
+        received = []
+        for msg in msgs:
+            profiler_queue.put(msg)
+            received.append(profiler_queue.get(timeout=0))
+        profiler_queue.put('stop')
+        received.append(profiler_queue.get(timeout=0))
+
+        assert received == msgs + ['stop']
+        with pytest.raises(queue.Empty):
+            profiler_queue.get(timeout=0)
+    finally:
+        profiler_queue.close()
+        profiler_queue.unlink()
+
+
+def test_profiler_queue_full():
+    profiler_queue = ProfilerQueue(size=1024)
+    msg = {
+        'line': {'type': 'conn.log', 'data': 'x' * 200},
+        'input_type': 'zeek_folder',
+    }
+    stop = Mock()
+    stop.is_set.return_value = False
+    try:
+        # nothing reads the msgs, so the buffer gets full
+        for _ in range(4):
+            profiler_queue.put(msg, stop=stop)
+        with pytest.raises(queue.Full):
+            profiler_queue.put(msg, timeout=0.2)
+        # gives up once slips is stopping
+        stop.is_set.return_value = True
+        with pytest.raises(queue.Full):
+            profiler_queue.put(msg, stop=stop)
+    finally:
+        profiler_queue.close()
+        profiler_queue.unlink()
@@ -1,5 +1,6 @@
 """Unit test for modules/threat_intelligence/threat_intelligence.py"""
 from tests.module_factory import ModuleFactory
+from slips_files.common.ioc_snapshot import IoCSnapshot
 import os
 import pytest
 
@@ -42,3 +43,51 @@ def test_check_local_ti_files_for_update(
     mock_db.get_TI_file_info.return_value = {'hash': old_hash}
 
     assert threatintel.should_update_local_ti_file(own_malicious_iocs) == expected_return
+
+
+@pytest.mark.parametrize(
+    'ip, expected',
+    [
+        ('192.168.1.10', True),
+        ('2001:db8::1', True),
+        ('10.0.0.1', False),
+    ],
+)
+def test_ip_belongs_to_blacklisted_range(ip, expected, mocker, mock_db):
+    threatintel = ModuleFactory().create_threatintel_obj(mock_db)
+    mock_db.get_malicious_ip_ranges.return_value = {
+        '192.168.1.0/24': '{}',
+        '2001:db8::/32': '{}',
+    }
+    mock_db.get_malicious_ip_range_info.return_value = (
+        '{"description": "test", "source": "test_feed", "threat_level": "high"}'
+    )
+    threatintel.get_malicious_ip_ranges()
+    mocker.patch.object(threatintel, 'set_evidence_malicious_ip')
+    assert bool(
+        threatintel.ip_belongs_to_blacklisted_range(
+            ip, 'uid', '8.8.8.8', 'timestamp', 'profile_1.1.1.1',
+            'timewindow1', 'srcip'
+        )
+    ) == expected
+
+
+def test_ioc_snapshot(tmp_path):
+    path = str(tmp_path / 'ioc_snapshot.bin')
+    ips = {f'10.0.0.{i}': f'{{"source": "feed{i}"}}' for i in range(256)}
+    IoCSnapshot.write(path, {'IoC_ips': ips, 'IoC_domains': {}})
+
+    snapshot = IoCSnapshot(path)
+    assert snapshot.get('IoC_ips', '10.0.0.7') == '{"source": "feed7"}'
+    assert snapshot.get('IoC_ips', '8.8.8.8') is None
+    assert snapshot.get('IoC_domains', 'example.com') is None
+    assert snapshot.get('IoC_JA3', 'hash') is None
+
+    # readers map the new snapshot once it replaces the old one
+    IoCSnapshot.write(
+        path, {'IoC_ips': {'8.8.8.8': '{}'}}, generation='generation2'
+    )
+    snapshot.last_check = 0
+    assert snapshot.get('IoC_ips', '8.8.8.8') == '{}'
+    assert snapshot.get('IoC_ips', '10.0.0.7') is None
+    assert snapshot.generation == 'generation2'
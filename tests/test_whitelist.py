@@ -1,4 +1,6 @@
 from tests.module_factory import ModuleFactory
+from slips_files.common.domain_trie import DomainTrie
+from slips_files.common.ip_range_index import IPRangeIndex
 import pytest
 
 
@@ -37,3 +39,180 @@ def test_load_org_IPs(org, subnet,
     first_octet = subnet.split('.')[0]
     assert first_octet in whitelist.load_org_IPs(org)
     assert subnet in whitelist.load_org_IPs(org)[first_octet]
+
+
+def get_flow(**kwargs):
+    flow = {
+        'type_': 'conn',
+        'saddr': '192.168.1.1',
+        'daddr': '8.8.8.8',
+        'smac': '',
+        'dmac': '',
+    }
+    flow.update(kwargs)
+    return type('Flow', (), flow)()
+
+
+@pytest.mark.parametrize(
+    'whitelist,flow,expected',
+    [
+        # whitelisted src ip
+        (
+            {'IPs': {'192.168.1.1': {'from': 'src', 'what_to_ignore': 'flows'}}},
+            get_flow(),
+            True,
+        ),
+        # the ip is whitelisted as a src only
+        (
+            {'IPs': {'8.8.8.8': {'from': 'src', 'what_to_ignore': 'flows'}}},
+            get_flow(),
+            False,
+        ),
+        # only alerts are ignored
+        (
+            {'IPs': {'8.8.8.8': {'from': 'both', 'what_to_ignore': 'alerts'}}},
+            get_flow(),
+            False,
+        ),
+        # subdomain of a whitelisted domain
+        (
+            {'domains': {'example.com': {'from': 'both', 'what_to_ignore': 'flows'}}},
+            get_flow(type_='http', host='www.example.com'),
+            True,
+        ),
+        (
+            {'domains': {'example.com': {'from': 'both', 'what_to_ignore': 'flows'}}},
+            get_flow(type_='http', host='example.com.test'),
+            False,
+        ),
+        # whitelisted ip in a dns answer
+        (
+            {'IPs': {'1.1.1.1': {'from': 'dst', 'what_to_ignore': 'both'}}},
+            get_flow(type_='dns', query='test.com', answers=['1.1.1.1']),
+            True,
+        ),
+        # whitelisted dst mac
+        (
+            {'mac': {'aa:bb:cc:dd:ee:ff': {'from': 'dst', 'what_to_ignore': 'flows'}}},
+            get_flow(dmac='aa:bb:cc:dd:ee:ff'),
+            True,
+        ),
+        # dst ip in the range of a whitelisted org
+        (
+            {'organizations': {'google': {'from': 'dst', 'what_to_ignore': 'flows'}}},
+            get_flow(),
+            True,
+        ),
+        (
+            {'organizations': {'google': {'from': 'src', 'what_to_ignore': 'flows'}}},
+            get_flow(),
+            False,
+        ),
+    ],
+)
+def test_is_whitelisted_flow(whitelist, flow, expected, mock_db):
+    whitelist_obj = ModuleFactory().create_whitelist_obj(mock_db)
+    mock_db.get_whitelist.side_effect = lambda type_: whitelist.get(type_, {})
+    mock_db.get_org_IPs.return_value = {'8': ['8.8.8.0/24']}
+    mock_db.get_org_info.return_value = '[]'
+    mock_db.get_ip_info.return_value = {}
+    mock_db.get_dns_resolution.return_value = {}
+    mock_db.get_mac_addr_from_profile.return_value = False
+    assert whitelist_obj.is_whitelisted_flow(flow) == expected
+
+
+def test_is_whitelisted_flow_after_reload(mock_db):
+    whitelist = ModuleFactory().create_whitelist_obj(mock_db)
+    mock_db.get_whitelist.return_value = {}
+    mock_db.get_mac_addr_from_profile.return_value = False
+    assert not whitelist.is_whitelisted_flow(get_flow())
+
+    whitelist.read_whitelist()
+    mock_db.get_whitelist.side_effect = lambda type_: (
+        {'8.8.8.8': {'from': 'dst', 'what_to_ignore': 'flows'}}
+        if type_ == 'IPs' else {}
+    )
+    assert whitelist.is_whitelisted_flow(get_flow())
+
+
+@pytest.mark.parametrize(
+    'asn_org,expected',
+    [
+        # the asn contains the name of the org
+        ('Google LLC', True),
+        # the asn is one of the asns of the org
+        ('AS15169', True),
+        ('Cloudflare', False),
+    ],
+)
+def test_is_whitelisted_flow_asn(asn_org, expected, mock_db):
+    whitelist = ModuleFactory().create_whitelist_obj(mock_db)
+    mock_db.get_whitelist.side_effect = lambda type_: (
+        {'google': {'from': 'dst', 'what_to_ignore': 'flows'}}
+        if type_ == 'organizations' else {}
+    )
+    mock_db.get_org_IPs.return_value = {}
+    mock_db.get_org_info.side_effect = lambda org, info: (
+        '["AS15169"]' if info == 'asn' else '[]'
+    )
+    mock_db.get_ip_info.return_value = {'asn': {'asnorg': asn_org}}
+    mock_db.get_dns_resolution.return_value = {}
+    mock_db.get_mac_addr_from_profile.return_value = False
+    for _ in range(3):
+        assert whitelist.is_whitelisted_flow(get_flow()) == expected
+    # the info of each ip is read once per flow, the asn check
+    # doesn't read it again
+    assert mock_db.get_ip_info.call_count == 2 * 3
+
+
+@pytest.mark.parametrize(
+    'ip,expected',
+    [
+        ('10.0.0.1', 'small'),
+        ('10.1.0.1', 'big'),
+        ('11.0.0.1', None),
+        ('2001:db8::1', 'v6'),
+        ('invalid', None),
+    ],
+)
+def test_ip_range_index(ip, expected):
+    index = IPRangeIndex()
+    index.add('10.0.0.0/8', 'big')
+    index.add('10.0.0.0/24', 'small')
+    index.add('2001:db8::/32', 'v6')
+    assert index.lookup(ip) == expected
+
+
+@pytest.mark.parametrize(
+    'domain,expected',
+    [
+        ('example.com', 'example.com'),
+        ('www.Example.com', 'example.com'),
+        ('a.b.example.org', 'b.example.org'),
+        ('badexample.com', None),
+        ('example.com.test', None),
+        ('com', None),
+    ],
+)
+def test_domain_trie(domain, expected):
+    trie = DomainTrie()
+    trie.add('example.com', 'example.com')
+    trie.add('b.example.org', 'b.example.org')
+    trie.add('removed.com')
+    assert trie.remove('removed.com')
+    assert len(trie) == 2
+    assert trie.lookup(domain) == expected
+
+
+@pytest.mark.parametrize(
+    'ip, expected',
+    [
+        ('216.73.80.1', True),
+        ('216.73.96.1', False),
+        ('invalid', False),
+    ],
+)
+def test_is_ip_in_org(ip, expected, mock_db):
+    whitelist = ModuleFactory().create_whitelist_obj(mock_db)
+    mock_db.get_org_IPs.return_value = {'216': ['216.73.80.0/20']}
+    assert whitelist.is_ip_in_org(ip, 'google') == expected
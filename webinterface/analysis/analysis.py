@@ -36,6 +36,20 @@ def get_all_tw_with_ts(profileid):
     return dict_tws
 
 
+def get_tw_key(profile, timewindow, key, read):
+    """
+    reads the given key of the given tw using read(), or from the archive
+    if slips moved this tw out of redis
+    :param profile: the ip of the profile
+    :param key: the suffix of the key, e.g. OutTuples
+    """
+    profileid_twid = f"profile_{profile}_{timewindow}"
+    key = f"{profileid_twid}_{key}"
+    if data := read(key):
+        return data
+    return __database__.get_archived_key(profileid_twid, key) or data
+
+
 def get_ip_info(ip):
     """
     Retrieve IP information from database
@@ -184,10 +198,13 @@ def set_intuples(profile, timewindow):
     :return: (tuple, string, ip_info)
     """
     data = []
-    if intuples := __database__.db.hget(
-        f"profile_{profile}_{timewindow}", 'InTuples'
+    if intuples := get_tw_key(
+        profile, timewindow, "InTuples", __database__.db.hgetall
     ):
-        intuples = json.loads(intuples)
+        intuples = {
+            tupleid: json.loads(tuple_info)
+            for tupleid, tuple_info in intuples.items()
+        }
         for key, value in intuples.items():
             ip, port, protocol = key.split("-")
             ip_info = get_ip_info(ip)
@@ -210,10 +227,13 @@ def set_outtuples(profile, timewindow):
     """
 
     data = []
-    if outtuples := __database__.db.hget(
-        f"profile_{profile}_{timewindow}", 'OutTuples'
+    if outtuples := get_tw_key(
+        profile, timewindow, "OutTuples", __database__.db.hgetall
     ):
-        outtuples = json.loads(outtuples)
+        outtuples = {
+            tupleid: json.loads(tuple_info)
+            for tupleid, tuple_info in outtuples.items()
+        }
 
         for key, value in outtuples.items():
             ip, port, protocol = key.split("-")
@@ -234,8 +254,8 @@ def set_timeline_flows(profile, timewindow):
     :return: list of timeline flows as set initially in database
     """
     data = []
-    if timeline_flows := __database__.db.hgetall(
-        f"profile_{profile}_{timewindow}_flows"
+    if timeline_flows := get_tw_key(
+        profile, timewindow, "flows", __database__.db.hgetall
     ):
         for key, value in timeline_flows.items():
             value = json.loads(value)
@@ -264,8 +284,11 @@ def set_timeline(profile, timewindow,):
     """
     data = []
 
-    if timeline := __database__.db.zrange(
-        f"profile_{profile}_{timewindow}_timeline", 0, -1
+    if timeline := get_tw_key(
+        profile,
+        timewindow,
+        "timeline",
+        lambda key: __database__.db.zrange(key, 0, -1),
     ):
         for flow in timeline:
             flow = json.loads(flow)
@@ -305,8 +328,9 @@ def set_alerts(profile, timewindow):
         alerts_tw = alerts.get(timewindow, {})
         tws = get_all_tw_with_ts(profile)
 
-        evidence: Dict[str, str] = __database__.db.hgetall(
-            f'{profile}_{timewindow}_evidence'
+        evidence: Dict[str, str] = get_tw_key(
+            profile.split("_")[1], timewindow, "evidence",
+            __database__.db.hgetall
             )
 
         for alert_id, evidence_id_list in alerts_tw.items():
@@ -347,8 +371,8 @@ def set_evidence(profile, timewindow, alert_id):
         evidence_ids: List[str] = alerts_tw[alert_id]
 
         profileid = f"profile_{profile}"
-        evidence: Dict[str, str] = __database__.db.hgetall(
-            f'{profileid}_{timewindow}_evidence'
+        evidence: Dict[str, str] = get_tw_key(
+            profile, timewindow, "evidence", __database__.db.hgetall
         )
 
         for evidence_id in evidence_ids:
@@ -370,8 +394,9 @@ def set_evidence_general(profile: str, timewindow: str):
     data = []
     profile = f"profile_{profile}"
 
-    evidence: Dict[str, str] = __database__.db.hgetall(
-            f'{profile}_{timewindow}_evidence'
+    evidence: Dict[str, str] = get_tw_key(
+            profile.split("_")[1], timewindow, "evidence",
+            __database__.db.hgetall
     )
     if evidence :
         for evidence_details in evidence.values():
@@ -1,3 +1,6 @@
+import json
+import os
+import sqlite3
 import redis
 from .signals import message_sent
 from webinterface.utils import *
@@ -34,6 +37,42 @@ class Database(object):
                                  decode_responses=True,
                                  health_check_interval=30)
 
+    def get_archived_key(self, profileid_twid: str, key: str):
+        """
+        returns the value of the given key of a tw that slips moved from
+        redis to the sqlite db in the output dir, in the format redis
+        returns it. None if the tw isn't archived
+        """
+        if not self.db.sismember('ArchivedTW', profileid_twid):
+            return None
+        output_dir = self.db.hget('analysis', 'output_dir')
+        if not output_dir:
+            return None
+
+        db_path = os.path.join(output_dir, 'flows.sqlite')
+        try:
+            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+            try:
+                row = conn.execute(
+                    'SELECT data FROM archived_tws WHERE profileid_twid = ?;',
+                    (profileid_twid,),
+                ).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        if not row:
+            return None
+
+        archived_key = json.loads(row[0]).get(key)
+        if not archived_key:
+            return None
+        key_type, value = archived_key
+        if key_type == 'zset':
+            # members sorted by score, like zrange()
+            return [member for member, _ in sorted(value, key=lambda m: m[1])]
+        return value
+
 
 __database__ = Database()
 
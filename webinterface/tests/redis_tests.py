@@ -59,18 +59,15 @@ def test_type_tws_correct():
 
 
 def test_type_outtuples_correct():
-  test_key = "profile_188.110.58.51_timewindow1"
-  test_field = "OutTuples"
+  test_key = "profile_188.110.58.51_timewindow1_OutTuples"
   assert __database__.type(test_key) == TYPE_HASH
 
-  outtuples = __database__.hget(test_key, test_field)
-  assert is_json(outtuples) is True
-
-  outtuples = json.loads(outtuples)
+  outtuples = __database__.hgetall(test_key)
   assert type(outtuples) is dict
 
   first_keypair = list(outtuples.items())[0]
-  assert type(first_keypair[1]) is list
+  assert is_json(first_keypair[1]) is True
+  assert type(json.loads(first_keypair[1])) is list
 
 
 def test_type_IPsInfo_correct():